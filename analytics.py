@@ -0,0 +1,220 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# statistics of the bootstrap, in the order of the last axis of _bootstrap_chunk
+STATISTICS = ("mean", "sharpe_ratio")
+
+
+def load_results(returns_csv: str, trade_counts_csv: str = None):
+    """
+    Reads a returns (and trade count) csv of results/ with one Portfolio_<trading_start> column per trading period.
+
+    Returns:
+    returns dataframe, trade count dataframe (None without trade_counts_csv)
+    """
+    returns = pd.read_csv(returns_csv, index_col=0)
+    returns.index = pd.to_datetime(returns.index)
+    if trade_counts_csv is None:
+        return returns, None
+    trade_counts = pd.read_csv(trade_counts_csv, index_col=0)
+    trade_counts.index = pd.to_datetime(trade_counts.index)
+    return returns, trade_counts
+
+
+def daily_returns(returns, trade_counts=None, costs: list = None) -> pd.DataFrame:
+    """
+    Daily returns of all portfolios of a backtest, one column per transaction cost level.
+
+    Parameters:
+    returns: Portfolio_<date> returns dataframe, or a {cost: dataframe} dict of the drivers with transaction_costs
+             (already after costs)
+    trade_counts: Portfolio_<date> trade count dataframe of the returns, needed for costs
+    costs: cost levels subtracted per trade from the returns like in comparison_framework.ipynb
+           (returns - trade_counts * cost), defaults to [0.0]
+
+    Returns:
+    dataframe dates x cost levels
+    """
+    if isinstance(returns, dict):
+        return pd.DataFrame({cost: df.sum(axis=1) for cost, df in returns.items()}).rename_axis(columns="cost")
+
+    costs = np.asarray([0.0] if costs is None else costs, dtype=np.float64)
+    gross = np.nansum(returns.to_numpy(dtype=np.float64), axis=1)
+    if trade_counts is None:
+        if np.any(costs != 0):
+            raise ValueError("costs need the trade counts of the returns")
+        counts = np.zeros(len(gross))
+    else:
+        counts = np.nansum(trade_counts.reindex(returns.index).to_numpy(dtype=np.float64), axis=1)
+    net = gross[:, None] - counts[:, None] * costs[None, :]
+    return pd.DataFrame(net, index=pd.to_datetime(returns.index), columns=pd.Index(costs, name="cost"))
+
+
+def monthly_excess_returns(daily: pd.DataFrame, n_pairs: int = 20, n_portfolios: int = 6) -> pd.DataFrame:
+    """
+    Monthly excess returns like comparison_framework.ipynb: the return on committed capital (summed daily returns
+    / the n_pairs nominated pairs) averaged over the n_portfolios overlapping portfolios (= trading months).
+    """
+    return daily.resample("1ME").sum() / n_pairs / n_portfolios
+
+
+def _sharpe_ratio(values: np.ndarray, axis: int, periods_per_year: int) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return values.mean(axis=axis) / values.std(axis=axis, ddof=1) * np.sqrt(periods_per_year)
+
+
+def performance_summary(monthly: pd.DataFrame, periods_per_year: int = 12) -> pd.DataFrame:
+    """
+    Performance of every column of the monthly returns (strategies, cost levels, ...) at once.
+
+    Parameters:
+    monthly: monthly excess returns, one column per strategy / cost level
+    periods_per_year: annualization of the Sharpe ratio, 1 gives the monthly ratio of the notebook
+
+    Returns:
+    dataframe with one row per column of monthly
+    """
+    values = monthly.to_numpy(dtype=np.float64)
+    wealth = np.cumprod(1 + values, axis=0)
+    drawdown = wealth / np.maximum.accumulate(wealth, axis=0) - 1
+    return pd.DataFrame({"months": len(values),
+                         "mean": values.mean(axis=0),
+                         "std": values.std(axis=0, ddof=1),
+                         "sharpe_ratio": _sharpe_ratio(values, 0, periods_per_year),
+                         "positive_months": (values > 0).mean(axis=0),
+                         "cumulative_return": wealth[-1] - 1 if len(values) else np.nan,
+                         "max_drawdown": drawdown.min(axis=0) if len(values) else np.nan},
+                        index=monthly.columns)
+
+
+def crisis_years(market_returns: pd.Series, quantile: float = 0.2) -> pd.Index:
+    """
+    Years with a market return in the lowest quantile, e.g. the annual S&P 500 returns with a date index.
+    """
+    market_returns = market_returns.dropna()
+    years = pd.to_datetime(market_returns.index).year
+    return pd.Index(years[market_returns.to_numpy() <= market_returns.quantile(quantile)], name="year")
+
+
+def regime_summary(monthly: pd.DataFrame, crisis: pd.Index, periods_per_year: int = 12) -> pd.DataFrame:
+    """
+    performance_summary of the crisis and the normal months.
+
+    Returns:
+    dataframe indexed by (regime, column of monthly)
+    """
+    in_crisis = monthly.index.year.isin(crisis)
+    return pd.concat({"crisis": performance_summary(monthly[in_crisis], periods_per_year),
+                      "normal": performance_summary(monthly[~in_crisis], periods_per_year)}, names=["regime"])
+
+
+def stationary_bootstrap_indices(n: int, n_bootstrap: int, block_length: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Resampled positions of the stationary bootstrap (Politis and Romano 1994): blocks start at a random position,
+    have a geometric length with mean block_length and wrap around the end of the series.
+
+    Returns:
+    (n_bootstrap, n) positions
+    """
+    starts = rng.integers(0, n, size=(n_bootstrap, n))
+    new_block = rng.random((n_bootstrap, n)) < 1 / block_length
+    new_block[:, 0] = True
+    # position of the last block start of every draw, the block continues from its random start from there
+    steps = np.arange(n)
+    block_start = np.maximum.accumulate(np.where(new_block, steps, 0), axis=1)
+    return (np.take_along_axis(starts, block_start, axis=1) + steps - block_start) % n
+
+
+def _bootstrap_chunk(values: np.ndarray, seed: np.random.SeedSequence, n_bootstrap: int, block_length: float,
+                     periods_per_year: int) -> np.ndarray:
+    """
+    Mean and Sharpe ratio of n_bootstrap resamples of all columns, the columns are resampled jointly.
+
+    Returns:
+    (n_bootstrap, columns, statistics) array
+    """
+    rng = np.random.default_rng(seed)
+    samples = values[stationary_bootstrap_indices(len(values), n_bootstrap, block_length, rng)]
+    return np.stack([samples.mean(axis=1), _sharpe_ratio(samples, 1, periods_per_year)], axis=-1)
+
+
+def _bootstrap(values: np.ndarray, n_bootstrap: int, block_length: float, seed: int, n_workers: int,
+               periods_per_year: int, chunk_size: int = 500) -> np.ndarray:
+    """
+    Bootstrap statistics in chunks of chunk_size resamples (in parallel when n_workers > 1). Every chunk has its own
+    child seed of seed, so the results do not depend on n_workers.
+    """
+    sizes = [min(chunk_size, n_bootstrap - start) for start in range(0, n_bootstrap, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_workers <= 1:
+        chunks = [_bootstrap_chunk(values, chunk_seed, size, block_length, periods_per_year)
+                  for chunk_seed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunks = list(executor.map(_bootstrap_chunk, [values] * len(sizes), seeds, sizes,
+                                       [block_length] * len(sizes), [periods_per_year] * len(sizes)))
+    return np.concatenate(chunks)
+
+
+def bootstrap_confidence_intervals(monthly: pd.DataFrame, n_bootstrap: int = 5000, block_length: float = 6,
+                                   alpha: float = 0.05, seed: int = 0, n_workers: int = 1,
+                                   periods_per_year: int = 12) -> pd.DataFrame:
+    """
+    Stationary block bootstrap percentile intervals of the mean monthly return and the Sharpe ratio of every column.
+
+    Parameters:
+    monthly: monthly excess returns, one column per strategy / cost level
+    n_bootstrap: number of resamples
+    block_length: mean block length in months, keeps the autocorrelation of the overlapping portfolios
+    alpha: 1 - confidence level
+    seed: seed of the resamples, the same seed gives the same intervals for any n_workers
+    n_workers: number of processes
+
+    Returns:
+    dataframe with one row per column of monthly and the estimates with their lower / upper bounds
+    """
+    values = monthly.to_numpy(dtype=np.float64)
+    samples = _bootstrap(values, n_bootstrap, block_length, seed, n_workers, periods_per_year)
+    estimates = np.stack([values.mean(axis=0), _sharpe_ratio(values, 0, periods_per_year)], axis=-1)
+    low, high = np.nanquantile(samples, [alpha / 2, 1 - alpha / 2], axis=0)
+
+    columns = {}
+    for i, statistic in enumerate(STATISTICS):
+        columns[statistic] = estimates[:, i]
+        columns[f"{statistic}_low"] = low[:, i]
+        columns[f"{statistic}_high"] = high[:, i]
+    return pd.DataFrame(columns, index=monthly.columns)
+
+
+def sharpe_difference_test(monthly_a: pd.DataFrame, monthly_b: pd.DataFrame, n_bootstrap: int = 5000,
+                           block_length: float = 6, alpha: float = 0.05, seed: int = 0, n_workers: int = 1,
+                           periods_per_year: int = 12) -> pd.DataFrame:
+    """
+    Tests the difference of the Sharpe ratios of two strategies column by column (e.g. both with one column per cost
+    level) with the stationary block bootstrap. Both strategies are resampled with the same months so the
+    correlation of their returns is kept, the p-value is two sided from the bootstrap distribution of the difference
+    centered at the estimate (Ledoit and Wolf 2008 without studentization).
+
+    Parameters:
+    monthly_a, monthly_b: monthly excess returns with the same columns, only the common months are used
+    see bootstrap_confidence_intervals for the other parameters
+
+    Returns:
+    dataframe with one row per column: both Sharpe ratios, their difference (a - b), its interval and p-value
+    """
+    monthly_a, monthly_b = monthly_a.align(monthly_b, join="inner", axis=0)
+    monthly_b = monthly_b[monthly_a.columns]
+    n_columns = monthly_a.shape[1]
+    values = np.hstack([monthly_a.to_numpy(dtype=np.float64), monthly_b.to_numpy(dtype=np.float64)])
+
+    samples = _bootstrap(values, n_bootstrap, block_length, seed, n_workers, periods_per_year)[:, :, 1]
+    differences = samples[:, :n_columns] - samples[:, n_columns:]
+    sharpe = _sharpe_ratio(values, 0, periods_per_year)
+    difference = sharpe[:n_columns] - sharpe[n_columns:]
+    low, high = np.nanquantile(differences, [alpha / 2, 1 - alpha / 2], axis=0)
+    p_value = np.mean(np.abs(differences - difference) >= np.abs(difference), axis=0)
+    return pd.DataFrame({"sharpe_ratio_a": sharpe[:n_columns], "sharpe_ratio_b": sharpe[n_columns:],
+                         "difference": difference, "difference_low": low, "difference_high": high,
+                         "p_value": p_value}, index=monthly_a.columns)
@@ -0,0 +1,148 @@
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+from contextlib import contextmanager
+from datetime import datetime
+
+# One logger per stage of the backtest, all below the "pairs" root logger
+STAGES = ("formation", "selection", "estimation", "trading", "backtest")
+TRADE_EVENTS = "pairs.trades"
+
+DEFAULT_LEVELS = {stage: logging.INFO for stage in STAGES}
+
+# queue and logger levels of the active backtest_logging context, handed to worker processes
+_worker_config = (None, None)
+
+
+def get_logger(stage: str) -> logging.Logger:
+    """
+    Logger of a backtest stage ("formation", "selection", "estimation", "trading" or "backtest").
+    Per pair / per day messages are logged on DEBUG with lazy %-arguments, so they cost nothing unless
+    the stage is switched to DEBUG.
+    """
+    return logging.getLogger(f"pairs.{stage}")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Writes the "event" dict of a record as one compact JSON line.
+    """
+
+    def format(self, record):
+        return json.dumps(getattr(record, "event", {"message": record.getMessage()}), default=str,
+                          separators=(",", ":"))
+
+
+class _TradeEventFilter(logging.Filter):
+    def __init__(self, trade_events: bool):
+        super().__init__()
+        self.trade_events = trade_events
+
+    def filter(self, record):
+        return (record.name == TRADE_EVENTS) == self.trade_events
+
+
+def log_trade_events(trade_logger: logging.Logger, result_df, period: str):
+    """
+    Logs one JSON-lines event per closed trade (non zero return) of a trading period.
+    Nothing is computed if the trade event log is disabled.
+    """
+    if not trade_logger.isEnabledFor(logging.INFO):
+        return
+    closed = result_df.stack()
+    closed = closed[closed != 0]
+    for (date, pair), pair_return in closed.items():
+        trade_logger.info("trade", extra={"event": {"period": period, "date": f"{date:%Y-%m-%d}", "pair": pair,
+                                                    "return": float(pair_return)}})
+
+
+def _set_levels(levels: dict):
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+
+def worker_logging_args() -> tuple:
+    """
+    initargs for init_worker_logging of a process pool started inside backtest_logging(processes=True).
+    """
+    return _worker_config
+
+
+def init_worker_logging(log_queue, levels: dict):
+    """
+    Process pool initializer, sends the records of the worker to the queue of the parent's backtest_logging.
+    """
+    if log_queue is None:
+        return
+    root = logging.getLogger("pairs")
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.propagate = False
+    _set_levels(levels)
+
+
+@contextmanager
+def backtest_logging(strategy: str, log_dir: str = "logs", levels: dict = None, trade_events: bool = False,
+                     processes: bool = False):
+    """
+    Logs the backtest of a strategy into logs/backtest_<strategy>_<timestamp>.log.
+
+    The loggers only put the records on a queue, a QueueListener thread formats and writes them, so the backtest
+    never waits for the disk and nothing replaces sys.stdout.
+
+    Parameters:
+    strategy: name used in the log file name, e.g. "kalman"
+    log_dir: folder of the log files
+    levels: {stage: level} overrides of DEFAULT_LEVELS, e.g. {"selection": logging.DEBUG} logs every tested pair
+    trade_events: also write one JSON line per closed trade into logs/trades_<strategy>_<timestamp>.jsonl
+    processes: use a multiprocessing queue, so process pool workers can log through init_worker_logging
+
+    Yields:
+    name of the log file
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    log_filename = os.path.join(log_dir, f"backtest_{strategy}_{timestamp}.log")
+
+    file_handler = logging.FileHandler(log_filename, mode="w")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+    file_handler.addFilter(_TradeEventFilter(trade_events=False))
+    handlers = [file_handler]
+    if trade_events:
+        trade_handler = logging.FileHandler(os.path.join(log_dir, f"trades_{strategy}_{timestamp}.jsonl"), mode="w")
+        trade_handler.setFormatter(JsonLinesFormatter())
+        trade_handler.addFilter(_TradeEventFilter(trade_events=True))
+        handlers.append(trade_handler)
+
+    log_queue = multiprocessing.Queue() if processes else queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+
+    logger_levels = {get_logger(stage).name: level for stage, level in {**DEFAULT_LEVELS, **(levels or {})}.items()}
+    logger_levels[TRADE_EVENTS] = logging.INFO if trade_events else logging.CRITICAL + 1
+
+    global _worker_config
+    root = logging.getLogger("pairs")
+    old_levels = {name: logging.getLogger(name).level for name in logger_levels}
+    old_propagate = root.propagate
+    root.addHandler(queue_handler)
+    root.propagate = False
+    _set_levels(logger_levels)
+    if processes:
+        _worker_config = (log_queue, logger_levels)
+
+    listener.start()
+    try:
+        yield log_filename
+    finally:
+        listener.stop()
+        _worker_config = (None, None)
+        root.removeHandler(queue_handler)
+        root.propagate = old_propagate
+        _set_levels(old_levels)
+        for handler in handlers:
+            handler.close()
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+
+def _missing_value(dtype: np.dtype):
+    # integer arrays can not hold NaN, days outside of a trading period are 0 there
+    return np.nan if np.issubdtype(dtype, np.floating) else 0
+
+
+class BacktestResults:
+    """
+    Daily returns and trade counts of all trading periods of a backtest, one Portfolio_<trading_start> column per
+    period and one frame per transaction cost level.
+
+    The arrays are allocated once for all periods (dates x periods per cost level) and every finished period writes
+    the row sums of its 20 pairs into its column, the public DataFrames are built from them once at the end.
+    Days outside of the trading period of a column are NaN like in pd.DataFrame({portfolio: series}).
+
+    With sparse=True only the non zero values are kept and the frames have a pandas sparse dtype with fill value 0,
+    so days outside of the trading period are 0 instead of NaN (row sums do not change). Most of the daily P&L and
+    trade counts are 0, a trade closes on a few days of the 6 months.
+
+    Parameters:
+    dates: date index of the stock prices the periods were cut from
+    periods: list of periods from trading_periods
+    costs: transaction cost levels
+    returns_dtype: dtype of the returns, e.g. "float64" or "float32"
+    trade_counts_dtype: dtype of the trade counts, e.g. "float64" or "int8" (integer dtypes are 0 outside of a period)
+    sparse: keep only the non zero values and return sparse DataFrames
+    """
+
+    def __init__(self, dates: pd.DatetimeIndex, periods: list, costs: list, returns_dtype: str = "float64",
+                 trade_counts_dtype: str = "float64", sparse: bool = False):
+        self.costs = list(costs)
+        self.returns_dtype = np.dtype(returns_dtype)
+        self.trade_counts_dtype = np.dtype(trade_counts_dtype)
+        self.sparse = sparse
+
+        # the result index is the union of the trading windows
+        traded = np.zeros(len(dates), dtype=bool)
+        for _, _, trading_start, trading_end in periods:
+            traded[dates.searchsorted(trading_start, side="left"):dates.searchsorted(trading_end, side="right")] = True
+        self.index = dates[traded]
+        self.columns = pd.Index([f"Portfolio_{trading_start}" for _, _, trading_start, _ in periods])
+        self.rows = [(self.index.searchsorted(trading_start, side="left"),
+                      self.index.searchsorted(trading_end, side="right"))
+                     for _, _, trading_start, trading_end in periods]
+
+        shape = (len(self.index), len(self.columns))
+        if sparse:
+            # (rows, columns, values) of the non zero entries
+            self._returns = {cost: ([], [], []) for cost in self.costs}
+            self._trade_counts = {cost: ([], [], []) for cost in self.costs}
+        else:
+            self._returns = {cost: np.full(shape, _missing_value(self.returns_dtype), dtype=self.returns_dtype)
+                             for cost in self.costs}
+            self._trade_counts = {cost: np.full(shape, _missing_value(self.trade_counts_dtype),
+                                                dtype=self.trade_counts_dtype)
+                                  for cost in self.costs}
+
+    def add(self, column: int, gross_result_df: pd.DataFrame):
+        """
+        Stores the portfolio returns and trade counts of a period for every cost level.
+
+        Parameters:
+        column: position of the period in periods
+        gross_result_df: daily returns of the pairs without transaction costs, as returned by the period functions
+        """
+        start, stop = self.rows[column]
+        gross = gross_result_df.to_numpy(dtype=np.float64)
+        if gross.shape[0] != stop - start:
+            raise ValueError(f"{self.columns[column]} has {gross.shape[0]} days, its trading period {stop - start}")
+
+        for cost in self.costs:
+            # same as apply_transaction_costs, the cost is subtracted from every closed trade
+            net = np.where(gross == 0.0, gross, gross - cost)
+            returns = np.nansum(net, axis=1)
+            trade_counts = np.count_nonzero(net, axis=1)
+            if self.sparse:
+                for entries, values in ((self._returns[cost], returns), (self._trade_counts[cost], trade_counts)):
+                    nonzero = np.flatnonzero(values)
+                    entries[0].append(start + nonzero)
+                    entries[1].append(np.full(len(nonzero), column))
+                    entries[2].append(values[nonzero])
+            else:
+                self._returns[cost][start:stop, column] = returns
+                self._trade_counts[cost][start:stop, column] = trade_counts
+
+    def _frame(self, data, dtype: np.dtype) -> pd.DataFrame:
+        if not self.sparse:
+            return pd.DataFrame(data, index=self.index, columns=self.columns, copy=False)
+        from scipy import sparse as sp
+        rows, columns, values = (np.concatenate(part) if part else np.empty(0, dtype=int) for part in data)
+        matrix = sp.csc_matrix((values.astype(dtype), (rows, columns)), shape=(len(self.index), len(self.columns)))
+        # one dense column at a time, DataFrame.sparse.from_spmatrix would fill float columns with NaN
+        return pd.DataFrame({name: pd.arrays.SparseArray(matrix[:, j].toarray().ravel(), fill_value=0)
+                             for j, name in enumerate(self.columns)}, index=self.index, columns=self.columns)
+
+    def frames(self, transaction_costs: list = None):
+        """
+        Builds the returns and trade count DataFrames.
+
+        Returns:
+        two dataframes for a single cost level (transaction_costs=None), otherwise two {cost: dataframe} dicts
+        """
+        returns = {cost: self._frame(self._returns[cost], self.returns_dtype) for cost in self.costs}
+        trade_counts = {cost: self._frame(self._trade_counts[cost], self.trade_counts_dtype) for cost in self.costs}
+        if transaction_costs is None:
+            (cost,) = returns
+            return returns[cost], trade_counts[cost]
+        return returns, trade_counts
@@ -0,0 +1,170 @@
+"""
+Benchmarks of the formation, trading and end-to-end backtest stages on synthetic prices.
+
+Every stage is timed (best of --repeat runs) and its peak memory is measured with tracemalloc in a separate run.
+The results are compared with a baseline file, a stage that is slower or uses more memory than the baseline by more
+than --tolerance is reported as a regression (exit code 1).
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py                          # compare with benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --update-baseline        # store the results as the new baseline
+    python benchmarks/run_benchmarks.py --tickers 500 --output results.json
+    python benchmarks/run_benchmarks.py --kernel-backend numpy   # compare the kernel backends
+
+benchmarks/baseline.json is recorded with the default kernel backend (numba, it is installed on the baseline
+machine), a run with another backend is reported as a different configuration.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cointegration_functions import (normalize, calculate_and_sort_ssd, select_cointegrated_pairs,  # noqa: E402
+                                     calculate_portfolio_spread, trade_portfolio, trading_periods, _hossein_period)
+from kalman_functions import estimate_model, trade_portfolio_kalman, _kalman_period  # noqa: E402
+import kernels  # noqa: E402
+from synthetic import synthetic_prices  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# differences below these are timer / allocator noise and never count as a regression
+ABSOLUTE_SLACK = {"seconds": 0.002, "peak_mb": 0.5}
+
+
+def measure(function, repeat: int) -> dict:
+    """
+    Best wall time of repeat runs and the peak memory (tracemalloc) of one more run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak / 2**20}
+
+
+def stages(stocks: pd.DataFrame, screening_method: str) -> dict:
+    """
+    Benchmarked functions of the first formation / trading period of the synthetic prices.
+    """
+    period = trading_periods(stocks.index)[0]
+    formation_start, formation_end, trading_start, trading_end = period
+    stocks_window = stocks.loc[formation_start:trading_end]
+    stocks_normalized = normalize(stocks_window)
+    stocks_formation = stocks_normalized.loc[formation_start:formation_end]
+    stocks_trading = stocks_normalized.loc[trading_start:trading_end]
+
+    # inputs of the later stages, computed once outside of the timings
+    pairs_sorted = calculate_and_sort_ssd(stocks_formation)
+    portfolio = select_cointegrated_pairs(stocks_formation, pairs_sorted, method=screening_method)
+    portfolio_models = estimate_model(stocks_formation, portfolio)
+    spread_df, spread_df_norm = calculate_portfolio_spread(stocks_trading, portfolio)
+
+    return {
+        "normalize": lambda: normalize(stocks_window),
+        "calculate_and_sort_ssd": lambda: calculate_and_sort_ssd(stocks_formation),
+        "select_cointegrated_pairs": lambda: select_cointegrated_pairs(stocks_formation, pairs_sorted,
+                                                                       method=screening_method),
+        "estimate_model": lambda: estimate_model(stocks_formation, portfolio),
+        "trade_portfolio": lambda: trade_portfolio(spread_df, spread_df_norm),
+        "trade_portfolio_kalman": lambda: trade_portfolio_kalman(portfolio_models, stocks_trading),
+        "period_cointegration": lambda: _hossein_period(stocks, period, screening_method=screening_method),
+        "period_kalman": lambda: _kalman_period(stocks, period, screening_method=screening_method),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Stages that are slower or use more memory than the baseline by more than tolerance (relative).
+    """
+    regressions = []
+    for name, result in results["stages"].items():
+        reference = baseline.get("stages", {}).get(name)
+        if reference is None:
+            continue
+        for metric in ("seconds", "peak_mb"):
+            if (result[metric] > reference[metric] * (1 + tolerance)
+                    and result[metric] - reference[metric] > ABSOLUTE_SLACK[metric]):
+                regressions.append(f"{name} {metric}: {result[metric]:.4f} (baseline {reference[metric]:.4f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tickers", type=int, default=100, help="number of synthetic tickers")
+    parser.add_argument("--days", type=int, default=756, help="number of synthetic days (>= 30 months)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage, the best one is kept")
+    parser.add_argument("--screening-method", default="numpy", choices=["numpy", "statsmodels"])
+    parser.add_argument("--kernel-backend", choices=kernels.BACKENDS, default=kernels.get_backend(),
+                        help="implementation of the inner loops, see kernels.py")
+    parser.add_argument("--only", nargs="*", help="run only these stages")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown / memory growth")
+    parser.add_argument("--output", help="also write the results to this json file")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning)
+    kernels.set_backend(args.kernel_backend)
+    stocks = synthetic_prices(args.tickers, args.days, seed=args.seed)
+    # the kernel backend changes the timings like the workload does, a baseline of another backend is not compared
+    results = {"config": {"tickers": args.tickers, "days": args.days, "seed": args.seed, "repeat": args.repeat,
+                          "screening_method": args.screening_method, "kernel_backend": args.kernel_backend},
+               "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                               "pandas": pd.__version__, "machine": platform.machine()},
+               "stages": {}}
+
+    for name, function in stages(stocks, args.screening_method).items():
+        if args.only and name not in args.only:
+            continue
+        results["stages"][name] = measure(function, args.repeat)
+        print(f"{name:28s} {results['stages'][name]['seconds'] * 1000:10.2f} ms "
+              f"{results['stages'][name]['peak_mb']:10.2f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("baseline written to", args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline found, run with --update-baseline first")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    # the number of repeats does not change the workload
+    workload = {key: value for key, value in results["config"].items() if key != "repeat"}
+    if {key: value for key, value in baseline.get("config", {}).items() if key != "repeat"} != workload:
+        print("baseline was recorded with a different configuration:", baseline.get("config"))
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if not regressions:
+        print("no regressions against", args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
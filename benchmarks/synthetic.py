@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+
+def synthetic_prices(n_tickers: int = 100, n_days: int = 756, n_factors: int = None, seed: int = 42,
+                     start: str = "1990-01-01", A: float = 0.0, B: float = 0.9, C: float = 0.004) -> pd.DataFrame:
+    """
+    Deterministic synthetic price panel for the benchmarks, scaled to n_tickers x n_days.
+
+    Every ticker follows one of n_factors common random walks plus its own AR(1) deviation
+    x_t = A + B * x_t-1 + C * e_t (the state model of archive/pykalmantest.py), so tickers of the same factor
+    are cointegrated and the formation period finds pairs like on real data.
+
+    Returns:
+    price dataframe with a business day DatetimeIndex and tickers T0000, T0001, ...
+    """
+    rng = np.random.default_rng(seed)
+    n_factors = n_factors or max(n_tickers // 5, 1)
+
+    factors = np.cumsum(rng.normal(0, 0.01, size=(n_days, n_factors)), axis=0)
+    x = np.zeros((n_days, n_tickers))
+    noise = rng.normal(size=(n_days, n_tickers))
+    for t in range(1, n_days):
+        x[t] = A + B * x[t - 1] + C * noise[t]
+
+    log_prices = factors[:, np.arange(n_tickers) % n_factors] + x
+    prices = 50 * (1 + rng.random(n_tickers)) * np.exp(log_prices)
+    return pd.DataFrame(prices, index=pd.bdate_range(start, periods=n_days),
+                        columns=[f"T{i:04d}" for i in range(n_tickers)])
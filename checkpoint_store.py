@@ -0,0 +1,113 @@
+import os
+
+import pandas as pd
+
+from formation_cache import FormationCache, _parquet_available
+
+
+class CheckpointStore:
+    """
+    Append-only store of the finished backtest periods, one file per trading period.
+
+    Every period is written as soon as it is finished: the daily returns of its pairs without transaction costs,
+    from which the Portfolio_<trading_start> return and trade count columns of every cost level are computed.
+    A restarted backtest loads the stored periods instead of running them again.
+
+    Next to every period the content hash of its input prices (formation start to trading end) and of the settings
+    it was run with is stored, so after new days are appended to the price file only the new periods are run, and
+    stored periods whose prices or settings changed are flagged and run again.
+
+    Parameters:
+    directory: folder of the checkpoint files, use one folder per strategy
+    file_format: "parquet" or "pickle", defaults to parquet when pyarrow or fastparquet is installed
+    verify_inputs: compare the stored input hashes with the current prices and settings before a period is loaded,
+                   a period stored without a hash can not be verified and is run again
+    """
+
+    def __init__(self, directory: str, file_format: str = None, verify_inputs: bool = True):
+        self.directory = directory
+        self.file_format = file_format or ("parquet" if _parquet_available() else "pickle")
+        self.verify_inputs = verify_inputs
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(period: tuple) -> str:
+        """
+        Key of a (formation_start, formation_end, trading_start, trading_end) period.
+        """
+        return f"Portfolio_{pd.Timestamp(period[2]):%Y-%m-%d}"
+
+    @staticmethod
+    def settings(**options) -> str:
+        """
+        Fingerprint of the settings a period result depends on, e.g. settings(n_pairs=20, entry_threshold=2.0).
+        Objects like a ScreeningCascade need a repr of their parameters.
+        """
+        return ",".join(f"{name}={value!r}" for name, value in sorted(options.items()))
+
+    @staticmethod
+    def input_hash(stocks: pd.DataFrame, period: tuple, settings: str = "") -> str:
+        """
+        Content hash of the raw prices a period depends on, from formation start to trading end, and of its settings.
+        """
+        return FormationCache.universe_hash(stocks.loc[period[0]:period[3]], settings)
+
+    def _path(self, key: str) -> str:
+        extension = "parquet" if self.file_format == "parquet" else "pkl"
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def keys(self) -> list:
+        """
+        Keys of all stored periods, sorted by trading start.
+        """
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.directory)
+                      if name.startswith("Portfolio_") and not name.endswith((".tmp", ".sha1")))
+
+    def stored_hash(self, key: str) -> str:
+        """
+        Input hash a period was computed from, None if it was stored without one.
+        """
+        hash_path = os.path.join(self.directory, f"{key}.sha1")
+        if not os.path.exists(hash_path):
+            return None
+        with open(hash_path) as f:
+            return f.read().strip()
+
+    def is_current(self, key: str, stocks: pd.DataFrame, period: tuple, settings: str = "") -> bool:
+        """
+        True if the period is stored and was computed from the same prices with the same settings.
+        """
+        if key not in self:
+            return False
+        return not self.verify_inputs or self.stored_hash(key) == self.input_hash(stocks, period, settings)
+
+    def load(self, key: str) -> pd.DataFrame:
+        """
+        Returns the stored daily returns of the pairs of a period.
+        """
+        if self.file_format == "parquet":
+            return pd.read_parquet(self._path(key))
+        return pd.read_pickle(self._path(key))
+
+    def save(self, key: str, result_df: pd.DataFrame, input_hash: str = None):
+        """
+        Stores the daily returns of the pairs of a finished period and the hash of its input prices and settings.
+        """
+        # write to a temporary file first, so a killed run never leaves a half written period behind.
+        # The hash goes last: a period killed in between keeps its old hash and is run again
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        if self.file_format == "parquet":
+            result_df.to_parquet(tmp_path)
+        else:
+            result_df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+
+        if input_hash is not None:
+            hash_path = os.path.join(self.directory, f"{key}.sha1")
+            with open(hash_path + ".tmp", "w") as f:
+                f.write(input_hash)
+            os.replace(hash_path + ".tmp", hash_path)
@@ -1,16 +1,31 @@
 import pandas as pd 
 import numpy as np
-import statsmodels.api as sm
-from statsmodels.tsa.stattools import adfuller
-import warnings
 import math 
-from tqdm import tqdm
-import matplotlib.pyplot as plt
-from itertools import combinations
-import sys
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import logging
 import os
-from datetime import datetime
 
+from formation_cache import FormationCache
+from checkpoint_store import CheckpointStore
+from pair_prefilter import PairPrefilter
+from screening_cascade import ScreeningCascade, STAGES as CASCADE_STAGES
+from backtest_results import BacktestResults
+from instrumentation import Instrumentation, PeriodMetrics, count_trades, metrics_frame
+from kernels import trade_spreads as _trade_spreads, pair_ssd, replay_signals
+from backtest_logging import (backtest_logging, get_logger, log_trade_events, TRADE_EVENTS, init_worker_logging,
+                              worker_logging_args)
+
+_formation_log = get_logger("formation")
+_selection_log = get_logger("selection")
+_trading_log = get_logger("trading")
+_backtest_log = get_logger("backtest")
+
+
+# statsmodels, scipy.stats, tqdm and matplotlib are imported by the functions that use them, importing the module
+# (in every worker process) only loads numpy / pandas
 
 ### Formation period functions ### 
 def normalize(df: pd.DataFrame) -> pd.DataFrame:
@@ -21,113 +36,461 @@ def normalize(df: pd.DataFrame) -> pd.DataFrame:
     df_result = df/df.iloc[0,:]
     return df_result
 
-def calculate_and_sort_ssd(stocks: pd.DataFrame) -> pd.DataFrame:
+def calculate_and_sort_ssd(stocks: pd.DataFrame, top_k: int = None) -> pd.DataFrame:
     """
     Calculate sum of squared differences (SSD) for all unique pairs of stocks and sort them.
 
+    All pairs are computed in one pass on the price matrix using ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b,
+    stocks with missing prices in the window are masked out once instead of per pair.
+
     Parameters:
     stocks : pd.DataFrame
         Normalized stock dataframe scaled to 1 at the start for each stock.
+    top_k : int, optional
+        Only return the k pairs with the smallest SSD (partial sort). None returns all pairs.
 
     Returns:
     pd.DataFrame
         Sorted dataframe containing all possible stock pairs with their SSD values.
     """
-    print("\nSorting all combinations by SSD...\n")
-    print("=" * 80)
-    stock_pairs = list(combinations(stocks.columns, 2))  # Unique stock pairs
-    ssd_values = {}
+    _formation_log.debug("sorting all combinations by SSD")
+
+    # If the stock is not trading yet, skip all of its pairs
+    valid = ~stocks.isna().any(axis=0).to_numpy()
+    tickers = stocks.columns[valid]
+    prices = stocks.to_numpy(dtype=np.float64)[:, valid]
+
+    return _rank_pairs(_gram_ssd(prices), tickers, prices, top_k=top_k)
+
+def _gram_ssd(prices: np.ndarray) -> np.ndarray:
+    """
+    SSD matrix of all column pairs of a price matrix (T x N) via the gram matrix.
+    """
+    # SSD does not change when the same series is subtracted from both stocks. Centering every day on the
+    # cross-sectional mean keeps the norms small, which limits the cancellation error of the identity.
+    centered = prices - prices.mean(axis=1, keepdims=True)
+    gram = centered.T @ centered
+    sq_norms = np.diag(gram)
+    return sq_norms[:, None] + sq_norms[None, :] - 2 * gram
+
+def _rank_pairs(ssd_matrix: np.ndarray, tickers: pd.Index, prices: np.ndarray, top_k: int = None) -> pd.DataFrame:
+    """
+    Turn an SSD matrix into the sorted "ticker1_ticker2" dataframe returned by calculate_and_sort_ssd.
+
+    Pairs are enumerated in the same order as itertools.combinations and sorted with a stable sort, so equal
+    SSD values keep that order. With top_k only the k smallest are found (partial sort) and their SSD is
+    recomputed directly from the prices.
+    """
+    first, second = np.triu_indices(len(tickers), k=1)
+    ssd = ssd_matrix[first, second]
+
+    if top_k is not None and top_k < len(ssd):
+        selected = np.sort(np.argpartition(ssd, top_k - 1)[:top_k])
+        first, second = first[selected], second[selected]
+        ssd = pair_ssd(prices, first, second)
+
+    order = np.argsort(ssd, kind="stable")
+    index = tickers[first[order]] + "_" + tickers[second[order]]
+    return pd.DataFrame({"SSD": ssd[order]}, index=index)
+
+class RollingSSD:
+    """
+    Incremental SSD ranking for formation windows that move forward one month at a time.
 
-    for ticker1, ticker2 in stock_pairs:
-        
-        # Assign stock price series 
-        stock1, stock2 = stocks[ticker1], stocks[ticker2]
-        
-        # If the stock is not trading yet, skip this pair. 
-        if stock1.isna().any() or stock2.isna().any():
-            continue
-        
-        # Compute SSD 
-        spread = stock1 - stock2
-        ssd = np.sum(np.square(spread)) 
+    For every month the sufficient statistics of the raw prices are kept: the gram matrix (sums of products and
+    squares of all stock pairs) and the number of missing prices per stock. The window statistics are a running
+    sum of the monthly ones, so moving the window adds one month and drops one month. Because the formation prices
+    are normalized to the first day of the window, the normalized SSD is rebuilt from the raw sums as
+    SSD_ij = S_ii / p_i^2 + S_jj / p_j^2 - 2 S_ij / (p_i p_j), where p are the prices on the first day.
 
-        # Store directly in a dictionary
-        ssd_values[f"{ticker1}_{ticker2}"] = ssd  
+    Parameters:
+    stocks: raw (not normalized) stock prices with a date index
+    window_months: length of the formation period in months
+    """
+
+    def __init__(self, stocks: pd.DataFrame, window_months: int = 24):
+        self.tickers = stocks.columns
+        self.prices = stocks.to_numpy(dtype=np.float64)
+        self.window_months = window_months
+
+        # row range of every month in the price matrix
+        periods = pd.DatetimeIndex(stocks.index).to_period("M")
+        starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+        ends = np.r_[starts[1:], len(periods)]
+        self._month_rows = dict(zip(periods[starts], zip(starts, ends)))
+
+        self._months = deque()  # (month, gram, nan counts) of the months in the current window
+        self._gram = None
+        self._nan_count = None
+        self._shifts = 0
+
+    def _month_stats(self, month: pd.Period):
+        start, end = self._month_rows.get(month, (0, 0))
+        block = self.prices[start:end]
+        missing = np.isnan(block)
+        block = np.where(missing, 0.0, block)
+        return month, block.T @ block, missing.sum(axis=0)
+
+    def _rebuild(self, months):
+        self._months = deque(self._month_stats(month) for month in months)
+        self._gram = sum(stats[1] for stats in self._months)
+        self._nan_count = sum(stats[2] for stats in self._months)
+        self._shifts = 0
+
+    def _move_to(self, months):
+        current = [stats[0] for stats in self._months]
+        if current == months:
+            return
+        # the running sums drift by rounding errors, so they are rebuilt from scratch once per full window
+        if current[1:] != months[:-1] or self._shifts >= self.window_months:
+            self._rebuild(months)
+            return
+
+        _, gram, nan_count = self._months.popleft()
+        self._gram = self._gram - gram
+        self._nan_count = self._nan_count - nan_count
+
+        new_stats = self._month_stats(months[-1])
+        self._months.append(new_stats)
+        self._gram = self._gram + new_stats[1]
+        self._nan_count = self._nan_count + new_stats[2]
+        self._shifts += 1
+
+    def calculate_and_sort_ssd(self, formation_start: pd.Timestamp, top_k: int = None) -> pd.DataFrame:
+        """
+        Same output as calculate_and_sort_ssd(normalize(stocks.loc[formation_start:formation_end])).
+
+        Parameters:
+        formation_start: first day of the formation period
+        top_k: only return the k pairs with the smallest SSD
+
+        Returns:
+        Sorted dataframe containing all possible stock pairs with their SSD values.
+        """
+        _formation_log.debug("sorting all combinations by SSD (incremental)")
+        months = list(pd.period_range(pd.Timestamp(formation_start), periods=self.window_months, freq="M"))
+        self._move_to(months)
+
+        # normalize to the first trading day of the window, stocks with a missing price are skipped
+        rows = [self._month_rows[month] for month in months if month in self._month_rows]
+        first_row, last_row = rows[0][0], rows[-1][1]
+        valid = self._nan_count == 0
+        scale = 1 / self.prices[first_row, valid]
+
+        gram = self._gram[np.ix_(valid, valid)] * np.outer(scale, scale)
+        sq_norms = np.diag(gram)
+        ssd_matrix = sq_norms[:, None] + sq_norms[None, :] - 2 * gram
+
+        prices = self.prices[first_row:last_row, valid] / self.prices[first_row, valid]
+        return _rank_pairs(ssd_matrix, self.tickers[valid], prices, top_k=top_k)
+
+def batch_ols(x: np.ndarray, y: np.ndarray):
+    """
+    Closed form OLS of stock2 on stock1 without a constant for a batch of pairs, the same regression as sm.OLS(y, x).
 
-    # Convert dictionary to DataFrame (much faster than appending)
-    df_result = pd.DataFrame.from_dict(ssd_values, orient="index", columns=["SSD"])
+    Parameters:
+    x: (T, P) prices of stock1 of P pairs
+    y: (T, P) prices of stock2 of P pairs
 
-    return df_result.sort_values(by="SSD")
+    Returns:
+    beta, residuals (T, P), residuals mean, residuals sd and the p-value of beta (nan if there is no fit)
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(len(x), -1)
+    y = np.asarray(y, dtype=np.float64).reshape(len(y), -1)
+    n = len(x)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sxx = np.sum(x * x, axis=0)
+        beta = np.sum(x * y, axis=0) / sxx
+        residuals = y - beta * x
+        ssr = np.sum(residuals * residuals, axis=0)
+        t_stat = beta / np.sqrt(ssr / (n - 1) / sxx)
+    from scipy import stats
+    ols_pvalue = 2 * stats.t.sf(np.abs(t_stat), n - 1)
+
+    return beta, residuals, residuals.mean(axis=0), residuals.std(axis=0), ols_pvalue
+
+def _batch_inverse(gram: np.ndarray) -> np.ndarray:
+    """
+    Inverse of a stack of normal equation matrices, falls back to the pseudo inverse (like statsmodels) if one is singular.
+    """
+    try:
+        return np.linalg.inv(gram)
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(gram, hermitian=True)
 
-def select_cointegrated_pairs(stocks: pd.DataFrame, pairs: pd.DataFrame) -> pd.DataFrame:
+def batch_adf(residuals: np.ndarray, maxlag: int = None, autolag: str = "AIC"):
+    """
+    Augmented Dickey-Fuller test with a constant for a batch of series, the same test as adfuller(series).
+
+    Every regression of the test is solved for all series at once through the normal equations. With autolag="AIC"
+    the lag is selected per series on a common sample like in statsmodels, with autolag=None maxlag is used.
+
+    Parameters:
+    residuals: (T, P) series to test, e.g. the OLS residuals of P pairs
+    maxlag: maximum number of lagged differences, defaults to 12 * (T / 100)^(1/4)
+    autolag: "AIC" or None
+
+    Returns:
+    ADF statistic, MacKinnon p-value and the number of lags used for each series
+    """
+    x = np.asarray(residuals, dtype=np.float64).reshape(len(residuals), -1)
+    nobs, n_series = x.shape
+    if maxlag is None:
+        maxlag = min(nobs // 2 - 2, int(np.ceil(12.0 * np.power(nobs / 100.0, 1 / 4.0))))
+    x = np.ascontiguousarray(x.T)
+    xdiff = np.diff(x, axis=1)
+
+    def design(lags):
+        # columns: constant, lagged level, lagged differences 1..lags, on the last nobs - lags - 1 observations
+        columns = [np.ones((n_series, nobs - lags - 1)), x[:, lags:-1]]
+        columns += [xdiff[:, lags - lag:-lag] for lag in range(1, lags + 1)]
+        return np.stack(columns, axis=1), xdiff[:, lags:]
+
+    def normal_equations(exog, endog):
+        return np.matmul(exog, exog.transpose(0, 2, 1)), np.matmul(exog, endog[:, :, None])[..., 0]
+
+    usedlag = np.full(n_series, maxlag)
+    if autolag is not None:
+        # all lag lengths are fitted on the same observations so the information criteria are comparable
+        exog, endog = design(maxlag)
+        gram, moments = normal_equations(exog, endog)
+        n = exog.shape[2]
+        aic = np.empty((maxlag + 1, n_series))
+        for lags in range(maxlag + 1):
+            k = lags + 2
+            params = np.einsum("pij,pj->pi", _batch_inverse(gram[:, :k, :k]), moments[:, :k])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                ssr = np.sum(endog * endog, axis=1) - np.sum(params * moments[:, :k], axis=1)
+                aic[lags] = n * np.log(ssr / n) + n * (np.log(2 * np.pi) + 1) + 2 * k
+        aic = np.where(np.isnan(aic), np.inf, aic)
+        usedlag = np.argmin(aic, axis=0)
+
+    adf_stat = np.full(n_series, np.nan)
+    for lags in np.unique(usedlag):
+        # rerun the regression with the selected lag on all available observations
+        series = np.flatnonzero(usedlag == lags)
+        exog, endog = design(lags)
+        exog, endog = exog[series], endog[series]
+        gram, moments = normal_equations(exog, endog)
+        n, k = exog.shape[2], lags + 2
+        inverse = _batch_inverse(gram)
+        params = np.einsum("pij,pj->pi", inverse, moments)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            residuals_adf = endog - np.matmul(params[:, None, :], exog)[:, 0]
+            scale = np.sum(residuals_adf * residuals_adf, axis=1) / (n - k)
+            adf_stat[series] = params[:, 1] / np.sqrt(scale * inverse[:, 1, 1])
+
+    from statsmodels.tsa.adfvalues import mackinnonp
+    adf_pvalue = np.array([mackinnonp(stat, regression="c", N=1) for stat in adf_stat])
+    return adf_stat, adf_pvalue, usedlag
+
+def _engle_granger(x: np.ndarray, y: np.ndarray):
+    """
+    Engle-Granger two step test of one pair: OLS of stock2 on stock1 (without constant) and ADF test of the residuals.
+
+    Module level function so it can be sent to worker processes.
+
+    Returns:
+    (ols_pvalue, beta, residuals mean, residuals sd, adf_pvalue) or None if one of the steps failed
+    """
+    import statsmodels.api as sm
+    from statsmodels.tsa.stattools import adfuller
+    try:
+        model = sm.OLS(y, x).fit()
+        ols_pvalue = model.pvalues[0]
+        # if there is no linear relationship, the ADF test is not needed
+        if math.isnan(ols_pvalue):
+            return ols_pvalue, np.nan, np.nan, np.nan, np.nan
+        residuals = model.resid
+        adf_pvalue = adfuller(residuals)[1]
+    except Exception as e:
+        _selection_log.warning("Error during Engle-Granger test: %s", e)
+        return None
+
+    return ols_pvalue, model.params[0], np.mean(residuals), np.std(residuals), adf_pvalue
+
+def _engle_granger_batch(x: np.ndarray, y: np.ndarray):
+    """
+    Engle-Granger test of a batch of pairs with the closed form kernels batch_ols and batch_adf.
+
+    Returns:
+    list of (ols_pvalue, beta, residuals mean, residuals sd, adf_pvalue), one per pair
+    """
+    beta, residuals, mean, sd, ols_pvalue = batch_ols(x, y)
+    _, adf_pvalue, _ = batch_adf(residuals)
+    return list(zip(ols_pvalue, beta, mean, sd, adf_pvalue))
+
+def _pretest_residuals(xs: list, ys: list) -> list:
+    """
+    OLS residuals of the pairs of a chunk for the screening cascade, one batch_ols if the pairs have the same length.
+    """
+    if len({len(x) for x in xs}) == 1:
+        return [batch_ols(np.column_stack(xs), np.column_stack(ys))[1]]
+    return [batch_ols(x, y)[1] for x, y in zip(xs, ys)]
+
+# process pool of select_cointegrated_pairs, kept for the whole backtest instead of one pool per formation window
+_screening_executor = None
+
+def screening_pool(n_workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool with n_workers processes shared by all select_cointegrated_pairs calls of this process, started on
+    first use. A process forked from the owner of the pool (a period worker) starts its own.
+    """
+    global _screening_executor
+    owner = (os.getpid(), n_workers)
+    if _screening_executor is None or _screening_executor[0] != owner:
+        if _screening_executor is not None and _screening_executor[0][0] == os.getpid():
+            _screening_executor[1].shutdown()
+        _screening_executor = (owner, ProcessPoolExecutor(max_workers=n_workers))
+    return _screening_executor[1]
+
+def shutdown_screening_pool():
+    """
+    Stops the processes of screening_pool, the next select_cointegrated_pairs with n_workers > 1 starts a new pool.
+    """
+    global _screening_executor
+    if _screening_executor is not None and _screening_executor[0][0] == os.getpid():
+        _screening_executor[1].shutdown()
+    _screening_executor = None
+
+def select_cointegrated_pairs(stocks: pd.DataFrame, pairs: pd.DataFrame, n_workers: int = 1, chunk_size: int = None,
+                              method: str = "statsmodels", cascade: ScreeningCascade = None,
+                              n_pairs: int = 20) -> pd.DataFrame:
     """
     Test for cointegration using the engle-granger two step procedure. Continue until 20 pairs are found. This portfolio will 
     be traded for the next 6 months.
 
+    The candidates are tested in chunks (in parallel when n_workers > 1) and the results are accepted in SSD order,
+    so the portfolio does not depend on the number of workers.
+
     Parameters: 
     stocks: normalized stocks dataframe, a 24 month subset (formation period)  with a date column as an index
     pairs: all possible pairs ordered by ssd
+    n_workers: number of processes testing candidate pairs, 1 tests them one by one in this process. The processes
+               of screening_pool are reused by every call, so a backtest starts them once and not per window
+    chunk_size: number of candidate pairs tested at once, defaults to 1 for a single statsmodels worker, 8 * n_workers
+                for statsmodels and 64 * n_workers for numpy. Every worker gets one batch of a chunk, so the price
+                columns of a chunk are sent in n_workers messages instead of one per pair
+    method: "statsmodels" fits sm.OLS and adfuller per pair, "numpy" tests the whole chunk with batch_ols and batch_adf.
+            The numpy kernels expect pairs without missing prices, like the ones returned by calculate_and_sort_ssd.
+    cascade: ScreeningCascade, cheap pre-tests of the OLS residuals, only the pairs passing all of them get the ADF test
+    n_pairs: size of the portfolio, the first n_pairs accepted pairs (in SSD order), so a smaller portfolio is always a
+             prefix of a larger one
 
     Returns: 
-    porftolio: a portfolio of 20 stocks to be traded in the following 6 months 
+    porftolio: a portfolio of 20 stocks to be traded in the following 6 months, attrs["pairs_tested"] is the number of
+    candidates (in SSD order) that were tested until the portfolio was complete, attrs["cascade"] the number of these
+    candidates every cascade stage rejected (and "missed", the rejected pairs ADF accepted, in validate mode)
     """
 
     portfolio = pd.DataFrame()
     pair_count = 0
-    
-    for pair in pairs.index:
-        stock1, stock2 = pair.split("_")
-        print(100 * "-", "\nProcessing pair:", stock1, "-", stock2)
-
-        # Step 1: OLS of stock2 on stock1 (without constant)
-        data = pd.concat([stocks[stock1], stocks[stock2]], axis=1).dropna()  # Drop NaN values
-        x = data[stock1]  # No sm.add_constant()
-        y = data[stock2]
-
-        try:
-            model = sm.OLS(y,x).fit()
-            print("fitting ols....")
-        except Exception as e:
-            print(f"Error during OLS fit: {e}")
-
-        ols_pvalue = model.pvalues.iloc[0]
-        print("OLS p-values:\n", model.pvalues)
-        print("\n",ols_pvalue)
-       
-        # if there is no linear relationship, continue
-        if math.isnan(ols_pvalue): 
-            print("NO OLS FIT...")
-            continue 
-        
-        print("OLS FIT FOUND....")
-        
-        # Step 2 : dickey Fuller test of the residuals (the spread)
-        residuals = pd.Series(model.resid)
-
-        # Check stationarity
-        try:
-            adf_pvalue = adfuller(residuals)[1]
-            print("ADF p value: " ,adf_pvalue)
-        except Exception as e:
-            print(f"Error during ADF test: {e}")
-
-        # if stationary, select that pair as cointegrated, extract Beta, and parameters and add to the portfolio
-        if  adf_pvalue < 0.05 and not np.isnan(adf_pvalue):
-            print("Pair was selected and added to the portfolio!")
-            # Assign to DataFrame
-            portfolio.loc[pair, 'beta'] = model.params.iloc[0]
-            portfolio.loc[pair, 'mean'] = np.mean(residuals)
-            portfolio.loc[pair, 'sd'] = np.std(residuals)
-            pair_count += 1
-        else: 
-            print("non-stationary series!...")
-        
-        if pair_count == 20:
-            print(100*"X", "\n portfolio of 20 was selected")
+    pairs_tested = 0
+    rejections = dict.fromkeys(CASCADE_STAGES, 0)
+    missed = 0
+
+    if chunk_size is None:
+        if method == "numpy":
+            chunk_size = 64 * n_workers
+        else:
+            chunk_size = 1 if n_workers == 1 else 8 * n_workers
+    executor = screening_pool(n_workers) if n_workers > 1 else None
+
+    for chunk_start in range(0, len(pairs.index), chunk_size):
+        chunk = pairs.index[chunk_start:chunk_start + chunk_size]
+
+        # Step 1 and 2 for the whole chunk: OLS of stock2 on stock1 and ADF test of the residuals
+        if method == "numpy":
+            stock1, stock2 = zip(*(pair.split("_") for pair in chunk))
+            x = stocks[list(stock1)].to_numpy(dtype=np.float64)
+            y = stocks[list(stock2)].to_numpy(dtype=np.float64)
+        else:
+            xs, ys = [], []
+            for pair in chunk:
+                stock1, stock2 = pair.split("_")
+                data = pd.concat([stocks[stock1], stocks[stock2]], axis=1).dropna()  # Drop NaN values
+                xs.append(data[stock1].to_numpy())
+                ys.append(data[stock2].to_numpy())
+
+        # cheap pre-tests first, the ADF test only runs on the pairs that pass (on all pairs in validate mode)
+        rejected_by = [""] * len(chunk)
+        tested = np.arange(len(chunk))
+        if cascade is not None:
+            residuals = [batch_ols(x, y)[1]] if method == "numpy" else _pretest_residuals(xs, ys)
+            rejected_by = np.concatenate([cascade.screen(r) for r in residuals])
+            if not cascade.validate:
+                tested = np.flatnonzero(rejected_by == "")
+
+        if len(tested) == 0:
+            tested_results = []
+        elif method == "numpy":
+            x, y = x[:, tested], y[:, tested]
+            if executor is None:
+                tested_results = _engle_granger_batch(x, y)
+            else:
+                batches = [batch for batch in np.array_split(np.arange(len(tested)), n_workers) if len(batch)]
+                tested_results = []
+                for batch_results in executor.map(_engle_granger_batch, [x[:, b] for b in batches], [y[:, b] for b in batches]):
+                    tested_results.extend(batch_results)
+        else:
+            xs, ys = [xs[i] for i in tested], [ys[i] for i in tested]
+            if executor is None:
+                tested_results = [_engle_granger(x, y) for x, y in zip(xs, ys)]
+            else:
+                tested_results = list(executor.map(_engle_granger, xs, ys,
+                                                   chunksize=max(1, -(-len(xs) // n_workers))))
+        results = [None] * len(chunk)
+        for i, result in zip(tested, tested_results):
+            results[i] = result
+
+        # accept the results in SSD order
+        for pair, result, rejected in zip(chunk, results, rejected_by):
+            pairs_tested += 1
+            if rejected:
+                rejections[rejected] += 1
+                if not cascade.validate:
+                    _selection_log.debug("%s: rejected by the %s pre-test", pair, rejected)
+                    continue
+                if (result is not None and not math.isnan(result[0]) and not np.isnan(result[4])
+                        and result[4] < 0.05):
+                    missed += 1
+                    _selection_log.warning("%s: rejected by the %s pre-test, but the ADF test accepts it (p-value %s)",
+                                           pair, rejected, result[4])
+            if result is None:
+                continue
+
+            ols_pvalue, beta, mean, sd, adf_pvalue = result
+
+            # if there is no linear relationship, continue
+            if math.isnan(ols_pvalue):
+                _selection_log.debug("%s: no OLS fit", pair)
+                continue
+
+            # if stationary, select that pair as cointegrated, extract Beta, and parameters and add to the portfolio
+            if adf_pvalue < 0.05 and not np.isnan(adf_pvalue):
+                # Assign to DataFrame
+                portfolio.loc[pair, 'beta'] = beta
+                portfolio.loc[pair, 'mean'] = mean
+                portfolio.loc[pair, 'sd'] = sd
+                pair_count += 1
+                _selection_log.debug("%s: OLS p-value %s, ADF p-value %s, selected (%d pairs)",
+                                     pair, ols_pvalue, adf_pvalue, pair_count)
+            else:
+                _selection_log.debug("%s: OLS p-value %s, ADF p-value %s, non-stationary",
+                                     pair, ols_pvalue, adf_pvalue)
+
+            if pair_count == n_pairs:
+                _selection_log.info("portfolio of %d was selected", n_pairs)
+                break
+        if pair_count == n_pairs:
             break
 
-        print("\n pair count is :", pair_count) 
-        
+    portfolio.attrs["pairs_tested"] = pairs_tested
+    if cascade is not None:
+        portfolio.attrs["cascade"] = dict(rejections, missed=missed) if cascade.validate else rejections
+        _selection_log.info("%d candidates tested, rejected by the pre-tests: %s", pairs_tested,
+                            ", ".join(f"{stage} {count}" for stage, count in portfolio.attrs["cascade"].items()))
     return portfolio 
 
 ### Trading period functions ###
@@ -142,32 +505,22 @@ def calculate_portfolio_spread(stocks: pd.DataFrame, portfolio: pd.DataFrame) ->
 
     Returns: 2 dataframes, spread and normalized spread dataFrame for the trading period
     """
-    spread_df = pd.DataFrame(index=stocks.index)  # Set the index to match the stocks DataFrame
-    spread_df_normalized = pd.DataFrame(index=stocks.index)  # Same as above
-    
-    for pair in portfolio.index:
-        #Extract the parameters from the formation period 
-        beta,mean,sd = portfolio.loc[pair] 
-        
-        # Extract the tickes 
-        stock1, stock2 = pair.split("_")   
-             
-        # Calculate spread series using beta, spread = P2 - beta * P1. 
-        spread = stocks[stock2] - beta * stocks[stock1]
-        
-        spread_normalized = (spread - mean) / sd
-
-        spread_df[pair] = spread
-        spread_df_normalized[pair] = spread_normalized
+    #Extract the parameters from the formation period and the tickers of all pairs
+    beta, mean, sd = portfolio.reindex(columns=["beta", "mean", "sd"]).to_numpy(dtype=np.float64).T
+    stock1s = [pair.split("_")[0] for pair in portfolio.index]
+    stock2s = [pair.split("_")[1] for pair in portfolio.index]
 
-    return spread_df, spread_df_normalized
+    # Calculate spread series using beta, spread = P2 - beta * P1, one column per pair
+    spread = stocks[stock2s].to_numpy(dtype=np.float64) - beta * stocks[stock1s].to_numpy(dtype=np.float64)
+    spread_normalized = (spread - mean) / sd
 
-import sys
-import os
-from datetime import datetime
+    spread_df = pd.DataFrame(spread, index=stocks.index, columns=portfolio.index)
+    spread_df_normalized = pd.DataFrame(spread_normalized, index=stocks.index, columns=portfolio.index)
+    return spread_df, spread_df_normalized
 
 
-def trade_portfolio(spread_df: pd.DataFrame, spread_df_normalized: pd.DataFrame, useTransactionCosts: bool = False, transaction_cost: float = 0.006) -> pd.DataFrame:
+def trade_portfolio(spread_df: pd.DataFrame, spread_df_normalized: pd.DataFrame, useTransactionCosts: bool = False, transaction_cost: float = 0.006,
+                    entry_threshold: float = 2.0) -> pd.DataFrame:
     """
     Calculates the trading period spread of the selected pairs from the formation period
     Also calculate the normalized spread using the portfolio parameters.
@@ -177,229 +530,409 @@ def trade_portfolio(spread_df: pd.DataFrame, spread_df_normalized: pd.DataFrame,
     spread_df_normalized: the trading period spread normalized of the 20 pairs (6 months)
     useTransactionCosts: indicator whether transaction costs should be applied
     transaction_cost: estimated transaction cost (market impact + commission fee), multiplied by two
+    entry_threshold: the trade is entered when the normalized spread leaves +-entry_threshold
 
     Returns: 
     DataFrame containing the returns (from period t to t+n) for all 20 pairs.
     and a df of trade counts for that period
     """
-    result_df = pd.DataFrame(index = spread_df.index)
-    trade_counts_df = pd.DataFrame(index = spread_df.index)
-    n_diverged = 0
-    
-    for pair, pair_norm in zip(spread_df.columns,spread_df_normalized.columns):
-        pair_result = {}
-        entered_trade = False
-        print("proccesing pair: \n",  pair, "\n", 100*"-")
-        
-        # Direction variable 1 long -1 short 
-        direction = 0
-        
-        for i in range(0,len(spread_df.index)):
-            date = spread_df[pair].index[i]
-            spread_current = spread_df[pair].iloc[i].item()
-            spread_norm_current = spread_df_normalized[pair_norm].iloc[i].item()
-            
-            print(40*"-", "\nprocessing date", date)
-            print("Current spread is: ",  spread_current, "and Current norm spread is",spread_norm_current)
-
-            if abs(spread_norm_current) > 2 and not entered_trade:
-                print("Trade was entered...")
-                # when signal comes, save the variables at time t and enter trade
-                entered_trade = True
-                spread_t = spread_current
-                direction = -1 if spread_norm_current > 2 else 1 # short if spread is too large and long if too small 
-
-            # if the spread at time t was > 2 and 
-            # current spread returns to 0, exit and save delta_spread = spread_t+n - spread_t
-            if direction == -1 and spread_norm_current <= 0 and entered_trade:
-                print("Short Trade was exited...")    
-                entered_trade = False   # exit trade
-                delta_spread = abs(spread_current - spread_t) # return = delta spread
-            elif direction == 1 and spread_norm_current >= 0 and entered_trade: 
-                print("Long Trade was exited...")    
-                entered_trade = False   # exit trade
-                delta_spread = abs(spread_current - spread_t)
-                
-            else: 
-                # if trade is not entered or spread of the entered trade did not return to 0
-                delta_spread = 0.0 
-
-            # on the last day of trading, if the spread did not converge, exit the position in loss
-            if date == spread_df.index[len(spread_df.index)-1]:
-                print("\n LAST DAY OF THE TRADING....",date)
-                if entered_trade == True:
-                    print("Brute force close - current vs. entry:", spread_current, spread_t)
-                    spread_diff = spread_current - spread_t
-                    
-                     # Determine profit/loss based on trade direction
-                    if direction == 1:  # long
-                        delta_spread = spread_diff
-                    elif direction == -1:  # short
-                        delta_spread = -spread_diff
-                    
-                    # Convert to absolute profit/loss value
-                    delta_spread = abs(delta_spread) if delta_spread >= 0 else -abs(delta_spread)
-                    print("Final delta_spread:", delta_spread)
-                    
-                    if delta_spread < 0:
-                        n_diverged += 1 
-                   
-            # Save the delta spread
-            if useTransactionCosts and delta_spread != 0:
-                pair_result[date] =  delta_spread - transaction_cost 
-            else: 
-                pair_result[date] = delta_spread
-        
-        # append to result df 
-        result_df[pair] = pair_result
-        trade_counts_df[pair] = [1 if r != 0.0 else 0 for r in pair_result.values()]
-
-        print("\n number of completed round trip trades: ", sum(trade_counts_df[pair]), "\n",100*"-")    
-    
-    print("Trading of the portfolio from ", spread_df.index[0], " to ", spread_df.index[-1], "has finished. \n",
-          "number of diverged pairs for this portfolio =", n_diverged, "\n transaction costs apply:" , useTransactionCosts)
-    return result_df, trade_counts_df
+    result, n_diverged = _trade_spreads(spread_df.to_numpy(dtype=np.float64),
+                                        spread_df_normalized[spread_df.columns].to_numpy(dtype=np.float64),
+                                        entry_threshold)
+    result_df = pd.DataFrame(result, index=spread_df.index, columns=spread_df.columns)
 
-def run_strategy_hossein(stocks: pd.DataFrame, useTransactionCosts: bool = False):
-    
-    os.makedirs("logs", exist_ok=True)
+    if _trading_log.isEnabledFor(logging.DEBUG):
+        for pair, n_trades in zip(result_df.columns, np.sum(result != 0.0, axis=0)):
+            _trading_log.debug("pair %s number of completed round trip trades: %d", pair, n_trades)
 
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    log_filename = f"logs/backtest_cointegration_{timestamp}.log"
-    sys.stdout = open(log_filename, "w")
+    _trading_log.info("trading from %s to %s finished, diverged pairs: %d, transaction costs apply: %s",
+                      spread_df.index[0], spread_df.index[-1], n_diverged, useTransactionCosts)
+    return apply_transaction_costs(result_df, transaction_cost if useTransactionCosts else 0.0)
 
-    stocks.index = pd.to_datetime(stocks.index)
-    time_frame = stocks.index
+def apply_transaction_costs(result_df: pd.DataFrame, transaction_cost: float):
+    """
+    Subtracts the transaction cost from every non-zero return (completed round trip trade) of a result dataframe
+    without costs, so one trading pass can be evaluated for several cost levels.
 
-    months = pd.Series(time_frame).dt.to_period('M').unique()  # Extract unique months
+    Parameters:
+    result_df: daily returns of the pairs without transaction costs, as returned by trade_portfolio
+    transaction_cost: estimated transaction cost (market impact + commission fee), multiplied by two
 
-    # This is the main dataframe, that stores the daily returns of each portfolio 
-    returns_dictionary = {}
-    trade_counts_dictionary = {}
-    n_trading_periods = 0 
+    Returns:
+    DataFrame with the returns after costs and a df of trade counts (1 on the days a trade was closed)
+    """
+    result = result_df.to_numpy(dtype=np.float64)
+    result = np.where(result == 0.0, result, result - transaction_cost)
+    return (pd.DataFrame(result, index=result_df.index, columns=result_df.columns),
+            pd.DataFrame((result != 0.0).astype(int), index=result_df.index, columns=result_df.columns))
 
-    # Iterate through months instead of days
-    for start_idx in tqdm(range(len(months)), desc="Running Cointegration Backtest"):
+### Backtest functions ###
+def trading_periods(time_frame: pd.DatetimeIndex, formation_months: int = 24, trading_months: int = 6) -> list:
+    """
+    Overlapping backtest periods, one per month: 24 months formation followed by 6 months trading.
+
+    Parameters:
+    time_frame: dates of the stock prices
+    formation_months: length of the formation period
+    trading_months: length of the trading period
+
+    Returns:
+    list of (formation_start, formation_end, trading_start, trading_end) of all periods that end within the time frame
+    """
+    months = pd.Series(time_frame).dt.to_period('M').unique()  # Extract unique months
+
+    periods = []
+    for month in months:
+        formation_start = pd.Timestamp(month.start_time)
+        formation_end = formation_start + pd.DateOffset(months=formation_months)-pd.DateOffset(days=1)  # 24 months later
+        trading_start = formation_start + pd.DateOffset(months=formation_months)
+        trading_end = formation_end + pd.DateOffset(months=trading_months)  # Next 6 months
 
-        formation_start = pd.Timestamp(months[start_idx].start_time)
-        formation_end = formation_start + pd.DateOffset(months=24)-pd.DateOffset(days=1)  # 24 months later
-        trading_start = formation_start + pd.DateOffset(months=24)
-        trading_end = formation_end + pd.DateOffset(months=6)  # Next 6 months
-        
         # Ensure we don't exceed the timeframe
         if trading_end > time_frame[-1]:
             break
-        
-        # The backtest algorithm starts here:
-        # 1. normalize the stock data at the start of the formation period to 1$  
+        periods.append((formation_start, formation_end, trading_start, trading_end))
+    return periods
+
+def _count_selection(metrics: PeriodMetrics, portfolio: pd.DataFrame):
+    metrics.count("pairs_tested", portfolio.attrs.get("pairs_tested"))
+    metrics.count("pairs_selected", len(portfolio))
+    for stage, count in portfolio.attrs.get("cascade", {}).items():
+        metrics.count(f"cascade_{stage}", count)
+
+def _form_portfolio(stocks: pd.DataFrame, stocks_formation: pd.DataFrame, period: tuple, rolling_ssd: RollingSSD = None,
+                    formation_cache: FormationCache = None, screening_workers: int = 1,
+                    screening_method: str = "statsmodels", prefilter: PairPrefilter = None,
+                    cascade: ScreeningCascade = None, n_pairs: int = 20, metrics: PeriodMetrics = None) -> pd.DataFrame:
+    """
+    Formation part of a period, the same for both strategies: sort the pairs by SSD and select 20 cointegrated pairs.
+    Loaded from the formation cache if this window was already computed.
+    With a prefilter only its candidate pairs are ranked by SSD (for universes too large for all pairs), with a
+    cascade only the candidates passing its pre-tests get the ADF test.
+    The ssd and selection stages, the number of tested pairs and the cascade rejections are recorded in metrics.
+    """
+    formation_start, formation_end, _, _ = period
+    metrics = metrics if metrics is not None else PeriodMetrics()
+
+    if formation_cache is not None:
+        settings = "".join(repr(option) for option in (prefilter, cascade) if option is not None)
+        settings += "" if n_pairs == 20 else f"n_pairs={n_pairs}"
+        # the two ADF implementations only agree within tolerance, pairs near the 0.05 cut can differ
+        settings += "" if screening_method == "statsmodels" else f"method={screening_method}"
+        cache_key = formation_cache.key(stocks.loc[formation_start:formation_end], settings)
+        cached = formation_cache.load(cache_key)
+        if cached is not None:
+            _formation_log.info("formation loaded from cache: %s", cache_key)
+            metrics.count("formation_cached", True)
+            _count_selection(metrics, cached[1])
+            return cached[1]
+
+    # 2. sort by ssd ~ 1 minute
+    with metrics.stage("ssd"):
+        if prefilter is not None:
+            pairs_sorted = prefilter.candidates(stocks_formation)
+        elif rolling_ssd is not None:
+            pairs_sorted = rolling_ssd.calculate_and_sort_ssd(formation_start)
+        else:
+            pairs_sorted = calculate_and_sort_ssd(stocks_formation)
+
+    # 3. Select 20 cointegrated pairs 
+    with metrics.stage("selection"):
+        portfolio = select_cointegrated_pairs(stocks_formation, pairs_sorted, n_workers=screening_workers,
+                                              method=screening_method, cascade=cascade, n_pairs=n_pairs)
+    metrics.count("formation_cached", False)
+    _count_selection(metrics, portfolio)
+
+    if formation_cache is not None:
+        formation_cache.save(cache_key, pairs_sorted, portfolio)
+    return portfolio
+
+def _hossein_period(stocks: pd.DataFrame, period: tuple, rolling_ssd: RollingSSD = None,
+                    formation_cache: FormationCache = None, screening_workers: int = 1,
+                    screening_method: str = "statsmodels", prefilter: PairPrefilter = None,
+                    cascade: ScreeningCascade = None, instrumentation: Instrumentation = None, n_pairs: int = 20,
+                    entry_threshold: float = 2.0) -> pd.DataFrame:
+    """
+    One formation / trading period of the cointegration strategy.
+
+    Returns:
+    daily returns of the 20 pairs in the trading period without transaction costs,
+    attrs["metrics"] holds the stage timings and counters of the period
+    """
+    formation_start, formation_end, trading_start, trading_end = period
+    metrics = PeriodMetrics(CheckpointStore.key(period), instrumentation)
+
+    # The backtest algorithm starts here:
+    # 1. normalize the stock data at the start of the formation period to 1$  
+    with metrics.stage("normalize"):
         stocks_normalized = normalize(stocks.loc[formation_start:trading_end])
 
-        # Select formation period data   
-        stocks_formation = stocks_normalized.loc[formation_start:formation_end]
-        # Select testing data (next 6 months)
-        stocks_trading = stocks_normalized.loc[trading_start:trading_end]
-        
-        # Formation part 
-        # 2. sort by ssd ~ 1 minute
-        print("\nSorting all combinations by SSD...\n")
-        print("=" * 80)
-        pairs_sorted = calculate_and_sort_ssd(stocks_formation)
-
-        print(f"Formation Start:\n{stocks_formation.index[0]}")
-        print("X" * 80)
-
-        # 3. Select 20 cointegrated pairs 
-        print("\nSelecting cointegrated pairs using Engle-Kranger method...\n")
-        print("=" * 80)
-        portfolio = select_cointegrated_pairs(stocks_formation, pairs_sorted)
-
-        print(f"Formation End:\n{stocks_formation.index[-1]}")
-        print("-" * 80)
-
-        print(f"Trading Start:\n{stocks_trading.index[0]}")
-        
-        # Trading part 
-        # 4. Calculate spread and normalized spread for all 20 pairs of the portfolio
-        print("\nCalculating spread in the trading period...\n")
-        print("=" * 80)
+    # Select formation period data   
+    stocks_formation = stocks_normalized.loc[formation_start:formation_end]
+    # Select testing data (next 6 months)
+    stocks_trading = stocks_normalized.loc[trading_start:trading_end]
+    _backtest_log.info("formation %s - %s, trading %s - %s", stocks_formation.index[0].date(),
+                       stocks_formation.index[-1].date(), stocks_trading.index[0].date(),
+                       stocks_trading.index[-1].date())
+
+    # Formation part
+    portfolio = _form_portfolio(stocks, stocks_formation, period, rolling_ssd=rolling_ssd,
+                                formation_cache=formation_cache, screening_workers=screening_workers,
+                                screening_method=screening_method, prefilter=prefilter, cascade=cascade,
+                                n_pairs=n_pairs, metrics=metrics)
+
+    # Trading part 
+    # 4. Calculate spread and normalized spread for all 20 pairs of the portfolio
+    with metrics.stage("spread"):
         spread_df, spread_df_norm = calculate_portfolio_spread(stocks_trading, portfolio)
 
-        # 5. Trade portfolio
-        print("\nPortfolio is trading...\n")
-        print("=" * 80)
-        result_df, trade_counts_df = trade_portfolio(spread_df, spread_df_norm, useTransactionCosts= useTransactionCosts)
+    # 5. Trade portfolio
+    with metrics.stage("trading"):
+        gross_result_df, _ = trade_portfolio(spread_df, spread_df_norm, useTransactionCosts=False,
+                                             entry_threshold=entry_threshold)
+    metrics.count("trades", count_trades(gross_result_df))
+    gross_result_df.attrs["metrics"] = metrics.as_dict()
+    return gross_result_df
+
+def _formation_months(period: tuple) -> int:
+    formation_start, _, trading_start, _ = period
+    return (trading_start.year - formation_start.year) * 12 + trading_start.month - formation_start.month
 
-        print(f"Trading End:\n{stocks_trading.index[-1]}\n")
-        print("X" * 80)
+def _run_period_chunk(period_function, stocks: pd.DataFrame, periods: list, incremental_ssd: bool = False,
+                      desc: str = None, **period_kwargs) -> list:
+    """
+    Runs period_function(stocks, period, rolling_ssd=..., **period_kwargs) for consecutive periods.
+    """
+    # keeps monthly SSD statistics so overlapping formation windows are not recomputed from scratch
+    rolling_ssd = RollingSSD(stocks, window_months=_formation_months(periods[0])) if incremental_ssd and periods else None
+    from tqdm import tqdm
+    try:
+        return [period_function(stocks, period, rolling_ssd=rolling_ssd, **period_kwargs)
+                for period in tqdm(periods, desc=desc, disable=desc is None)]
+    finally:
+        # the screening processes are shared by the periods of the chunk, not kept after the backtest
+        shutdown_screening_pool()
+
+def _run_shared_period_chunk(period_function, shm_name: str, shape: tuple, row_start: int, row_stop: int,
+                             dates: pd.DatetimeIndex, tickers: pd.Index, periods: list, incremental_ssd: bool,
+                             period_kwargs: dict) -> list:
+    """
+    Worker of _run_periods, reads the price rows of its periods from shared memory without copying them.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        prices = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)[row_start:row_stop]
+        results = _run_period_chunk(period_function, pd.DataFrame(prices, index=dates, columns=tickers, copy=False),
+                                    periods, incremental_ssd, **period_kwargs)
+    finally:
+        prices = None
+        shm.close()
+    return results
+
+def _checkpointed_period(period_function, checkpoints: CheckpointStore, settings: str, stocks: pd.DataFrame,
+                         period: tuple, **period_kwargs) -> pd.DataFrame:
+    """
+    Runs a period and stores its result right away, also inside a worker process.
+    """
+    result_df = period_function(stocks, period, **period_kwargs)
+    checkpoints.save(CheckpointStore.key(period), result_df, CheckpointStore.input_hash(stocks, period, settings))
+    return result_df
+
+# period_kwargs that only change how a period is computed, not its result, they are left out of the checkpoint settings
+_RUNTIME_OPTIONS = ("formation_cache", "screening_workers", "instrumentation")
+
+def _checkpoint_settings(period_function, period_kwargs: dict) -> str:
+    """
+    Settings fingerprint of the checkpoints of period_function: the strategy and every option of its result.
+    """
+    return CheckpointStore.settings(strategy=period_function.__name__,
+                                    **{name: value for name, value in period_kwargs.items()
+                                       if name not in _RUNTIME_OPTIONS})
+
+def _run_periods(period_function, stocks: pd.DataFrame, periods: list, n_workers: int = 1,
+                 incremental_ssd: bool = False, desc: str = None, checkpoints: CheckpointStore = None,
+                 **period_kwargs) -> list:
+    """
+    Runs period_function for every period, the results are returned in period order.
+
+    The periods only depend on their own window of the prices, so with n_workers > 1 they are split into contiguous
+    chunks that run on a process pool. The price matrix is copied into shared memory once and every worker only
+    reads the rows of its chunk's windows. The results are identical to the serial run.
+
+    Parameters:
+    period_function: function(stocks, period, rolling_ssd, **period_kwargs) of one period
+    stocks: stock prices with a date index
+    periods: list of periods from trading_periods
+    n_workers: number of processes
+    incremental_ssd: give every chunk a RollingSSD
+    desc: progress bar description
+    checkpoints: CheckpointStore, periods already in the store are loaded, the other periods are stored when finished.
+                 Stored periods whose input prices or settings (period_function and period_kwargs, see
+                 _checkpoint_settings) changed are flagged in the log and run again.
+    """
+    if checkpoints is not None:
+        settings = _checkpoint_settings(period_function, period_kwargs)
+        stored, changed = {}, []
+        for i, period in enumerate(periods):
+            key = CheckpointStore.key(period)
+            if checkpoints.is_current(key, stocks, period, settings):
+                stored[i] = checkpoints.load(key)
+            elif key in checkpoints:
+                changed.append(key)
+        if changed:
+            _backtest_log.warning("input prices or settings of %d stored periods changed, running them again: %s",
+                                  len(changed), ", ".join(changed))
+        _backtest_log.info("%d of %d periods loaded from the checkpoints, %d new periods", len(stored),
+                           len(periods), len(periods) - len(stored) - len(changed))
+        pending = [period for i, period in enumerate(periods) if i not in stored]
+        results = iter(_run_periods(partial(_checkpointed_period, period_function, checkpoints, settings), stocks,
+                                    pending, n_workers=n_workers, incremental_ssd=incremental_ssd, desc=desc,
+                                    **period_kwargs))
+        return [stored[i] if i in stored else next(results) for i in range(len(periods))]
+
+    if n_workers <= 1 or len(periods) <= 1:
+        return _run_period_chunk(period_function, stocks, periods, incremental_ssd, desc, **period_kwargs)
+
+    values = stocks.to_numpy(dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    try:
+        np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+
+        # a few chunks per worker balance the load, consecutive periods in a chunk keep the RollingSSD useful
+        chunks = np.array_split(np.arange(len(periods)), min(len(periods), 4 * n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker_logging,
+                                 initargs=worker_logging_args()) as executor:
+            futures = {}
+            for chunk in chunks:
+                chunk_periods = [periods[i] for i in chunk]
+                row_start = stocks.index.searchsorted(chunk_periods[0][0], side="left")
+                row_stop = stocks.index.searchsorted(chunk_periods[-1][3], side="right")
+                future = executor.submit(_run_shared_period_chunk, period_function, shm.name, values.shape,
+                                         row_start, row_stop, stocks.index[row_start:row_stop], stocks.columns,
+                                         chunk_periods, incremental_ssd, period_kwargs)
+                futures[future] = len(chunk_periods)
+
+            from tqdm import tqdm
+            with tqdm(total=len(periods), desc=desc) as progress:
+                for future in as_completed(futures):
+                    progress.update(futures[future])
+
+            # merge in period order, independent of the order the chunks finished in
+            results = [result for future in futures for result in future.result()]
+    finally:
+        shm.close()
+        shm.unlink()
+    return results
+
+def run_strategy_hossein(stocks: pd.DataFrame, useTransactionCosts: bool = False, incremental_ssd: bool = False,
+                         screening_workers: int = 1, screening_method: str = "statsmodels",
+                         formation_cache: FormationCache = None, transaction_costs: list = None,
+                         log_levels: dict = None, trade_events: bool = False, period_workers: int = 1,
+                         checkpoints: CheckpointStore = None, prefilter: PairPrefilter = None,
+                         cascade: ScreeningCascade = None, instrumentation: Instrumentation = None,
+                         returns_dtype: str = "float64",
+                         trade_counts_dtype: str = "float64", sparse_results: bool = False, n_pairs: int = 20,
+                         entry_threshold: float = 2.0, formation_months: int = 24, trading_months: int = 6):
+    """
+    Runs the cointegration backtest over all overlapping 24 month formation / 6 month trading periods.
+
+    Parameters:
+    stocks: stock prices with a date index
+    useTransactionCosts: indicator whether transaction costs (0.006 per round trip) should be applied
+    incremental_ssd: rank the pairs with RollingSSD instead of recomputing the SSD of every window
+    screening_workers: number of processes used by select_cointegrated_pairs
+    screening_method: "statsmodels" or "numpy", see select_cointegrated_pairs
+    formation_cache: FormationCache to load / store the formation results of every window
+    transaction_costs: list of cost levels, e.g. [0, 0.002, 0.006, 0.01], evaluated in one simulation pass
+                       (overrides useTransactionCosts)
+    log_levels: {stage: level} of the stage loggers, e.g. {"selection": logging.DEBUG}, see backtest_logging
+    trade_events: also write a JSON-lines log with one event per closed trade
+    period_workers: number of processes the monthly periods are spread over, see _run_periods
+    checkpoints: CheckpointStore, every finished period is stored right away and stored periods are not run again,
+                 so an interrupted backtest resumes where it stopped
+    prefilter: PairPrefilter, rank only its candidate pairs by SSD instead of all pairs of the universe
+    cascade: ScreeningCascade, cheap pre-tests before the ADF test of select_cointegrated_pairs
+    instrumentation: Instrumentation, keeps the per period metrics (stage times, pairs tested, trades) in
+                     instrumentation.metrics, writes them to its metrics_csv and profiles the configured stages
+    returns_dtype, trade_counts_dtype, sparse_results: storage of the result frames, see BacktestResults
+    n_pairs: number of pairs of every portfolio
+    entry_threshold: entry threshold of the normalized spread in standard deviations
+    formation_months, trading_months: length of the formation and trading periods, see trading_periods
+    (parameter_sweep.py evaluates grids of these parameters with shared work)
+
+    Returns:
+    returns and trade count dataframes with one Portfolio_<trading_start> column per trading period,
+    or two {cost: dataframe} dicts if transaction_costs is given
+    """
+    stocks.index = pd.to_datetime(stocks.index)
+    periods = trading_periods(stocks.index, formation_months, trading_months)
+
+    # This is the main result, that stores the daily returns of each portfolio (per transaction cost level)
+    costs = _transaction_cost_levels(useTransactionCosts, transaction_costs)
+    results = BacktestResults(stocks.index, periods, costs, returns_dtype=returns_dtype,
+                              trade_counts_dtype=trade_counts_dtype, sparse=sparse_results)
+    trade_logger = logging.getLogger(TRADE_EVENTS)
+
+    with backtest_logging("cointegration", levels=log_levels, trade_events=trade_events,
+                          processes=period_workers > 1) as log_filename:
+        gross_results = _run_periods(_hossein_period, stocks, periods, n_workers=period_workers,
+                                     incremental_ssd=incremental_ssd, desc="Running Cointegration Backtest",
+                                     checkpoints=checkpoints, formation_cache=formation_cache,
+                                     screening_workers=screening_workers, screening_method=screening_method,
+                                     prefilter=prefilter, cascade=cascade, instrumentation=instrumentation,
+                                     n_pairs=n_pairs, entry_threshold=entry_threshold)
 
         # 6. Calculate daily returns of each portfolio and append this column for each trading period
-        # calculated as a row sums of the daily returns of 20 pairs 
-        returns_dictionary[f"Portfolio_{trading_start}"] = result_df.sum(axis=1)
-        trade_counts_dictionary[f"Portfolio_{trading_start}"] = trade_counts_df.sum(axis=1)
-        n_trading_periods += 1
-        print("Number of trading periods: ", n_trading_periods) 
-    
-    sys.stdout.close()
-    sys.stdout = sys.__stdout__
-    print("Done ... logs saved into", log_filename)    
-    return pd.DataFrame(returns_dictionary), pd.DataFrame(trade_counts_dictionary)
+        # calculated as a row sums of the daily returns of 20 pairs, once for every transaction cost level
+        period_metrics = []
+        for column, (period, gross_result_df) in enumerate(zip(periods, gross_results)):
+            metrics = PeriodMetrics(CheckpointStore.key(period), instrumentation, gross_result_df.attrs.get("metrics"))
+            with metrics.stage("costs"):
+                log_trade_events(trade_logger, gross_result_df, f"{period[2]:%Y-%m-%d}")
+                results.add(column, gross_result_df)
+            period_metrics.append(metrics.as_dict())
+
+        _backtest_log.info("number of trading periods: %d", len(periods))
+        _export_metrics(instrumentation, periods, period_metrics)
+
+    print("Done ... logs saved into", log_filename)
+    return results.frames(transaction_costs)
+
+def _export_metrics(instrumentation: Instrumentation, periods: list, period_metrics: list) -> pd.DataFrame:
+    """
+    Per period metrics DataFrame of a backtest (index Portfolio_<trading_start> like the returns columns),
+    the stage totals are logged and the frame is handed to the instrumentation.
+    """
+    metrics_df = metrics_frame([f"Portfolio_{trading_start}" for _, _, trading_start, _ in periods], period_metrics)
+    totals = metrics_df.filter(like="_seconds").sum()
+    _backtest_log.info("seconds per stage: %s", ", ".join(f"{stage[:-8]} {seconds:.2f}"
+                                                          for stage, seconds in totals.items()))
+    if instrumentation is not None:
+        instrumentation.export(metrics_df)
+    return metrics_df
+
+def _transaction_cost_levels(useTransactionCosts: bool, transaction_costs: list, transaction_cost: float = 0.006) -> list:
+    """
+    Cost levels a backtest is evaluated for, a single level from useTransactionCosts if no list is given.
+    """
+    if transaction_costs is None:
+        return [transaction_cost if useTransactionCosts else 0.0]
+    return list(transaction_costs)
 
 def plot_spread_signals(spread_df, pair, std_multiplier=2):
-    
+    import matplotlib.pyplot as plt
+
     spread = spread_df[pair]
     # Compute bands
     upper_band = std_multiplier
     lower_band = -std_multiplier
 
-    # Track trades
-    long_entry_dates, long_entry_prices = [], []
-    long_exit_dates, long_exit_prices = [], []
-    short_entry_dates, short_entry_prices = [], []
-    short_exit_dates, short_exit_prices = [], []
-
-    trade_active = False
-    trade_type = None  # 'long' or 'short'
-
-    for i in range(len(spread)):
-        y_val = spread.iloc[i]
-        idx = spread.index[i]
-
-        if not trade_active:
-            if y_val > upper_band:
-                # Short entry
-                trade_active = True
-                trade_type = 'short'
-                short_entry_dates.append(idx)
-                short_entry_prices.append(y_val)
-            elif y_val < lower_band:
-                # Long entry
-                trade_active = True
-                trade_type = 'long'
-                long_entry_dates.append(idx)
-                long_entry_prices.append(y_val)
-        else:
-            if trade_type == 'short' and y_val < 0:
-                # Exit short
-                trade_active = False
-                trade_type = None
-                short_exit_dates.append(idx)
-                short_exit_prices.append(y_val)
-            elif trade_type == 'long' and y_val > 0:
-                # Exit long
-                trade_active = False
-                trade_type = None
-                long_exit_dates.append(idx)
-                long_exit_prices.append(y_val)
-        
-        # Last day 
-        if i == len(spread) - 1:
-            if trade_type == 'short':
-                short_exit_dates.append(idx)
-                short_exit_prices.append(y_val)
-            if trade_type == 'long':
-                short_exit_dates.append(idx)
-                short_exit_prices.append(y_val)
-            
+    # Replay the trades, exit when the spread crosses the mean
+    entries, exits = replay_signals(spread.to_numpy(), upper_band, lower_band, 0.0, 0.0)
+    long_entry_dates, long_entry_prices = spread.index[entries == 1], spread[entries == 1]
+    long_exit_dates, long_exit_prices = spread.index[exits == 1], spread[exits == 1]
+    short_entry_dates, short_entry_prices = spread.index[entries == -1], spread[entries == -1]
+    short_exit_dates, short_exit_prices = spread.index[exits == -1], spread[exits == -1]
 
     # Plotting
     plt.figure(figsize=(12, 6))
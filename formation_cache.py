@@ -0,0 +1,87 @@
+import hashlib
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def _parquet_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None or importlib.util.find_spec("fastparquet") is not None
+
+
+class FormationCache:
+    """
+    On-disk cache of the formation period results, shared by the cointegration and the Kalman strategy.
+
+    Both strategies run the same normalize -> calculate_and_sort_ssd -> select_cointegrated_pairs sequence on every
+    formation window, so the sorted SSD list and the selected portfolio (beta, mean, sd) are stored once per window
+    and loaded by every later run. The key is the formation window together with a hash of the universe
+    (tickers and raw prices of the window), so a changed price file never hits an old entry.
+
+    Parameters:
+    directory: folder of the cache files
+    file_format: "parquet" or "pickle", defaults to parquet when pyarrow or fastparquet is installed
+    """
+
+    def __init__(self, directory: str = "cache/formation", file_format: str = None):
+        self.directory = directory
+        self.file_format = file_format or ("parquet" if _parquet_available() else "pickle")
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def universe_hash(stocks_window: pd.DataFrame, settings: str = "") -> str:
+        """
+        Content hash of the raw prices of a window, including the tickers and the dates.
+        """
+        digest = hashlib.sha1()
+        digest.update("|".join(map(str, stocks_window.columns)).encode())
+        digest.update(pd.DatetimeIndex(stocks_window.index).asi8.tobytes())
+        digest.update(np.ascontiguousarray(stocks_window.to_numpy(dtype=np.float64)).tobytes())
+        digest.update(settings.encode())
+        return digest.hexdigest()
+
+    def key(self, stocks_formation: pd.DataFrame, settings: str = "") -> str:
+        """
+        Cache key of a formation window.
+
+        Parameters:
+        stocks_formation: raw (not normalized) prices of the formation period
+        settings: anything else the selected portfolio depends on, e.g. the number of pairs
+        """
+        formation_start = pd.Timestamp(stocks_formation.index[0])
+        return f"{formation_start:%Y-%m-%d}_{self.universe_hash(stocks_formation, settings)[:16]}"
+
+    def _path(self, key: str, name: str) -> str:
+        extension = "parquet" if self.file_format == "parquet" else "pkl"
+        return os.path.join(self.directory, f"{key}_{name}.{extension}")
+
+    def _read(self, path: str) -> pd.DataFrame:
+        if self.file_format == "parquet":
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def _write(self, df: pd.DataFrame, path: str):
+        # write to a temporary file first, so an interrupted run never leaves a half written entry behind
+        tmp_path = path + ".tmp"
+        if self.file_format == "parquet":
+            df.to_parquet(tmp_path)
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+
+    def load(self, key: str):
+        """
+        Returns (pairs_sorted, portfolio) of a formation window or None if it is not cached yet.
+        """
+        ssd_path, portfolio_path = self._path(key, "ssd"), self._path(key, "portfolio")
+        if not (os.path.exists(ssd_path) and os.path.exists(portfolio_path)):
+            return None
+        return self._read(ssd_path), self._read(portfolio_path)
+
+    def save(self, key: str, pairs_sorted: pd.DataFrame, portfolio: pd.DataFrame):
+        """
+        Stores the sorted SSD list and the selected portfolio of a formation window.
+        """
+        self._write(pairs_sorted, self._path(key, "ssd"))
+        self._write(portfolio, self._path(key, "portfolio"))
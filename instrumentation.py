@@ -0,0 +1,123 @@
+import cProfile
+import importlib.util
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+class Instrumentation:
+    """
+    Settings of the per period instrumentation of the backtest drivers.
+
+    Every period records the wall time of its stages (normalize, ssd, selection, estimation, spread, trading) and
+    counters (pairs tested before 20 were accepted, EM iterations, trades). With profile_stages the listed stages
+    are also profiled, one file per period and stage in profile_dir.
+
+    Parameters:
+    metrics_csv: path of the per period metrics csv written at the end of the backtest, None keeps them in memory only
+    profile_stages: stages to profile, e.g. ["estimation"]
+    profile_dir: folder of the profiler output
+    profiler: "cprofile" (.prof files for pstats / snakeviz) or "pyinstrument" (.html, needs pyinstrument)
+    """
+
+    def __init__(self, metrics_csv: str = None, profile_stages: list = (), profile_dir: str = "profiles",
+                 profiler: str = "cprofile"):
+        if profiler not in ("cprofile", "pyinstrument"):
+            raise ValueError(f"unknown profiler {profiler}, expected 'cprofile' or 'pyinstrument'")
+        if profiler == "pyinstrument" and importlib.util.find_spec("pyinstrument") is None:
+            raise ImportError("profiler='pyinstrument' needs the pyinstrument package")
+        self.metrics_csv = metrics_csv
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.metrics = None  # per period metrics DataFrame of the last backtest
+
+    def export(self, metrics_df: pd.DataFrame):
+        """
+        Keeps the metrics of a finished backtest in self.metrics and writes them to metrics_csv.
+        """
+        self.metrics = metrics_df
+        if self.metrics_csv is not None:
+            directory = os.path.dirname(self.metrics_csv)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            metrics_df.to_csv(self.metrics_csv)
+
+
+class PeriodMetrics:
+    """
+    Stage timings and counters of one backtest period.
+
+    Parameters:
+    name: period name, e.g. Portfolio_<trading_start>, also the prefix of the profiler files
+    instrumentation: Instrumentation with the profiling settings, None only measures
+    values: metrics recorded so far, e.g. the attrs["metrics"] of a period result
+    """
+
+    def __init__(self, name: str = None, instrumentation: Instrumentation = None, values: dict = None):
+        self.name = name
+        self.instrumentation = instrumentation
+        self.values = dict(values or {})
+
+    @contextmanager
+    def stage(self, stage: str):
+        """
+        Measures (and profiles if configured) the code inside the with block as <stage>_seconds.
+        """
+        profiler = self._start_profiler(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.values[f"{stage}_seconds"] = self.values.get(f"{stage}_seconds", 0.0) + time.perf_counter() - start
+            if profiler is not None:
+                self._stop_profiler(profiler, stage)
+
+    def count(self, counter: str, value):
+        self.values[counter] = value
+
+    def as_dict(self) -> dict:
+        return dict(self.values)
+
+    def _start_profiler(self, stage: str):
+        if self.instrumentation is None or stage not in self.instrumentation.profile_stages:
+            return None
+        if self.instrumentation.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, profiler, stage: str):
+        os.makedirs(self.instrumentation.profile_dir, exist_ok=True)
+        path = os.path.join(self.instrumentation.profile_dir, f"{self.name}_{stage}")
+        if self.instrumentation.profiler == "pyinstrument":
+            profiler.stop()
+            with open(path + ".html", "w") as f:
+                f.write(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+
+
+def count_trades(result_df: pd.DataFrame) -> int:
+    """
+    Number of closed trades (non zero returns) of a trading period.
+    """
+    return int(np.count_nonzero(np.nan_to_num(result_df.to_numpy(dtype=np.float64))))
+
+
+def metrics_frame(period_names: list, period_metrics: list) -> pd.DataFrame:
+    """
+    Per period metrics DataFrame, one row per period and one column per stage time / counter.
+    """
+    metrics_df = pd.DataFrame(period_metrics, index=pd.Index(period_names, name="portfolio"))
+    # stage timings first, in the order of the backtest steps
+    seconds = [column for column in metrics_df.columns if column.endswith("_seconds")]
+    return metrics_df[seconds + [column for column in metrics_df.columns if column not in seconds]]
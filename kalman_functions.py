@@ -1,32 +1,126 @@
 import numpy as np
 import pandas as pd
-from pykalman import KalmanFilter
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
 from cointegration_functions import *
+from cointegration_functions import _transaction_cost_levels, _form_portfolio, _run_periods, _export_metrics
+from kernels import (em_scalar, kalman_variance_sequence, kalman_filter, trade_kalman_bands as _trade_kalman_bands,
+                     replay_signals)
 
+_estimation_log = get_logger("estimation")
+_trading_log = get_logger("trading")
+_backtest_log = get_logger("backtest")
 
 
-def estimate_model(stocks_formation, portfolio):
+
+class KalmanParameterStore:
+    """
+    Last estimated (A, B, C, D) of every pair, used to warm start the EM of the next formation window.
+
+    Consecutive formation windows overlap by 23 months and the same pair is often selected again, so the previous
+    estimates are already close to the new ones. A warm started pair runs EM until the log-likelihood changes by
+    less than tol * |log-likelihood| (at most max_iter iterations) instead of the fixed number of iterations of a
+    cold start.
+    The tolerance is relative because EM converges slowly on these spreads: after 20 iterations the log-likelihood
+    (around 2000 for a 24 month window) still changes by about 0.2 per iteration, so an absolute tolerance of 1e-2
+    hardly ever stopped. On the synthetic benchmark prices (100 tickers, 28 periods of 20 pairs) tol=1e-3 cuts the
+    EM iterations from 400 to about 110 per period, the first iteration from the stored parameters already has a
+    higher log-likelihood than 20 cold iterations.
+
+    Parameters:
+    tol: relative log-likelihood tolerance of a warm started EM
+    max_iter: maximum number of EM iterations of a warm started pair
+    """
+    TOL = 1e-3
+
+    def __init__(self, tol: float = TOL, max_iter: int = 20):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.params = {}
+
+    def __repr__(self):
+        # the settings of a warm started backtest, see CheckpointStore.settings
+        return f"KalmanParameterStore(tol={self.tol}, max_iter={self.max_iter})"
+
+    def __contains__(self, pair):
+        return pair in self.params
+
+    def __len__(self):
+        return len(self.params)
+
+    def initial_params(self, pairs):
+        """
+        Returns (A, B, C, D) arrays of the stored pairs in the given order.
+        """
+        return tuple(np.array([self.params[pair][i] for pair in pairs], dtype=np.float64) for i in range(4))
+
+    def update(self, portfolio_models: pd.DataFrame):
+        """
+        Stores the estimated parameters of every pair of a portfolio, replacing older estimates.
+        """
+        for pair, row in portfolio_models[["A", "B", "C", "D"]].astype(np.float64).iterrows():
+            self.params[pair] = tuple(row.to_numpy())
+
+
+def estimate_model(stocks_formation, portfolio, method: str = "native", n_iter: int = 20, tol: float = None,
+                   param_store: KalmanParameterStore = None):
     """
     Parameters: should be portfolio and stocks formation, 
     Y observed is defined as spread = P2 - beta * P1
     Takes formation period spread (= observed y) and learns the parameters of the state-observation model (A,B,C,D) using EM algorithm.
     Estimates the model for each pair of the trading portfolio in the formation period.
-    """
-    portfolio_models = pd.DataFrame(columns=["A", "B", "C", "D"])
 
-    for pair in portfolio.index:
+    method: "native" estimates all pairs at once with em_scalar, "pykalman" fits a pykalman KalmanFilter per pair
+    n_iter: (maximum) number of EM iterations
+    tol: log-likelihood tolerance for an early stop of the native EM, None always runs n_iter iterations
+    param_store: KalmanParameterStore, pairs estimated in an earlier window start from their stored parameters
+                 (native method only), the store is updated with the new estimates
+
+    Returns:
+    A, B, C, D and beta of every pair, attrs["em_iterations"] is the total number of EM iterations over all pairs
+    """
+    # OLS of stock2 on stock1 (without constant) for all pairs at once, the formation prices of the pairs are complete
+    stock1s = [pair.split("_")[0] for pair in portfolio.index]
+    stock2s = [pair.split("_")[1] for pair in portfolio.index]
+    betas, spreads, _, _, _ = batch_ols(stocks_formation[stock1s].to_numpy(), stocks_formation[stock2s].to_numpy())
+
+    if method == "native":
+        # pairs already estimated in an earlier window start from their stored parameters and stop on the store's
+        # tolerance, the other pairs start from pykalman's defaults. Both run in the same vectorized EM.
+        n_pairs = len(portfolio.index)
+        initial_params = [np.zeros(n_pairs), np.ones(n_pairs), np.ones(n_pairs), np.ones(n_pairs)]
+        pair_n_iter = np.full(n_pairs, n_iter)
+        pair_tol = np.full(n_pairs, np.nan if tol is None else tol)
+        pair_rtol = np.full(n_pairs, np.nan)
+
+        warm = np.array([param_store is not None and pair in param_store for pair in portfolio.index], dtype=bool)
+        if warm.any():
+            for param, stored in zip(initial_params, param_store.initial_params(portfolio.index[warm])):
+                param[warm] = stored
+            pair_n_iter[warm] = param_store.max_iter
+            pair_tol[warm] = np.nan
+            pair_rtol[warm] = param_store.tol
+
+        A_est, B_est, C_est, D_est, n_iterations, _ = em_scalar(spreads, n_iter=pair_n_iter, tol=pair_tol,
+                                                                initial_params=initial_params, rtol=pair_rtol)
+
+        portfolio_models = pd.DataFrame({"A": A_est, "B": B_est, "C": C_est, "D": D_est, "beta": betas},
+                                        index=portfolio.index)
+        portfolio_models.attrs["em_iterations"] = int(n_iterations.sum())
+        if param_store is not None:
+            param_store.update(portfolio_models)
+        _estimation_log.info("estimated %d pairs, %d warm started, mean EM iterations %.1f",
+                             n_pairs, warm.sum(), n_iterations.mean() if n_pairs else 0.0)
+        _estimation_log.debug("params of the spreads:\n%s\nEM iterations: %s", portfolio_models, n_iterations)
+        return portfolio_models
+
+    from pykalman import KalmanFilter
+    portfolio_models = pd.DataFrame(columns=["A", "B", "C", "D", "beta"])
+
+    for j, pair in enumerate(portfolio.index):
         
         stock1, stock2 = pair.split("_")
-        print("processing pair ", stock1, "and", stock2)
+        _estimation_log.debug("processing pair %s and %s", stock1, stock2)
 
-        data = pd.concat([stocks_formation[stock1], stocks_formation[stock2]], axis=1).dropna()  # Drop NaN values
-        x = data[stock1]  # No sm.add_constant()
-        y = data[stock2]
-        
-        model = sm.OLS(y,x).fit()
-        y_obs = pd.Series(model.resid) #spread = P2 - beta * P1. 
+        y_obs = pd.Series(spreads[:, j], index=stocks_formation.index) #spread = P2 - beta * P1. 
         
         # Define the Kalman Filter
         kf = KalmanFilter(
@@ -36,10 +130,8 @@ def estimate_model(stocks_formation, portfolio):
                     'transition_covariance', 'observation_covariance']
         )
 
-        print("estimating model....")
-
         # Estimate Parameters Using EM
-        kf = kf.em(y_obs, n_iter=20)
+        kf = kf.em(y_obs, n_iter=n_iter)
 
         # Extract Learned Parameters
         A_est = kf.transition_offsets       # Estimated A
@@ -52,231 +144,198 @@ def estimate_model(stocks_formation, portfolio):
         portfolio_models.loc[pair, "B"] = B_est.item()
         portfolio_models.loc[pair, "C"] = C_est.item()
         portfolio_models.loc[pair, "D"] = D_est.item()
-        portfolio_models.loc[pair, "beta"] = model.params.iloc[0]
-        print("params of the spread for :", pair, "are ", A_est.item(), B_est.item(), C_est.item(), D_est.item(), model.params.iloc[0])
+        portfolio_models.loc[pair, "beta"] = betas[j]
+        _estimation_log.debug("params of the spread for %s are %s %s %s %s %s", pair, A_est.item(), B_est.item(),
+                              C_est.item(), D_est.item(), betas[j])
       
         
+    portfolio_models.attrs["em_iterations"] = n_iter * len(portfolio.index)
     return portfolio_models
 
 
-def trade_portfolio_kalman(portfolio_models: pd.DataFrame, stocks_trading: pd.DataFrame, useTransactionCosts: bool = False, transaction_cost: float = 0.006, threshold_factor: float = 1.0):
-    """ 
-    This performs the recursive kalman filter based on the parameterss A,B,C,D state-observation model estimated before.
-    Takes the trading period stocks and performs the trading algorithm 
+def kalman_paths(portfolio_models: pd.DataFrame, stocks_trading: pd.DataFrame):
     """
-    result_df = pd.DataFrame(index = stocks_trading.index)
-    x_est_df = pd.DataFrame(index = stocks_trading.index)
-    R_est_df = pd.DataFrame(index = stocks_trading.index)
-    y_obs_df = pd.DataFrame(index = stocks_trading.index)
-    trade_counts_df = pd.DataFrame(index = stocks_trading.index)
-
-    n_diverged = 0
-    
-    
-    # Process each pair
-    for pair in portfolio_models.index:
-        entered_trade = False
-        stock1, stock2 = pair.split("_")
+    Observed spread, filtered spread and its variance of all pairs in the trading period. They do not depend on the
+    threshold factor, so several thresholds can be traded on the same paths.
 
-        print("proccesing pair: \n",  pair, "\n", 100*"-")
-        A,B,C,D,beta = portfolio_models.loc[pair]
-       
-        # Spread for a given pair , spread = P2 - beta * P1
-        y_obs = stocks_trading[stock2] - beta * stocks_trading[stock1]
-       
-        # x0 = y0 
-        x_est = [y_obs.iloc[0]]  
-        R_est = [D**2]
-        K_hist  = [(B**2) * R_est[-1] + C**2  / ((B**2) * R_est[-1] + C**2 + D**2)]
-
-        print("Params A,B,C,D are", A,B,C,D)
-        
-        pair_result = {}
-        spread_t = 0
-        pair_result[y_obs.index[0]] = 0.0
-        
-        print("Current observed spread is: ",  y_obs.iloc[0], "and Current filtered spread is", x_est[0])
-        
-        # Direction variable 1 long -1 short 
-        direction = 0
-        n_trades = 0 
-        # proces spread each day for this pair 
-        for i in range(1, len(y_obs.index)):
-            
-            date = stocks_trading.index[i]
-
-            # y observed
-            observed_y = y_obs.iloc[i] 
-
-            # Kalman Filter recursion
-            x = A + B * x_est[-1]
-            R = (B**2) * R_est[-1] + C**2
-            K = R / (R + D**2)
-            x_hat = x + K * (observed_y - x)
-            R_hat = R - K*R  #(D**2) * K
-            
-            x_est.append(x_hat)
-            R_est.append(R_hat)
-            K_hist.append(K)
-
-            print(40*"-", "\nprocessing date", date)
-            print("Current observed spread is: ",  y_obs.iloc[i], "and Current filtered spread is", x_est[i])
-            # trade logic here, we compare prediction and signal 
-            threshold = np.sqrt(R_hat) * threshold_factor # threshold to enter the trade
-            
-            # Entering trade
-            if observed_y > x_hat + threshold and not entered_trade:
-                #observed spread is too large, enter trade 
-                print("Observed spread ", observed_y ," is too big, short trade entered...")
-                spread_t = observed_y
-                direction = -1
-                n_trades += 1
-                entered_trade = True
-            
-            elif observed_y < x_hat - threshold and not entered_trade:
-                # observed spread is too small, enter trade 
-                print("Observed spread is too small, long trade entered...")
-                spread_t = observed_y
-                direction = +1
-                n_trades += 1
-                entered_trade = True
-
-            # Closing Trade
-            # current spread drops below the estimate -+ threshold, exit and save delta_spread = spread_t+n - spread_t
-            if direction == -1 and observed_y < x_hat - threshold  and entered_trade:
-                entered_trade = False  
-                spread_diff = observed_y - spread_t
-                delta_spread = direction * spread_diff
-                print("Short trade was exited...return is :", delta_spread)    
-                
-            elif direction == +1 and observed_y > x_hat + threshold and entered_trade:
-                entered_trade = False 
-                spread_diff = observed_y - spread_t
-                delta_spread = direction * spread_diff
-                print("Long trade was exited...return is :", delta_spread)    
-            else: 
-                # if trade is not entered or spread of the entered trade did not return to 0
-                delta_spread = 0.0 
-
-            #last day of trading
-            if i == len(y_obs.index) - 1:
-                date = stocks_trading.index[i]
-                print("\n LAST DAY OF THE TRADING....", date)
-                print("Last observed spread is:", observed_y, "and last filtered spread is:", x_est[i])
-
-                if entered_trade:
-                    spread_diff = observed_y - spread_t
-                    print("Brute force close - observed vs. entry:", observed_y, spread_t)
-
-                    # Determine profit/loss based on trade direction
-                    delta_spread = direction * spread_diff
-                    print("Final delta_spread:", delta_spread)
-
-                    if delta_spread < 0:
-                        n_diverged += 1
-
-            # Save the delta spread, account for transaction costs
-            if useTransactionCosts and delta_spread != 0:
-                pair_result[date] =  delta_spread - transaction_cost 
-            else: 
-                pair_result[date] = delta_spread
-
-        # append to result df 
-        result_df[pair] = pair_result
-        trade_counts_df[pair] = [1 if r != 0.0 else 0 for r in pair_result.values()]
-        x_est_df[pair] = x_est
-        R_est_df[pair] = R_est
-        y_obs_df[pair] = y_obs
-        print("\n number of completed round trip trades: ", sum(trade_counts_df[pair]), "\n",100*"-")    
-
-    return x_est_df, y_obs_df, R_est_df, result_df, trade_counts_df
+    Returns:
+    y_obs, x_est and R_est, (T, P) arrays
+    """
+    stock1s = [pair.split("_")[0] for pair in portfolio_models.index]
+    stock2s = [pair.split("_")[1] for pair in portfolio_models.index]
+    A, B, C, D, beta = portfolio_models[["A", "B", "C", "D", "beta"]].to_numpy(dtype=np.float64).T
 
-def run_strategy_kalman(stocks: pd.DataFrame, useTransactionCosts: bool = False):
-    
-    os.makedirs("logs", exist_ok=True)
+    # Spread for all pairs, spread = P2 - beta * P1
+    y_obs = stocks_trading[stock2s].to_numpy(dtype=np.float64) - beta * stocks_trading[stock1s].to_numpy(dtype=np.float64)
 
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    log_filename = f"logs/backtest_kalman_{timestamp}.log"
-    sys.stdout = open(log_filename, "w")
-    
-    stocks.index = pd.to_datetime(stocks.index)
-    time_frame = stocks.index
+    R_est, K = kalman_variance_sequence(B, C, D, len(y_obs))
+    x_est = kalman_filter(y_obs, A, B, K)
+    return y_obs, x_est, R_est
 
-    months = pd.Series(time_frame).dt.to_period('M').unique()  # Extract unique months
+def trade_portfolio_kalman(portfolio_models: pd.DataFrame, stocks_trading: pd.DataFrame, useTransactionCosts: bool = False, transaction_cost: float = 0.006, threshold_factor: float = 1.0):
+    """ 
+    This performs the recursive kalman filter based on the parameterss A,B,C,D state-observation model estimated before.
+    Takes the trading period stocks and performs the trading algorithm 
 
-    # This is the main dataframe, that stores the daily returns of each portfolio 
-    returns_dictionary = {}
-    trade_counts_dictionary = {} 
+    All pairs are filtered together: the variance / gain sequence is computed once (it does not depend on the
+    observations) and the filter and the trading rule step through the days with one vector per day.
+    """
+    pairs = portfolio_models.index
+    y_obs, x_est, R_est = kalman_paths(portfolio_models, stocks_trading)
+    result, n_diverged = _trade_kalman_bands(y_obs, x_est, R_est, threshold_factor)
+
+    x_est_df = pd.DataFrame(x_est, index=stocks_trading.index, columns=pairs)
+    R_est_df = pd.DataFrame(R_est, index=stocks_trading.index, columns=pairs)
+    y_obs_df = pd.DataFrame(y_obs, index=stocks_trading.index, columns=pairs)
+    result_df = pd.DataFrame(result, index=stocks_trading.index, columns=pairs)
+
+    if _trading_log.isEnabledFor(logging.DEBUG):
+        for pair, n_trades in zip(pairs, np.sum(result != 0.0, axis=0)):
+            _trading_log.debug("pair %s number of completed round trip trades: %d", pair, n_trades)
+    _trading_log.info("trading from %s to %s finished, diverged pairs: %d", stocks_trading.index[0],
+                      stocks_trading.index[-1], n_diverged)
+
+    result_df, trade_counts_df = apply_transaction_costs(result_df, transaction_cost if useTransactionCosts else 0.0)
+    return x_est_df, y_obs_df, R_est_df, result_df, trade_counts_df
 
-    n_trading_periods = 0 
+def _kalman_period(stocks: pd.DataFrame, period: tuple, rolling_ssd: RollingSSD = None,
+                   formation_cache: FormationCache = None, screening_workers: int = 1,
+                   screening_method: str = "statsmodels", param_store: KalmanParameterStore = None,
+                   prefilter: PairPrefilter = None, cascade: ScreeningCascade = None,
+                   instrumentation: Instrumentation = None, n_pairs: int = 20,
+                   threshold_factor: float = 1.0) -> pd.DataFrame:
+    """
+    One formation / trading period of the Kalman filter strategy.
 
-    # Iterate through months instead of days
-    for start_idx in tqdm(range(len(months)), desc= "Running Kalman backtest"):
+    Returns:
+    daily returns of the 20 pairs in the trading period without transaction costs,
+    attrs["metrics"] holds the stage timings and counters of the period
+    """
+    formation_start, formation_end, trading_start, trading_end = period
+    metrics = PeriodMetrics(CheckpointStore.key(period), instrumentation)
 
-        formation_start = pd.Timestamp(months[start_idx].start_time)
-        formation_end = formation_start + pd.DateOffset(months=24)-pd.DateOffset(days=1)  # 24 months later
-        trading_start = formation_start + pd.DateOffset(months=24)
-        trading_end = formation_end + pd.DateOffset(months=6)  # Next 6 months
-        
-        # Ensure we don't exceed the timeframe
-        if trading_end > time_frame[-1]:
-            break
-        
-        # The backtest algorithm starts here:
-        # 1. normalize the stock data at the start of the formation period to 1$  
+    # The backtest algorithm starts here:
+    # 1. normalize the stock data at the start of the formation period to 1$  
+    with metrics.stage("normalize"):
         stocks_normalized = normalize(stocks.loc[formation_start:trading_end])
 
-        # Select formation period data   
-        stocks_formation = stocks_normalized.loc[formation_start:formation_end]
-        # Select testing data (next 6 months)
-        stocks_trading = stocks_normalized.loc[trading_start:trading_end]
-        
-        # Formation part 
-        # 2. sort by ssd ~ 1 minute
-        print("\nSorting all combinations by SSD...\n")
-        print("=" * 80)
-        pairs_sorted = calculate_and_sort_ssd(stocks_formation)
-
-        print(f"Formation Start:\n{stocks_formation.index[0]}")
-        print("X" * 80)
-
-        # 3. Select 20 cointegrated pairs 
-        print("\nSelecting cointegrated pairs using Engle-Kranger method...\n")
-        print("=" * 80)
-        portfolio = select_cointegrated_pairs(stocks_formation, pairs_sorted)
-
-        # 4. Estimate the state - observation model parameters
-        print("\nEstimating the state - observation model parameters...\n")
-        print("=" * 80)
-        portfolio_models = estimate_model(stocks_formation=stocks_formation,portfolio=portfolio)
-        
-        print(f"Formation End:\n{stocks_formation.index[-1]}")
-        print("-" * 80)
-        print(f"Trading Start:\n{stocks_trading.index[0]}")
+    # Select formation period data   
+    stocks_formation = stocks_normalized.loc[formation_start:formation_end]
+    # Select testing data (next 6 months)
+    stocks_trading = stocks_normalized.loc[trading_start:trading_end]
+    _backtest_log.info("formation %s - %s, trading %s - %s", stocks_formation.index[0].date(),
+                       stocks_formation.index[-1].date(), stocks_trading.index[0].date(),
+                       stocks_trading.index[-1].date())
+
+    # Formation part (SSD sorting and selection of 20 cointegrated pairs)
+    portfolio = _form_portfolio(stocks, stocks_formation, period, rolling_ssd=rolling_ssd,
+                                formation_cache=formation_cache, screening_workers=screening_workers,
+                                screening_method=screening_method, prefilter=prefilter, cascade=cascade,
+                                n_pairs=n_pairs, metrics=metrics)
+
+    # 4. Estimate the state - observation model parameters
+    with metrics.stage("estimation"):
+        portfolio_models = estimate_model(stocks_formation=stocks_formation,portfolio=portfolio,
+                                          param_store=param_store)
+    metrics.count("em_iterations", portfolio_models.attrs.get("em_iterations"))
+
+    # Trading part
+    # 5. Trade portfolio
+    with metrics.stage("trading"):
+        _, _, _, gross_result_df, _ = trade_portfolio_kalman(portfolio_models, stocks_trading=stocks_trading,
+                                                              useTransactionCosts=False,
+                                                              threshold_factor=threshold_factor)
+    metrics.count("trades", count_trades(gross_result_df))
+    gross_result_df.attrs["metrics"] = metrics.as_dict()
+    return gross_result_df
+
+
+def run_strategy_kalman(stocks: pd.DataFrame, useTransactionCosts: bool = False, incremental_ssd: bool = False,
+                        screening_workers: int = 1, screening_method: str = "statsmodels",
+                        formation_cache: FormationCache = None, transaction_costs: list = None,
+                        warm_start: bool = False, warm_start_tol: float = KalmanParameterStore.TOL,
+                        log_levels: dict = None, trade_events: bool = False, period_workers: int = 1,
+                        checkpoints: CheckpointStore = None, prefilter: PairPrefilter = None,
+                        cascade: ScreeningCascade = None, instrumentation: Instrumentation = None,
+                        returns_dtype: str = "float64",
+                        trade_counts_dtype: str = "float64", sparse_results: bool = False, n_pairs: int = 20,
+                        threshold_factor: float = 1.0, formation_months: int = 24, trading_months: int = 6):
+    """
+    Runs the Kalman filter backtest over all overlapping 24 month formation / 6 month trading periods.
 
-        # Trading part
-        # 5. Trade portfolio
-        print("\nPortfolio is trading...\n")
-        print("=" * 80)
-        _, _, _, result_df, trade_counts_df = trade_portfolio_kalman(portfolio_models, stocks_trading=stocks_trading,
-                                                                      useTransactionCosts= useTransactionCosts,
-                                                                        threshold_factor=1.0)
+    Parameters:
+    stocks: stock prices with a date index
+    useTransactionCosts: indicator whether transaction costs (0.006 per round trip) should be applied
+    incremental_ssd: rank the pairs with RollingSSD instead of recomputing the SSD of every window
+    screening_workers: number of processes used by select_cointegrated_pairs
+    screening_method: "statsmodels" or "numpy", see select_cointegrated_pairs
+    formation_cache: FormationCache to load / store the formation results of every window
+    transaction_costs: list of cost levels, e.g. [0, 0.002, 0.006, 0.01], evaluated in one simulation pass
+                       (overrides useTransactionCosts)
+    warm_start: start the EM of a pair from its parameters of the previous window it was selected in
+    warm_start_tol: relative log-likelihood tolerance of the warm started EM, see KalmanParameterStore
+    log_levels: {stage: level} of the stage loggers, e.g. {"estimation": logging.DEBUG}, see backtest_logging
+    trade_events: also write a JSON-lines log with one event per closed trade
+    period_workers: number of processes the monthly periods are spread over, see _run_periods
+                    (not with warm_start, the warm start chains the periods)
+    checkpoints: CheckpointStore, every finished period is stored right away and stored periods are not run again,
+                 so an interrupted backtest resumes where it stopped (with warm_start the resumed periods start
+                 from an empty parameter store)
+    prefilter: PairPrefilter, rank only its candidate pairs by SSD instead of all pairs of the universe
+    cascade: ScreeningCascade, cheap pre-tests before the ADF test of select_cointegrated_pairs
+    instrumentation: Instrumentation, keeps the per period metrics (stage times, pairs tested, EM iterations, trades)
+                     in instrumentation.metrics, writes them to its metrics_csv and profiles the configured stages
+    returns_dtype, trade_counts_dtype, sparse_results: storage of the result frames, see BacktestResults
+    n_pairs: number of pairs of every portfolio
+    threshold_factor: width of the trading bands in filtered standard deviations
+    formation_months, trading_months: length of the formation and trading periods, see trading_periods
+    (parameter_sweep.py evaluates grids of these parameters with shared work)
+
+    Returns:
+    returns and trade count dataframes with one Portfolio_<trading_start> column per trading period,
+    or two {cost: dataframe} dicts if transaction_costs is given
+    """
+    if warm_start and period_workers > 1:
+        raise ValueError("warm_start needs the periods in order, it can not be combined with period_workers > 1")
 
-        print(f"Trading End:\n{stocks_trading.index[-1]}\n")
-        print("X" * 80)
+    stocks.index = pd.to_datetime(stocks.index)
+    periods = trading_periods(stocks.index, formation_months, trading_months)
+
+    # last estimated model parameters of every pair, seeds the EM when a pair is selected again
+    param_store = KalmanParameterStore(tol=warm_start_tol) if warm_start else None
+
+    # This is the main result, that stores the daily returns of each portfolio (per transaction cost level)
+    costs = _transaction_cost_levels(useTransactionCosts, transaction_costs)
+    results = BacktestResults(stocks.index, periods, costs, returns_dtype=returns_dtype,
+                              trade_counts_dtype=trade_counts_dtype, sparse=sparse_results)
+    trade_logger = logging.getLogger(TRADE_EVENTS)
+
+    with backtest_logging("kalman", levels=log_levels, trade_events=trade_events,
+                          processes=period_workers > 1) as log_filename:
+        gross_results = _run_periods(_kalman_period, stocks, periods, n_workers=period_workers,
+                                     incremental_ssd=incremental_ssd, desc="Running Kalman backtest",
+                                     checkpoints=checkpoints, formation_cache=formation_cache,
+                                     screening_workers=screening_workers, screening_method=screening_method,
+                                     param_store=param_store, prefilter=prefilter, cascade=cascade,
+                                     instrumentation=instrumentation, n_pairs=n_pairs,
+                                     threshold_factor=threshold_factor)
 
         # 6. Calculate daily returns of each portfolio and append this column for each trading period
-        # calculated as a row sums of the daily returns of 20 pairs 
+        # calculated as a row sums of the daily returns of 20 pairs, once for every transaction cost level
         # Also sum up the number trades on that day over the 6 portfolios
-        returns_dictionary[f"Portfolio_{trading_start}"] = result_df.sum(axis=1)
-        trade_counts_dictionary[f"Portfolio_{trading_start}"] = trade_counts_df.sum(axis=1)
-        n_trading_periods += 1
-        print("Number of trading periods: ", n_trading_periods, "\n transaction costs apply:" , useTransactionCosts) 
+        period_metrics = []
+        for column, (period, gross_result_df) in enumerate(zip(periods, gross_results)):
+            metrics = PeriodMetrics(CheckpointStore.key(period), instrumentation, gross_result_df.attrs.get("metrics"))
+            with metrics.stage("costs"):
+                log_trade_events(trade_logger, gross_result_df, f"{period[2]:%Y-%m-%d}")
+                results.add(column, gross_result_df)
+            period_metrics.append(metrics.as_dict())
+
+        _backtest_log.info("number of trading periods: %d, transaction cost levels: %s", len(periods), costs)
+        _export_metrics(instrumentation, periods, period_metrics)
 
-    sys.stdout.close()
-    sys.stdout = sys.__stdout__
     print("Done ... logs saved into", log_filename)
-    return pd.DataFrame(returns_dictionary), pd.DataFrame(trade_counts_dictionary)
+    return results.frames(transaction_costs)
 
 
 def plot_spread_signals_kalman(pair, x_est, y_obs, R_est, tf):
@@ -291,62 +350,20 @@ def plot_spread_signals_kalman(pair, x_est, y_obs, R_est, tf):
         result (DataFrame): Residuals or strategy returns
         tf (float): Threshold factor (number of standard deviations for the band)
     """
+    import matplotlib.pyplot as plt
+
     # Compute bands
     upper_band = x_est[pair] + np.sqrt(R_est[pair].values) * tf
     lower_band = x_est[pair] - np.sqrt(R_est[pair].values) * tf
 
-    # Track trades
-    long_entry_dates, long_entry_prices = [], []
-    long_exit_dates, long_exit_prices = [], []
-    short_entry_dates, short_entry_prices = [], []
-    short_exit_dates, short_exit_prices = [], []
-
-    trade_active = False
-    trade_type = None  # 'long' or 'short'
-
-    for i in range(len(y_obs)):
-        y_val = y_obs[pair].iloc[i]
-        x_val = x_est[pair].iloc[i]
-        upper = upper_band.iloc[i]
-        lower = lower_band.iloc[i]
-        idx = y_obs.index[i]
-
-        if not trade_active:
-            if y_val > upper:
-                # Short entry
-                trade_active = True
-                trade_type = 'short'
-                short_entry_dates.append(idx)
-                short_entry_prices.append(y_val)
-            elif y_val < lower:
-                # Long entry
-                trade_active = True
-                trade_type = 'long'
-                long_entry_dates.append(idx)
-                long_entry_prices.append(y_val)
-        else:
-            if trade_type == 'short' and y_val < lower:
-                # Exit short
-                trade_active = False
-                trade_type = None
-                short_exit_dates.append(idx)
-                short_exit_prices.append(y_val)
-            elif trade_type == 'long' and y_val > upper:
-                # Exit long
-                trade_active = False
-                trade_type = None
-                long_exit_dates.append(idx)
-                long_exit_prices.append(y_val)
-        
-        # Last day 
-        if i == len(y_obs) - 1:
-            if trade_type == 'short':
-                short_exit_dates.append(idx)
-                short_exit_prices.append(y_val)
-            if trade_type == 'long':
-                long_exit_dates.append(idx)
-                long_exit_prices.append(y_val)
-            
+    # Replay the trades, exit when the spread crosses the opposite band
+    y = y_obs[pair]
+    entries, exits = replay_signals(y.to_numpy(), upper_band.to_numpy(), lower_band.to_numpy(),
+                                    lower_band.to_numpy(), upper_band.to_numpy())
+    long_entry_dates, long_entry_prices = y.index[entries == 1], y[entries == 1]
+    long_exit_dates, long_exit_prices = y.index[exits == 1], y[exits == 1]
+    short_entry_dates, short_entry_prices = y.index[entries == -1], y[entries == -1]
+    short_exit_dates, short_exit_prices = y.index[exits == -1], y[exits == -1]
 
     # Plotting
     plt.figure(figsize=(12, 6))
@@ -0,0 +1,679 @@
+import importlib.util
+
+import numpy as np
+
+# Inner loops of the backtest (trading state machines, scalar Kalman filter / smoother, pair SSD) with switchable
+# implementations:
+# numpy: one array operation over all pairs per day
+# python: the loop kernels below, one pair and one day at a time in plain Python (slow, reference / fallback)
+# numba: the same loop kernels compiled with numba.njit
+# All backends give bit for bit the same results, check_backends and tests/test_kernels.py compare them.
+BACKENDS = ("numpy", "python", "numba")
+
+_backend = "numba" if importlib.util.find_spec("numba") is not None else "numpy"
+_compiled = {}
+
+
+def numba_available() -> bool:
+    return importlib.util.find_spec("numba") is not None
+
+
+def get_backend() -> str:
+    return _backend
+
+
+def set_backend(backend: str):
+    """
+    Selects the kernel implementation for all following calls, "numpy", "python" or "numba" (needs numba).
+    The backend is a module setting, worker processes started with fork inherit it.
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown kernel backend {backend}, expected one of {BACKENDS}")
+    if backend == "numba" and not numba_available():
+        raise ImportError("kernel backend 'numba' needs the numba package")
+    _backend = backend
+
+
+def _loops(function):
+    """
+    Loop kernel of the current backend, compiled on first use with numba.
+    """
+    if _backend != "numba":
+        return function
+    if function not in _compiled:
+        import numba
+        # error_model="numpy": division by zero gives inf / NaN like the numpy backend instead of raising
+        _compiled[function] = numba.njit(cache=True, error_model="numpy")(function)
+    return _compiled[function]
+
+
+def _per_column(value, n_columns: int) -> np.ndarray:
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=np.float64), (n_columns,)))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# spread trading rule of trade_portfolio
+
+def _trade_spreads_numpy(spread: np.ndarray, spread_normalized: np.ndarray, entry_threshold, result: np.ndarray):
+    n_days, n_pairs = spread.shape
+    entered_trade = np.zeros(n_pairs, dtype=bool)
+    direction = np.zeros(n_pairs)  # 1 long -1 short
+    spread_t = np.zeros(n_pairs)
+
+    with np.errstate(invalid="ignore"):
+        for i in range(n_days):
+            spread_current = spread[i]
+            spread_norm_current = spread_normalized[i]
+
+            # when the signal comes, save the spread at time t and enter the trade
+            enter = (np.abs(spread_norm_current) > entry_threshold) & ~entered_trade
+            entered_trade = entered_trade | enter
+            spread_t = np.where(enter, spread_current, spread_t)
+            direction = np.where(enter, np.where(spread_norm_current > entry_threshold, -1.0, 1.0), direction)
+
+            # exit when the spread returns to 0, return = delta spread
+            exit_trade = entered_trade & (((direction == -1) & (spread_norm_current <= 0))
+                                          | ((direction == 1) & (spread_norm_current >= 0)))
+            result[i] = np.where(exit_trade, np.abs(spread_current - spread_t), 0.0)
+            entered_trade = entered_trade & ~exit_trade
+
+        # on the last day of trading, if the spread did not converge, exit the position in loss
+        delta_spread = direction * (spread[-1] - spread_t)
+        delta_spread = np.where(delta_spread >= 0, np.abs(delta_spread), -np.abs(delta_spread))
+        result[-1] = np.where(entered_trade, delta_spread, result[-1])
+        return int(np.sum(entered_trade & (delta_spread < 0)))
+
+
+def _trade_spreads_loops(spread, spread_normalized, entry_threshold, result):
+    n_days, n_pairs = spread.shape
+    n_diverged = 0
+    for p in range(n_pairs):
+        entered_trade = False
+        direction = 0.0
+        spread_t = 0.0
+        for i in range(n_days):
+            spread_current = spread[i, p]
+            spread_norm_current = spread_normalized[i, p]
+            if not entered_trade and abs(spread_norm_current) > entry_threshold[p]:
+                entered_trade = True
+                spread_t = spread_current
+                direction = -1.0 if spread_norm_current > entry_threshold[p] else 1.0
+            if entered_trade and ((direction == -1 and spread_norm_current <= 0)
+                                  or (direction == 1 and spread_norm_current >= 0)):
+                result[i, p] = abs(spread_current - spread_t)
+                entered_trade = False
+
+        if entered_trade:
+            delta_spread = direction * (spread[n_days - 1, p] - spread_t)
+            result[n_days - 1, p] = abs(delta_spread) if delta_spread >= 0 else -abs(delta_spread)
+            if delta_spread < 0:
+                n_diverged += 1
+    return n_diverged
+
+
+def trade_spreads(spread: np.ndarray, spread_normalized: np.ndarray, entry_threshold=2.0):
+    """
+    Trading rule of trade_portfolio for all pairs at once. The days are processed in order (the rule is a state
+    machine), the numpy backend updates the state of all pairs with array operations every day.
+
+    Enter when the normalized spread leaves +-entry_threshold (short above, long below), exit when it crosses 0 and
+    save |spread_t+n - spread_t|, on the last day an open trade is closed at the current spread (profit or loss).
+
+    Parameters:
+    spread: (T, P) trading period spread of the pairs
+    spread_normalized: (T, P) normalized spread of the pairs
+    entry_threshold: entry threshold in standard deviations, a scalar or one per column (P,) so several thresholds
+                     can be evaluated in one pass on repeated columns
+
+    Returns:
+    (T, P) array of the returns (delta spread) without transaction costs and the number of diverged pairs
+    """
+    n_days, n_pairs = spread.shape
+    result = np.zeros((n_days, n_pairs))
+    if n_days == 0:
+        return result, 0
+    if _backend == "numpy":
+        return result, _trade_spreads_numpy(spread, spread_normalized, entry_threshold, result)
+    n_diverged = _loops(_trade_spreads_loops)(np.ascontiguousarray(spread, dtype=np.float64),
+                                              np.ascontiguousarray(spread_normalized, dtype=np.float64),
+                                              _per_column(entry_threshold, n_pairs), result)
+    return result, int(n_diverged)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# band trading rule of trade_portfolio_kalman
+
+def _trade_kalman_bands_numpy(y_obs: np.ndarray, x_est: np.ndarray, R_est: np.ndarray, threshold_factor,
+                              result: np.ndarray):
+    n_days, n_pairs = y_obs.shape
+    threshold = np.sqrt(R_est) * threshold_factor # threshold to enter the trade
+    upper_band = x_est + threshold
+    lower_band = x_est - threshold
+
+    entered_trade = np.zeros(n_pairs, dtype=bool)
+    direction = np.zeros(n_pairs)  # 1 long -1 short
+    spread_t = np.zeros(n_pairs)
+
+    with np.errstate(invalid="ignore"):
+        for i in range(1, n_days):
+            observed_y = y_obs[i]
+
+            # Entering trade, observed spread is too large (short) or too small (long)
+            enter_short = (observed_y > upper_band[i]) & ~entered_trade
+            enter_long = (observed_y < lower_band[i]) & ~entered_trade & ~enter_short
+            enter = enter_short | enter_long
+            spread_t = np.where(enter, observed_y, spread_t)
+            direction = np.where(enter_short, -1.0, np.where(enter_long, 1.0, direction))
+            entered_trade = entered_trade | enter
+
+            # Closing trade when the spread crosses the opposite band, delta_spread = direction * (spread_t+n - spread_t)
+            exit_trade = entered_trade & (((direction == -1) & (observed_y < lower_band[i]))
+                                          | ((direction == 1) & (observed_y > upper_band[i])))
+            result[i] = np.where(exit_trade, direction * (observed_y - spread_t), 0.0)
+            entered_trade = entered_trade & ~exit_trade
+
+        # last day of trading, close the open trades
+        delta_spread = direction * (y_obs[-1] - spread_t)
+        result[-1] = np.where(entered_trade, delta_spread, result[-1])
+        return int(np.sum(entered_trade & (delta_spread < 0)))
+
+
+def _trade_kalman_bands_loops(y_obs, x_est, R_est, threshold_factor, result):
+    n_days, n_pairs = y_obs.shape
+    n_diverged = 0
+    for p in range(n_pairs):
+        entered_trade = False
+        direction = 0.0
+        spread_t = 0.0
+        for i in range(1, n_days):
+            observed_y = y_obs[i, p]
+            threshold = np.sqrt(R_est[i, p]) * threshold_factor[p]
+            upper_band = x_est[i, p] + threshold
+            lower_band = x_est[i, p] - threshold
+            if not entered_trade:
+                if observed_y > upper_band:
+                    entered_trade, direction, spread_t = True, -1.0, observed_y
+                elif observed_y < lower_band:
+                    entered_trade, direction, spread_t = True, 1.0, observed_y
+            if entered_trade and ((direction == -1 and observed_y < lower_band)
+                                  or (direction == 1 and observed_y > upper_band)):
+                result[i, p] = direction * (observed_y - spread_t)
+                entered_trade = False
+
+        if entered_trade:
+            delta_spread = direction * (y_obs[n_days - 1, p] - spread_t)
+            result[n_days - 1, p] = delta_spread
+            if delta_spread < 0:
+                n_diverged += 1
+    return n_diverged
+
+
+def trade_kalman_bands(y_obs: np.ndarray, x_est: np.ndarray, R_est: np.ndarray, threshold_factor=1.0):
+    """
+    Trading rule of trade_portfolio_kalman for all pairs at once.
+
+    Enter short when the observed spread is above x_est + threshold and long when it is below x_est - threshold,
+    exit when it crosses the opposite band, on the last day an open trade is closed at the observed spread.
+    threshold_factor is a scalar or one factor per column (P,).
+
+    Returns:
+    (T, P) array of the returns (delta spread) without transaction costs and the number of diverged pairs
+    """
+    n_days, n_pairs = y_obs.shape
+    result = np.zeros((n_days, n_pairs))
+    if n_days < 2:
+        return result, 0
+    if _backend == "numpy":
+        return result, _trade_kalman_bands_numpy(y_obs, x_est, R_est, threshold_factor, result)
+    n_diverged = _loops(_trade_kalman_bands_loops)(np.ascontiguousarray(y_obs, dtype=np.float64),
+                                                   np.ascontiguousarray(x_est, dtype=np.float64),
+                                                   np.ascontiguousarray(R_est, dtype=np.float64),
+                                                   _per_column(threshold_factor, n_pairs), result)
+    return result, int(n_diverged)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# scalar Kalman filter of the trading period
+
+def _kalman_variance_sequence_loops(B, C, D, R_est, K):
+    n_days, n_pairs = R_est.shape
+    for p in range(n_pairs):
+        R_est[0, p] = D[p] * D[p]
+        for i in range(1, n_days):
+            R = (B[p] * B[p]) * R_est[i - 1, p] + C[p] * C[p]
+            K[i, p] = R / (R + D[p] * D[p])
+            R_est[i, p] = R - K[i, p] * R
+
+
+def kalman_variance_sequence(B: np.ndarray, C: np.ndarray, D: np.ndarray, n_days: int):
+    """
+    Filtered state variance R_hat and Kalman gain K of the scalar model for n_days. They do not depend on the
+    observations, so they are computed once for all pairs before the filter runs.
+
+    Parameters:
+    B, C, D: (P,) model parameters of the pairs
+
+    Returns:
+    R_est (n_days, P) with R_est[0] = D^2 and K (n_days, P) with K[0] = 0 (day 0 is not filtered)
+    """
+    R_est = np.empty((n_days, len(B)))
+    K = np.zeros((n_days, len(B)))
+    if _backend != "numpy":
+        if n_days:
+            _loops(_kalman_variance_sequence_loops)(_per_column(B, len(B)), _per_column(C, len(B)),
+                                                    _per_column(D, len(B)), R_est, K)
+        return R_est, K
+    R_est[0] = D**2
+    for i in range(1, n_days):
+        R = (B**2) * R_est[i - 1] + C**2
+        K[i] = R / (R + D**2)
+        R_est[i] = R - K[i]*R  #(D**2) * K
+    return R_est, K
+
+
+def _kalman_filter_loops(y_obs, A, B, K, x_est):
+    n_days, n_pairs = y_obs.shape
+    for p in range(n_pairs):
+        x_est[0, p] = y_obs[0, p]
+        for i in range(1, n_days):
+            x = A[p] + B[p] * x_est[i - 1, p]
+            x_est[i, p] = x + K[i, p] * (y_obs[i, p] - x)
+
+
+def kalman_filter(y_obs: np.ndarray, A: np.ndarray, B: np.ndarray, K: np.ndarray) -> np.ndarray:
+    """
+    Filtered spread x_est of all pairs, one vector step per day (x0 = y0).
+
+    Parameters:
+    y_obs: (T, P) observed spreads
+    A, B: (P,) model parameters of the pairs
+    K: (T, P) Kalman gains from kalman_variance_sequence
+    """
+    x_est = np.empty_like(y_obs)
+    if len(y_obs) == 0:
+        return x_est
+    if _backend != "numpy":
+        n_pairs = y_obs.shape[1]
+        x_est = np.empty(y_obs.shape)
+        _loops(_kalman_filter_loops)(np.ascontiguousarray(y_obs, dtype=np.float64), _per_column(A, n_pairs),
+                                     _per_column(B, n_pairs), np.ascontiguousarray(K, dtype=np.float64), x_est)
+        return x_est
+    x_est[0] = y_obs[0]
+    for i in range(1, len(y_obs)):
+        x = A + B * x_est[i - 1]
+        x_est[i] = x + K[i] * (y_obs[i] - x)
+    return x_est
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# EM estimation of the scalar state-observation model (Kalman filter + RTS smoother + M-step)
+
+def _em_scalar_numpy(y_obs, A, B, Q, R, n_iter, tol, rtol):
+    n_days, n_pairs = y_obs.shape
+    # the initial state mean (0) and covariance (1) are not estimated, as in pykalman
+    x_pred, P_pred = np.empty((n_days, n_pairs)), np.empty((n_days, n_pairs))
+    x_filt, P_filt = np.empty((n_days, n_pairs)), np.empty((n_days, n_pairs))
+    x_smooth, P_smooth = np.empty((n_days, n_pairs)), np.empty((n_days, n_pairs))
+    J = np.zeros((n_days, n_pairs))
+
+    loglikelihood = np.full(n_pairs, -np.inf)
+    n_iterations = np.zeros(n_pairs, dtype=np.int64)
+    active = np.ones(n_pairs, dtype=bool)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(n_iter.max(initial=0)):
+            active &= n_iterations < n_iter
+            if not active.any():
+                break
+
+            # E-step: Kalman filter
+            x_pred[0], P_pred[0] = 0.0, 1.0
+            for t in range(n_days):
+                if t > 0:
+                    x_pred[t] = B * x_filt[t - 1] + A
+                    P_pred[t] = B * P_filt[t - 1] * B + Q
+                S = P_pred[t] + R
+                K = np.where(S != 0, P_pred[t] / S, 0.0)
+                x_filt[t] = x_pred[t] + K * (y_obs[t] - x_pred[t])
+                P_filt[t] = P_pred[t] - K * P_pred[t]
+
+            # log-likelihood of the current parameters, used for the early stop
+            S = P_pred + R
+            new_loglikelihood = -0.5 * np.sum(np.log(2 * np.pi * S) + (y_obs - x_pred)**2 / S, axis=0)
+            change = np.abs(new_loglikelihood - loglikelihood)
+            active &= ~((change < tol) | (change < rtol * np.abs(new_loglikelihood)))
+            if not active.any():
+                break
+            loglikelihood = np.where(active, new_loglikelihood, loglikelihood)
+
+            # E-step: RTS smoother and lag-one covariances V_t = Cov(x_t, x_t-1)
+            x_smooth[-1], P_smooth[-1] = x_filt[-1], P_filt[-1]
+            for t in reversed(range(n_days - 1)):
+                J[t] = np.where(P_pred[t + 1] != 0, P_filt[t] * B / P_pred[t + 1], 0.0)
+                x_smooth[t] = x_filt[t] + J[t] * (x_smooth[t + 1] - x_pred[t + 1])
+                P_smooth[t] = P_filt[t] + J[t] * (P_smooth[t + 1] - P_pred[t + 1]) * J[t]
+            V = P_smooth[1:] * J[:-1]
+
+            # M-step in pykalman's order: D, B (with the old A), C (with the new B and old A), A (with the new B)
+            R_new = np.mean((y_obs - x_smooth)**2 + P_smooth, axis=0)
+            sxx = np.sum(P_smooth[:-1] + x_smooth[:-1]**2, axis=0)
+            B_new = np.sum(V + x_smooth[1:] * x_smooth[:-1] - A * x_smooth[:-1], axis=0)
+            B_new = np.where(sxx != 0, B_new / sxx, 0.0)
+            err = x_smooth[1:] - B_new * x_smooth[:-1] - A
+            Q_new = np.mean(err**2 + B_new * P_smooth[:-1] * B_new + P_smooth[1:] - 2 * V * B_new, axis=0)
+            A_new = np.mean(x_smooth[1:] - B_new * x_smooth[:-1], axis=0)
+
+            A, B = np.where(active, A_new, A), np.where(active, B_new, B)
+            Q, R = np.where(active, Q_new, Q), np.where(active, R_new, R)
+            n_iterations += active
+
+    return A, B, Q, R, n_iterations, loglikelihood
+
+
+def _em_scalar_loops(y_obs, A, B, Q, R, n_iter, tol, rtol, n_iterations, loglikelihood):
+    n_days, n_pairs = y_obs.shape
+    x_pred, P_pred = np.empty(n_days), np.empty(n_days)
+    x_filt, P_filt = np.empty(n_days), np.empty(n_days)
+    x_smooth, P_smooth = np.empty(n_days), np.empty(n_days)
+    J = np.zeros(n_days)
+
+    for p in range(n_pairs):
+        a, b, q, r = A[p], B[p], Q[p], R[p]
+        pair_loglikelihood = -np.inf
+        iterations = 0
+        while iterations < n_iter[p]:
+            # E-step: Kalman filter
+            for t in range(n_days):
+                if t == 0:
+                    x_pred[t], P_pred[t] = 0.0, 1.0
+                else:
+                    x_pred[t] = b * x_filt[t - 1] + a
+                    P_pred[t] = b * P_filt[t - 1] * b + q
+                S = P_pred[t] + r
+                K = P_pred[t] / S if S != 0 else 0.0
+                x_filt[t] = x_pred[t] + K * (y_obs[t, p] - x_pred[t])
+                P_filt[t] = P_pred[t] - K * P_pred[t]
+
+            # log-likelihood of the current parameters, used for the early stop
+            total = 0.0
+            for t in range(n_days):
+                S = P_pred[t] + r
+                error = y_obs[t, p] - x_pred[t]
+                total += np.log(2 * np.pi * S) + error * error / S
+            new_loglikelihood = -0.5 * total
+            change = abs(new_loglikelihood - pair_loglikelihood)
+            if change < tol[p] or change < rtol[p] * abs(new_loglikelihood):
+                break
+            pair_loglikelihood = new_loglikelihood
+
+            # E-step: RTS smoother, V_t = P_smooth[t] * J[t - 1]
+            x_smooth[n_days - 1], P_smooth[n_days - 1] = x_filt[n_days - 1], P_filt[n_days - 1]
+            for t in range(n_days - 2, -1, -1):
+                J[t] = P_filt[t] * b / P_pred[t + 1] if P_pred[t + 1] != 0 else 0.0
+                x_smooth[t] = x_filt[t] + J[t] * (x_smooth[t + 1] - x_pred[t + 1])
+                P_smooth[t] = P_filt[t] + J[t] * (P_smooth[t + 1] - P_pred[t + 1]) * J[t]
+
+            # M-step, same order of operations as _em_scalar_numpy
+            r_sum = 0.0
+            for t in range(n_days):
+                error = y_obs[t, p] - x_smooth[t]
+                r_sum += error * error + P_smooth[t]
+            sxx, b_sum = 0.0, 0.0
+            for t in range(n_days - 1):
+                sxx += P_smooth[t] + x_smooth[t] * x_smooth[t]
+                b_sum += P_smooth[t + 1] * J[t] + x_smooth[t + 1] * x_smooth[t] - a * x_smooth[t]
+            b_new = b_sum / sxx if sxx != 0 else 0.0
+            q_sum, a_sum = 0.0, 0.0
+            for t in range(n_days - 1):
+                V = P_smooth[t + 1] * J[t]
+                error = x_smooth[t + 1] - b_new * x_smooth[t] - a
+                q_sum += error * error + b_new * P_smooth[t] * b_new + P_smooth[t + 1] - 2 * V * b_new
+                a_sum += x_smooth[t + 1] - b_new * x_smooth[t]
+
+            r = r_sum / n_days
+            q = q_sum / (n_days - 1)
+            a = a_sum / (n_days - 1)
+            b = b_new
+            iterations += 1
+
+        A[p], B[p], Q[p], R[p] = a, b, q, r
+        n_iterations[p] = iterations
+        loglikelihood[p] = pair_loglikelihood
+
+
+def em_scalar(y_obs: np.ndarray, n_iter=20, tol=None, initial_params: tuple = None, rtol=None):
+    """
+    EM estimation of the scalar state-observation model for all pairs at once
+        x_t = A + B * x_t-1 + C * e_t      (state)
+        y_t = x_t + D * u_t                (observation)
+    Same algorithm and starting values as pykalman's KalmanFilter.em with
+    em_vars=['transition_matrices', 'transition_offsets', 'transition_covariance', 'observation_covariance'],
+    but the filter, RTS smoother and M-step are written out for a 1-D state (vectorized across the pairs with the
+    numpy backend, one pair at a time with the loop backends).
+
+    Parameters:
+    y_obs: (T, P) formation period spreads of P pairs
+    n_iter: maximum number of EM iterations, a scalar or one value per pair
+    tol: stop a pair once its log-likelihood changes by less than tol between iterations, a scalar or one value per
+         pair (NaN never stops early), None runs n_iter iterations
+    initial_params: (A, B, C, D) arrays to start from, defaults to pykalman's A=0, B=1, C=1, D=1
+    rtol: stop a pair once its log-likelihood changes by less than rtol * |log-likelihood|, like tol a scalar or one
+          value per pair
+
+    Returns:
+    A, B, C, D arrays (P,), number of EM iterations and log-likelihood of every pair
+    """
+    y_obs = np.asarray(y_obs, dtype=np.float64).reshape(len(y_obs), -1)
+    n_days, n_pairs = y_obs.shape
+
+    if initial_params is None:
+        initial_params = (0.0, 1.0, 1.0, 1.0)
+    A, B, C, D = (np.broadcast_to(np.asarray(param, dtype=np.float64), (n_pairs,)).copy() for param in initial_params)
+    Q, R = C**2, D**2
+    n_iter = np.ascontiguousarray(np.broadcast_to(np.asarray(n_iter, dtype=np.int64), (n_pairs,)))
+    tol = _per_column(np.nan if tol is None else tol, n_pairs)
+    rtol = _per_column(np.nan if rtol is None else rtol, n_pairs)
+
+    if _backend == "numpy":
+        A, B, Q, R, n_iterations, loglikelihood = _em_scalar_numpy(y_obs, A, B, Q, R, n_iter, tol, rtol)
+    else:
+        n_iterations = np.zeros(n_pairs, dtype=np.int64)
+        loglikelihood = np.full(n_pairs, -np.inf)
+        _loops(_em_scalar_loops)(np.ascontiguousarray(y_obs), A, B, Q, R, n_iter, tol, rtol, n_iterations,
+                                 loglikelihood)
+    return A, B, np.sqrt(Q), np.sqrt(R), n_iterations, loglikelihood
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# SSD of selected pairs
+
+def _pair_ssd_loops(prices, first, second, ssd):
+    n_days = prices.shape[0]
+    squares = np.empty(n_days)
+    accumulators = np.empty(8)
+    # the squares are added in the order of np.sum along a contiguous axis (numpy's pairwise summation): ranges of
+    # more than 128 values are split in two halves (the first a multiple of 8) and their sums are added, shorter
+    # ranges are summed with 8 accumulators. The recursion runs on an explicit stack of (start, size, half, stage).
+    starts, sizes, halves = np.empty(64, dtype=np.int64), np.empty(64, dtype=np.int64), np.empty(64, dtype=np.int64)
+    stages, lefts = np.empty(64, dtype=np.int64), np.empty(64)
+    for k in range(len(first)):
+        for t in range(n_days):
+            difference = prices[t, first[k]] - prices[t, second[k]]
+            squares[t] = difference * difference
+
+        starts[0], sizes[0], stages[0] = 0, n_days, 0
+        top = 1
+        total = 0.0
+        while top > 0:
+            node = top - 1
+            start, n = starts[node], sizes[node]
+            if n > 128:
+                # stage 0: split and sum the first half
+                half = n // 2
+                halves[node] = half - half % 8
+                stages[node] = 1
+                starts[top], sizes[top], stages[top] = start, halves[node], 0
+                top += 1
+                continue
+
+            if n < 8:
+                value = 0.0
+                for i in range(start, start + n):
+                    value += squares[i]
+            else:
+                for j in range(8):
+                    accumulators[j] = squares[start + j]
+                i = start + 8
+                while i < start + n - n % 8:
+                    for j in range(8):
+                        accumulators[j] += squares[i + j]
+                    i += 8
+                value = (((accumulators[0] + accumulators[1]) + (accumulators[2] + accumulators[3]))
+                         + ((accumulators[4] + accumulators[5]) + (accumulators[6] + accumulators[7])))
+                while i < start + n:
+                    value += squares[i]
+                    i += 1
+            top -= 1
+
+            # hand the sum up: a finished first half starts the second half, a finished second half adds both
+            while top > 0:
+                parent = top - 1
+                if stages[parent] == 1:
+                    lefts[parent] = value
+                    stages[parent] = 2
+                    starts[top] = starts[parent] + halves[parent]
+                    sizes[top] = sizes[parent] - halves[parent]
+                    stages[top] = 0
+                    top += 1
+                    break
+                value = lefts[parent] + value
+                top -= 1
+            if top == 0:
+                total = value
+        ssd[k] = total
+
+
+def pair_ssd(prices: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    Sum of squared differences of the price columns first[k] and second[k] of a (T x N) price matrix.
+    """
+    if _backend == "numpy":
+        return np.sum(np.square(prices[:, first] - prices[:, second]), axis=0)
+    ssd = np.empty(len(first))
+    _loops(_pair_ssd_loops)(np.ascontiguousarray(prices, dtype=np.float64), np.asarray(first, dtype=np.int64),
+                            np.asarray(second, dtype=np.int64), ssd)
+    return ssd
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# replay of the trading signals of a single pair for the plots
+
+def _replay_signals_loops(y, upper, lower, exit_short, exit_long, entries, exits):
+    n_days = len(y)
+    direction = 0  # 1 long -1 short, 0 no open trade
+    for i in range(n_days):
+        if direction == 0:
+            if y[i] > upper[i]:
+                direction = -1
+                entries[i] = -1
+            elif y[i] < lower[i]:
+                direction = 1
+                entries[i] = 1
+        elif (direction == -1 and y[i] < exit_short[i]) or (direction == 1 and y[i] > exit_long[i]):
+            exits[i] = direction
+            direction = 0
+    # the open trade is closed on the last day
+    if n_days and direction != 0:
+        exits[n_days - 1] = direction
+
+
+def replay_signals(y: np.ndarray, upper, lower, exit_short, exit_long):
+    """
+    Entry and exit days of the trades of a single pair, as drawn by plot_spread_signals and
+    plot_spread_signals_kalman: enter short above upper and long below lower, exit a short below exit_short and a long
+    above exit_long, an open trade is closed on the last day.
+
+    Parameters:
+    y: (T,) spread
+    upper, lower, exit_short, exit_long: bands, scalars or (T,) arrays
+
+    Returns:
+    entries, exits: (T,) int8 arrays with 1 for a long and -1 for a short trade on the days it was entered / closed
+    """
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    bands = [np.ascontiguousarray(np.broadcast_to(np.asarray(band, dtype=np.float64), y.shape))
+             for band in (upper, lower, exit_short, exit_long)]
+    entries, exits = np.zeros(len(y), dtype=np.int8), np.zeros(len(y), dtype=np.int8)
+    # a sequential state machine of one series, the numpy backend runs the loops in plain Python
+    _loops(_replay_signals_loops)(y, *bands, entries, exits)
+    return entries, exits
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+
+def check_backends(backends: list = None, n_days: int = 252, n_pairs: int = 12, seed: int = 0) -> dict:
+    """
+    Runs every kernel on random spreads (with missing values) with each backend and compares the results with the
+    numpy backend bit for bit, part of python -m pytest tests (or run python kernels.py).
+
+    Parameters:
+    backends: backends to compare with numpy, defaults to python and numba if it is installed
+
+    Returns:
+    {backend: {kernel: equal}}
+    """
+    if backends is None:
+        backends = ["python"] + (["numba"] if numba_available() else [])
+    rng = np.random.default_rng(seed)
+    # AR(1) spreads like the selected pairs, a few missing days and a stock that is not trading yet
+    y = np.zeros((n_days, n_pairs))
+    for t in range(1, n_days):
+        y[t] = 0.95 * y[t - 1] + rng.normal(0, 0.02, n_pairs)
+    y[rng.random((n_days, n_pairs)) < 0.01] = np.nan
+    y[:20, -1] = np.nan
+    y_normalized = (y - np.nanmean(y, axis=0)) / np.nanstd(y, axis=0)
+    prices = np.cumprod(1 + rng.normal(0, 0.01, (n_days, 2 * n_pairs)), axis=0)
+    first, second = np.triu_indices(2 * n_pairs, k=1)
+    formation = np.nan_to_num(y)
+
+    def run_all():
+        A, B, C, D, n_iterations, loglikelihood = em_scalar(formation, n_iter=20)
+        warm = em_scalar(formation, n_iter=rng_iter, tol=1e-2, initial_params=(A, B, C, D))
+        warm_relative = em_scalar(formation, n_iter=rng_iter, initial_params=(A, B, C, D), rtol=1e-3)
+        R_est, K = kalman_variance_sequence(B, C, D, n_days)
+        x_est = kalman_filter(y, A, B, K)
+        thresholds = np.linspace(0.5, 2.5, n_pairs)
+        return {"em_scalar": (A, B, C, D, n_iterations, loglikelihood),
+                "em_scalar_warm_start": warm,
+                "em_scalar_warm_start_rtol": warm_relative,
+                "kalman_variance_sequence": (R_est, K),
+                "kalman_filter": (x_est,),
+                "trade_spreads": trade_spreads(y, y_normalized, 2.0),
+                "trade_spreads_per_column": trade_spreads(y, y_normalized, thresholds),
+                "trade_kalman_bands": trade_kalman_bands(y, x_est, R_est, 1.0),
+                "trade_kalman_bands_per_column": trade_kalman_bands(y, x_est, R_est, thresholds),
+                "pair_ssd": (pair_ssd(prices, first, second),),
+                "replay_signals": replay_signals(y_normalized[:, 0], 2.0, -2.0, 0.0, 0.0)}
+
+    rng_iter = rng.integers(1, 20, n_pairs)
+    previous = _backend
+    try:
+        set_backend("numpy")
+        expected = run_all()
+        checked = {}
+        for backend in backends:
+            set_backend(backend)
+            results = run_all()
+            checked[backend] = {kernel: all(np.array_equal(np.asarray(a), np.asarray(b), equal_nan=True)
+                                            for a, b in zip(expected[kernel], results[kernel]))
+                                for kernel in expected}
+    finally:
+        set_backend(previous)
+    return checked
+
+
+if __name__ == "__main__":
+    for backend, kernels in check_backends().items():
+        for kernel, equal in kernels.items():
+            print(f"{backend:8s} {kernel:32s} {'equal' if equal else 'DIFFERENT'}")
@@ -0,0 +1,127 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class PairPrefilter:
+    """
+    Candidate generation for calculate_and_sort_ssd on large universes.
+
+    The SSD of two normalized price paths is their squared euclidean distance, so the pairs with the smallest SSD
+    are close neighbours. The paths (one T dimensional point per ticker) are reduced to n_components dimensions with
+    PCA or a random projection, a cKDTree finds the n_neighbors nearest tickers of every ticker and only these
+    candidate pairs get their exact SSD. Instead of O(N^2 T) this costs about O(N T^2 + N n_neighbors T).
+    PCA is an orthogonal projection, so the reduced distances never overestimate the real ones: the candidates are
+    checked in the order of their reduced distance and the exact SSD stops once no further candidate can make the
+    top_m.
+
+    Parameters:
+    n_components: dimensions of the reduced paths
+    n_neighbors: nearest neighbours queried per ticker
+    top_m: number of candidate pairs returned, None returns all candidates
+    method: "pca" or "random" (gaussian random projection)
+    seed: seed of the random projection
+    """
+
+    def __init__(self, n_components: int = 32, n_neighbors: int = 50, top_m: int = 2000, method: str = "pca",
+                 seed: int = 0):
+        if method not in ("pca", "random"):
+            raise ValueError(f"unknown method {method}, expected 'pca' or 'random'")
+        self.n_components = n_components
+        self.n_neighbors = n_neighbors
+        self.top_m = top_m
+        self.method = method
+        self.seed = seed
+
+    def __repr__(self):
+        return (f"PairPrefilter(n_components={self.n_components}, n_neighbors={self.n_neighbors}, "
+                f"top_m={self.top_m}, method={self.method!r}, seed={self.seed})")
+
+    def _reduce(self, prices: np.ndarray) -> np.ndarray:
+        # one row per ticker, distances do not change when the mean path is subtracted
+        paths = prices.T - prices.mean(axis=1)
+        n_components = min(self.n_components, *paths.shape)
+        if self.method == "pca":
+            # principal axes from the (T x T) covariance of the paths, cheaper than the SVD of the (N x T) paths
+            _, eigenvectors = np.linalg.eigh(paths.T @ paths)
+            return paths @ eigenvectors[:, ::-1][:, :n_components]
+        rng = np.random.default_rng(self.seed)
+        projection = rng.normal(size=(paths.shape[1], n_components)) / np.sqrt(n_components)
+        return paths @ projection
+
+    def candidates(self, stocks: pd.DataFrame) -> pd.DataFrame:
+        """
+        Top candidate pairs of a formation window with their exact SSD, in the format of calculate_and_sort_ssd.
+
+        Parameters:
+        stocks: normalized stock prices of the formation period
+
+        Returns:
+        DataFrame with the SSD of the top_m candidate pairs, sorted ascending
+        """
+        # If the stock is not trading yet, skip all of its pairs
+        valid = ~stocks.isna().any(axis=0).to_numpy()
+        tickers = stocks.columns[valid]
+        prices = stocks.to_numpy(dtype=np.float64)[:, valid]
+        n_tickers = len(tickers)
+        if n_tickers < 2:
+            return pd.DataFrame({"SSD": np.empty(0)}, index=pd.Index([], dtype=object))
+
+        # nearest neighbours of every ticker in the reduced space, a pair is kept once as (first, second) column
+        from scipy.spatial import cKDTree
+        tree = cKDTree(self._reduce(prices))
+        distances, neighbors = tree.query(tree.data, k=min(self.n_neighbors + 1, n_tickers))
+        first = np.repeat(np.arange(n_tickers), neighbors.shape[1])
+        second = neighbors.ravel()
+        first, second = np.minimum(first, second), np.maximum(first, second)
+        different = first != second
+        candidate_ids, unique = np.unique(first[different] * n_tickers + second[different], return_index=True)
+        lower_bound = distances.ravel()[different][unique]**2
+        first, second = np.divmod(candidate_ids, n_tickers)
+
+        # exact SSD of the candidates in the order of their reduced distance
+        by_bound = np.argsort(lower_bound, kind="stable")
+        first, second, lower_bound = first[by_bound], second[by_bound], lower_bound[by_bound]
+        ssd = np.full(len(first), np.inf)
+        for start in range(0, len(first), 4096):
+            block = slice(start, start + 4096)
+            if (self.method == "pca" and self.top_m is not None and start >= self.top_m
+                    and lower_bound[start] > np.partition(ssd[:start], self.top_m - 1)[self.top_m - 1]):
+                break
+            ssd[block] = np.sum((prices[:, first[block]] - prices[:, second[block]])**2, axis=0)
+
+        # ascending SSD, ties in combinations order like calculate_and_sort_ssd
+        computed = np.isfinite(ssd)
+        first, second, ssd = first[computed], second[computed], ssd[computed]
+        order = np.lexsort((second, first, ssd))[:self.top_m]
+        index = tickers[first[order]] + "_" + tickers[second[order]]
+        return pd.DataFrame({"SSD": ssd[order]}, index=index)
+
+
+def prefilter_recall(stocks: pd.DataFrame, prefilter: PairPrefilter, top_k: int = 200) -> dict:
+    """
+    Recall benchmark of a prefilter against the brute force ranking of calculate_and_sort_ssd.
+
+    Parameters:
+    stocks: normalized stock prices of a formation period
+    prefilter: PairPrefilter to evaluate
+    top_k: size of the brute force top list the recall is measured on
+
+    Returns:
+    dict with the recall of the top_k pairs, the share of the top_k returned in the same order and both run times
+    """
+    from cointegration_functions import calculate_and_sort_ssd
+
+    start = time.perf_counter()
+    exact = calculate_and_sort_ssd(stocks, top_k=top_k)
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    approximate = prefilter.candidates(stocks)
+    prefilter_seconds = time.perf_counter() - start
+
+    recall = np.isin(exact.index, approximate.index).mean() if len(exact) else 1.0
+    same_order = np.mean(exact.index == approximate.index[:len(exact)]) if len(approximate) >= len(exact) else np.nan
+    return {"top_k": top_k, "recall": float(recall), "same_order": float(same_order),
+            "n_candidates": len(approximate), "exact_seconds": exact_seconds, "prefilter_seconds": prefilter_seconds}
@@ -0,0 +1,215 @@
+"""
+Command line entry point of the pairs trading backtests.
+
+The options can be given on the command line, in a TOML (or YAML, needs PyYAML) config file or both, the command
+line wins. The config keys are the option names with underscores, see configs/ for the runs of the thesis.
+
+Usage (from the repository root):
+    python pairs_backtest.py run --strategy kalman --costs 0,0.006 --start 1990 --workers 8
+    python pairs_backtest.py run --config configs/kalman.toml
+    python pairs_backtest.py run --config configs/cointegration.toml --end 2010-12-31 --output-dir results/until2010
+
+The returns and trade counts are written to <output_dir>/backtest_<strategy>_returns<cost>.csv and
+<output_dir>/backtest_<strategy>_tradecount<cost>.csv and the per period metrics to
+<output_dir>/backtest_<strategy>_metrics.csv. <cost> is "_nocost" for 0, empty for the 0.006 of the thesis (the file
+names of the old run_simulation.py) and e.g. "_cost0.01" otherwise.
+
+Checkpoints are off unless --checkpoint-dir (or checkpoint_dir in the config) is given, a stored period is only
+reused if it was run with the same prices and settings.
+"""
+import argparse
+import os
+import sys
+
+# options of the run command and their defaults, also the keys of a config file
+DEFAULTS = {
+    "strategy": None,
+    "prices": "./stocks_1990_2025.csv",
+    "start": None,
+    "end": None,
+    "costs": [0.0, 0.006],
+    "workers": 1,
+    "screening_workers": 1,
+    "screening_method": "statsmodels",
+    "incremental_ssd": False,
+    "n_pairs": 20,
+    "threshold": None,
+    "formation_months": 24,
+    "trading_months": 6,
+    "cascade": False,
+    "prefilter": False,
+    "warm_start": False,
+    "checkpoint_dir": None,
+    "formation_cache_dir": None,
+    "output_dir": "./results",
+    "profile_stages": [],
+    "kernel_backend": None,
+    "trade_events": False,
+}
+# default entry threshold (cointegration, in standard deviations) / threshold factor (kalman) of the strategies
+THRESHOLDS = {"cointegration": 2.0, "kalman": 1.0}
+# transaction cost of the thesis runs, its results keep the file names without a cost suffix
+THESIS_COST = 0.006
+
+
+def load_config(path: str) -> dict:
+    """
+    Reads a .toml or .yaml / .yml config file into a dict of run options.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        import tomllib
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    elif extension in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("YAML configs need the PyYAML package, use a .toml config instead") from None
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+    else:
+        raise ValueError(f"unknown config format {extension}, expected .toml, .yaml or .yml")
+
+    unknown = sorted(set(config) - set(DEFAULTS))
+    if unknown:
+        raise ValueError(f"unknown options in {path}: {', '.join(unknown)}")
+    return config
+
+
+def _costs(value: str) -> list:
+    return [float(cost) for cost in value.split(",") if cost.strip()]
+
+
+def _stages(value: str) -> list:
+    return [stage.strip() for stage in value.split(",") if stage.strip()]
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="pairs_backtest.py", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # every option defaults to None so only the options given on the command line override the config
+    run = commands.add_parser("run", help="run a backtest and write its results")
+    run.add_argument("--config", help="TOML / YAML file with the options below")
+    run.add_argument("--strategy", choices=sorted(THRESHOLDS))
+    run.add_argument("--prices", help=f"price csv, default {DEFAULTS['prices']}")
+    run.add_argument("--start", help="first date of the prices, e.g. 1990 or 1990-01-01")
+    run.add_argument("--end", help="last date of the prices, a year or month includes all of it, e.g. 2010")
+    run.add_argument("--costs", type=_costs, help="comma separated transaction cost levels, default 0,0.006")
+    run.add_argument("--workers", type=int, help="processes running the trading periods")
+    run.add_argument("--screening-workers", type=int, help="processes testing the candidate pairs of a period")
+    run.add_argument("--screening-method", choices=["statsmodels", "numpy"])
+    run.add_argument("--incremental-ssd", action="store_true", default=None)
+    run.add_argument("--n-pairs", type=int, help="pairs per portfolio")
+    run.add_argument("--threshold", type=float,
+                     help="entry threshold (cointegration, default 2.0) or threshold factor (kalman, default 1.0)")
+    run.add_argument("--formation-months", type=int)
+    run.add_argument("--trading-months", type=int)
+    run.add_argument("--cascade", action="store_true", default=None, help="screen the pairs with a ScreeningCascade")
+    run.add_argument("--prefilter", action="store_true", default=None, help="prefilter the pairs with a PairPrefilter")
+    run.add_argument("--warm-start", action="store_true", default=None, help="warm start the EM (kalman)")
+    run.add_argument("--checkpoint-dir", help="checkpoint the finished periods in this folder, {strategy} is "
+                                              "replaced by the strategy, e.g. ./cache/checkpoints/{strategy}")
+    run.add_argument("--no-checkpoints", dest="checkpoint_dir", action="store_const", const="",
+                     help="do not checkpoint the periods (default, overrides checkpoint_dir of the config)")
+    run.add_argument("--formation-cache-dir", help="cache of the formation periods, shared by both strategies")
+    run.add_argument("--output-dir", help=f"folder of the result csv files, default {DEFAULTS['output_dir']}")
+    run.add_argument("--profile-stages", type=_stages, help="comma separated stages to profile, e.g. estimation")
+    run.add_argument("--kernel-backend", choices=["numpy", "python", "numba"], help="see kernels.py")
+    run.add_argument("--trade-events", action="store_true", default=None, help="log every trade")
+    return parser
+
+
+def run_options(args: argparse.Namespace) -> dict:
+    """
+    Options of a run: the defaults, overridden by the config file, overridden by the command line.
+    """
+    options = dict(DEFAULTS)
+    if args.config:
+        options.update(load_config(args.config))
+    options.update({key: value for key, value in vars(args).items()
+                    if key in DEFAULTS and value is not None})
+    if options["strategy"] not in THRESHOLDS:
+        raise ValueError(f"--strategy (or strategy in the config) must be one of {sorted(THRESHOLDS)}")
+    if options["strategy"] == "kalman" and options["warm_start"] and options["workers"] > 1:
+        raise ValueError("warm_start needs the periods in order, it can not be combined with workers > 1")
+    if options["threshold"] is None:
+        options["threshold"] = THRESHOLDS[options["strategy"]]
+    options["costs"] = [float(cost) for cost in options["costs"]]
+    return options
+
+
+def _cost_name(cost: float) -> str:
+    if cost == 0:
+        return "_nocost"
+    return "" if cost == THESIS_COST else f"_cost{cost:g}"
+
+
+def run(options: dict):
+    """
+    Runs the backtest of the options and writes the returns, trade counts and metrics.
+    """
+    # the backtest modules (and pandas) are only imported for a run, --help and config errors return right away
+    from price_store import load_prices
+    from checkpoint_store import CheckpointStore
+    from formation_cache import FormationCache
+    from instrumentation import Instrumentation
+    from pair_prefilter import PairPrefilter
+    from screening_cascade import ScreeningCascade
+    import kernels
+
+    if options["kernel_backend"]:
+        kernels.set_backend(options["kernel_backend"])
+    strategy = options["strategy"]
+    # years / dates of a TOML config are ints / dates, str() turns them into the same strings as on the command line
+    start, end = (None if options[key] is None else str(options[key]) for key in ("start", "end"))
+    stocks = load_prices(options["prices"]).window(start, end)
+    os.makedirs(options["output_dir"], exist_ok=True)
+
+    checkpoint_dir = options["checkpoint_dir"].format(strategy=strategy) if options["checkpoint_dir"] else None
+    kwargs = dict(transaction_costs=options["costs"], period_workers=options["workers"],
+                  screening_workers=options["screening_workers"], screening_method=options["screening_method"],
+                  incremental_ssd=options["incremental_ssd"], n_pairs=options["n_pairs"],
+                  formation_months=options["formation_months"], trading_months=options["trading_months"],
+                  cascade=ScreeningCascade() if options["cascade"] else None,
+                  prefilter=PairPrefilter() if options["prefilter"] else None,
+                  checkpoints=CheckpointStore(checkpoint_dir) if checkpoint_dir else None,
+                  formation_cache=(FormationCache(options["formation_cache_dir"])
+                                   if options["formation_cache_dir"] else None),
+                  instrumentation=Instrumentation(os.path.join(options["output_dir"],
+                                                               f"backtest_{strategy}_metrics.csv"),
+                                                  profile_stages=options["profile_stages"]),
+                  trade_events=options["trade_events"])
+
+    if strategy == "kalman":
+        from kalman_functions import run_strategy_kalman
+        returns, trade_counts = run_strategy_kalman(stocks, threshold_factor=options["threshold"],
+                                                    warm_start=options["warm_start"], **kwargs)
+    else:
+        from cointegration_functions import run_strategy_hossein
+        returns, trade_counts = run_strategy_hossein(stocks, entry_threshold=options["threshold"], **kwargs)
+
+    for cost in options["costs"]:
+        returns[cost].to_csv(os.path.join(options["output_dir"],
+                                          f"backtest_{strategy}_returns{_cost_name(cost)}.csv"))
+        trade_counts[cost].to_csv(os.path.join(options["output_dir"],
+                                               f"backtest_{strategy}_tradecount{_cost_name(cost)}.csv"))
+    print("results written to", options["output_dir"])
+
+
+def main(argv: list = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        options = run_options(args)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    if args.command == "run":
+        run(options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
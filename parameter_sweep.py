@@ -0,0 +1,145 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from cointegration_functions import (normalize, calculate_and_sort_ssd, select_cointegrated_pairs,
+                                     calculate_portfolio_spread, trading_periods, _trade_spreads)
+from kalman_functions import estimate_model, kalman_paths, _trade_kalman_bands
+from screening_cascade import ScreeningCascade
+
+PARAMETERS = ["formation_months", "trading_months", "n_pairs", "threshold"]
+
+
+def _formation(stocks_formation: pd.DataFrame, strategy: str, max_pairs: int, screening_method: str,
+               cascade: ScreeningCascade):
+    """
+    Portfolio of the largest size (and its Kalman models) of a formation window, the smaller sizes are its prefixes.
+    """
+    pairs_sorted = calculate_and_sort_ssd(stocks_formation)
+    portfolio = select_cointegrated_pairs(stocks_formation, pairs_sorted, method=screening_method, cascade=cascade,
+                                          n_pairs=max_pairs)
+    if strategy == "kalman" and len(portfolio):
+        return estimate_model(stocks_formation, portfolio)
+    return portfolio
+
+
+def _trade_thresholds(stocks_trading: pd.DataFrame, portfolio: pd.DataFrame, strategy: str,
+                      thresholds: np.ndarray) -> np.ndarray:
+    """
+    Returns of all pairs for all thresholds in one pass of the trading rule: the spreads (Kalman: the filtered paths)
+    are computed once and repeated for every threshold.
+
+    Returns:
+    (T, P, K) returns without transaction costs of P pairs and K thresholds
+    """
+    n_days, n_pairs, n_thresholds = len(stocks_trading), len(portfolio), len(thresholds)
+    if n_pairs == 0:
+        return np.zeros((n_days, 0, n_thresholds))
+
+    def repeat(paths):
+        return np.repeat(paths, n_thresholds, axis=1)
+
+    column_thresholds = np.tile(thresholds, n_pairs)
+    if strategy == "kalman":
+        y_obs, x_est, R_est = kalman_paths(portfolio, stocks_trading)
+        result, _ = _trade_kalman_bands(repeat(y_obs), repeat(x_est), repeat(R_est), column_thresholds)
+    else:
+        spread_df, spread_df_normalized = calculate_portfolio_spread(stocks_trading, portfolio)
+        result, _ = _trade_spreads(repeat(spread_df.to_numpy(dtype=np.float64)),
+                                   repeat(spread_df_normalized.to_numpy(dtype=np.float64)), column_thresholds)
+    return result.reshape(n_days, n_pairs, n_thresholds)
+
+
+def parameter_sweep(stocks: pd.DataFrame, strategy: str = "cointegration", thresholds: list = None,
+                    portfolio_sizes: list = (20,), formation_months: list = (24,), trading_months: list = (6,),
+                    transaction_cost: float = 0.0, screening_method: str = "numpy", cascade: ScreeningCascade = None,
+                    by_period: bool = False) -> pd.DataFrame:
+    """
+    Backtests a grid of research parameters of a strategy and shares the work between the grid points:
+    - every formation window is ranked by SSD and screened once, for the largest portfolio size. Pairs are accepted
+      in SSD order, so the smaller portfolios are prefixes of it (and of its Kalman models)
+    - the formation windows do not depend on the trading period length and are reused across trading_months
+    - the spreads / Kalman paths of a trading period are computed once and all thresholds are traded in one pass
+      of the trading rule on repeated columns
+
+    Parameters:
+    stocks: stock prices with a date index
+    strategy: "cointegration" or "kalman"
+    thresholds: entry thresholds in standard deviations of the normalized spread (cointegration, default [2.0]) or
+                threshold factors of the Kalman bands (kalman, default [1.0])
+    portfolio_sizes: numbers of pairs per portfolio
+    formation_months, trading_months: lengths of the formation and trading periods
+    transaction_cost: cost subtracted from every closed trade
+    screening_method: "statsmodels" or "numpy", see select_cointegrated_pairs
+    cascade: ScreeningCascade of the pair selection
+    by_period: one row per parameter tuple and trading period instead of one row per parameter tuple
+
+    Returns:
+    tidy DataFrame indexed by (formation_months, trading_months, n_pairs, threshold) with the number of periods,
+    closed trades, mean return per pair and period, mean monthly return (summed returns of the overlapping portfolios
+    / n_pairs / trading_months like comparison_framework.ipynb), its standard deviation and annualized Sharpe ratio.
+    With by_period, indexed by (..., portfolio) with the return and trades of every period.
+    """
+    if strategy not in ("cointegration", "kalman"):
+        raise ValueError(f"unknown strategy {strategy}, expected 'cointegration' or 'kalman'")
+    if thresholds is None:
+        thresholds = [2.0] if strategy == "cointegration" else [1.0]
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    portfolio_sizes = sorted(portfolio_sizes)
+    stocks = stocks.copy()
+    stocks.index = pd.to_datetime(stocks.index)
+
+    from tqdm import tqdm
+    period_rows, monthly_rows = [], []
+    for formation_length in formation_months:
+        formations = {}  # formation_start -> portfolio of the largest size, shared by all trading lengths
+        for trading_length in trading_months:
+            periods = trading_periods(stocks.index, formation_length, trading_length)
+            # daily returns of all overlapping portfolios per (size, threshold)
+            daily = np.zeros((len(stocks.index), len(portfolio_sizes), len(thresholds)))
+
+            for period in tqdm(periods, desc=f"Sweep {formation_length}/{trading_length} months"):
+                formation_start, formation_end, trading_start, trading_end = period
+                stocks_normalized = normalize(stocks.loc[formation_start:trading_end])
+                if formation_start not in formations:
+                    formations[formation_start] = _formation(stocks_normalized.loc[formation_start:formation_end],
+                                                             strategy, portfolio_sizes[-1], screening_method, cascade)
+                portfolio = formations[formation_start]
+
+                gross = _trade_thresholds(stocks_normalized.loc[trading_start:trading_end], portfolio, strategy,
+                                          thresholds)
+                net = np.where(gross == 0.0, gross, gross - transaction_cost)
+                start = stocks.index.searchsorted(trading_start, side="left")
+
+                for i, n_pairs in enumerate(portfolio_sizes):
+                    portfolio_returns = np.nansum(net[:, :n_pairs], axis=1)  # (T, K)
+                    trades = np.count_nonzero(net[:, :n_pairs], axis=(0, 1))
+                    daily[start:start + len(net), i] += portfolio_returns
+                    for k, threshold in enumerate(thresholds):
+                        period_rows.append((formation_length, trading_length, n_pairs, threshold,
+                                            f"Portfolio_{trading_start}", portfolio_returns[:, k].sum(),
+                                            int(trades[k])))
+            if not periods:
+                continue
+
+            # monthly returns of the overlapping portfolios, per grid point
+            traded = slice(stocks.index.searchsorted(periods[0][2], side="left"),
+                           stocks.index.searchsorted(periods[-1][3], side="right"))
+            for (i, n_pairs), (k, threshold) in itertools.product(enumerate(portfolio_sizes), enumerate(thresholds)):
+                monthly = (pd.Series(daily[traded, i, k], index=stocks.index[traded]).resample("1ME").sum()
+                           / n_pairs / trading_length)
+                monthly_rows.append((formation_length, trading_length, n_pairs, threshold, monthly.mean(),
+                                     monthly.std()))
+
+    per_period = pd.DataFrame(period_rows, columns=PARAMETERS + ["portfolio", "return", "trades"])
+    if by_period:
+        return per_period.set_index(PARAMETERS + ["portfolio"])
+
+    summary = per_period.groupby(PARAMETERS, sort=False).agg(n_periods=("return", "size"), trades=("trades", "sum"),
+                                                             mean_period_return=("return", "mean"))
+    summary["mean_period_return"] /= summary.index.get_level_values("n_pairs").to_numpy()
+    monthly = pd.DataFrame(monthly_rows, columns=PARAMETERS + ["mean_monthly_return", "std_monthly_return"])
+    summary = summary.join(monthly.set_index(PARAMETERS))
+    summary["sharpe_ratio"] = summary["mean_monthly_return"] / summary["std_monthly_return"] * np.sqrt(12)
+    return summary
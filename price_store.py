@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class PriceStore:
+    """
+    Binary copy of the price csv: a float64 memory-mapped (dates x tickers) matrix, the dates and the tickers.
+
+    The csv is parsed once by PriceStore.from_csv, afterwards opening the store only maps the file, and a window of
+    consecutive dates is a row slice of the matrix, so slicing by date range does not copy the prices.
+
+    Parameters:
+    directory: folder with prices.f64, dates.npy and meta.json written by from_csv
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(directory, "dates.npy")))
+        self.tickers = pd.Index(self.meta["tickers"])
+        # ticker -> column of the matrix
+        self.ticker_columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.prices = np.memmap(os.path.join(directory, "prices.f64"), dtype=np.float64, mode="r",
+                                shape=(len(self.dates), len(self.tickers)))
+
+    @classmethod
+    def from_csv(cls, csv_path: str, directory: str = "cache/prices") -> "PriceStore":
+        """
+        Converts a price csv (dates in the first column, one column per ticker) into a store.
+        """
+        stocks = pd.read_csv(csv_path, index_col=0)
+        os.makedirs(directory, exist_ok=True)
+
+        prices = np.ascontiguousarray(stocks.to_numpy(dtype=np.float64))
+        # write the matrix first and the meta data last, a store without meta.json is incomplete
+        matrix = np.memmap(os.path.join(directory, "prices.f64"), dtype=np.float64, mode="w+", shape=prices.shape)
+        matrix[:] = prices
+        matrix.flush()
+        del matrix
+        np.save(os.path.join(directory, "dates.npy"), pd.to_datetime(stocks.index).to_numpy(dtype="datetime64[ns]"))
+
+        stat = os.stat(csv_path)
+        meta = {"source": os.path.abspath(csv_path), "source_size": stat.st_size, "source_mtime": stat.st_mtime,
+                "tickers": [str(ticker) for ticker in stocks.columns]}
+        tmp_path = os.path.join(directory, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(directory, "meta.json"))
+        return cls(directory)
+
+    def is_current(self, csv_path: str) -> bool:
+        """
+        True if the store was converted from the current version of csv_path.
+        """
+        stat = os.stat(csv_path)
+        return (self.meta["source"] == os.path.abspath(csv_path) and self.meta["source_size"] == stat.st_size
+                and self.meta["source_mtime"] == stat.st_mtime)
+
+    def rows(self, start=None, end=None) -> slice:
+        """
+        Row slice of the dates from start to end (both included, like DataFrame.loc). A partial date string covers its
+        whole period like in DataFrame.loc, e.g. end="2010" includes all of 2010 and end="2010-06" all of June.
+        """
+        if isinstance(end, str):
+            end = pd.Period(end).end_time
+        row_start = 0 if start is None else self.dates.searchsorted(pd.Timestamp(start), side="left")
+        row_stop = len(self.dates) if end is None else self.dates.searchsorted(pd.Timestamp(end), side="right")
+        return slice(row_start, row_stop)
+
+    def window(self, start=None, end=None, tickers: list = None) -> pd.DataFrame:
+        """
+        Prices from start to end as a DataFrame on top of the memory map (no copy unless tickers are selected).
+        """
+        rows = self.rows(start, end)
+        if tickers is None:
+            return pd.DataFrame(self.prices[rows], index=self.dates[rows], columns=self.tickers, copy=False)
+        columns = [self.ticker_columns[ticker] for ticker in tickers]
+        return pd.DataFrame(self.prices[rows][:, columns], index=self.dates[rows], columns=pd.Index(tickers))
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        All prices with a DatetimeIndex, as expected by run_strategy_hossein / run_strategy_kalman.
+        """
+        return self.window()
+
+
+def load_prices(csv_path: str, directory: str = "cache/prices") -> PriceStore:
+    """
+    Opens the price store of a csv, (re)converting the csv if the store is missing or older than the csv.
+    """
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        store = PriceStore(directory)
+        if store.is_current(csv_path):
+            return store
+    return PriceStore.from_csv(csv_path, directory)
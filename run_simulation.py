@@ -1,28 +1,14 @@
-import pandas as pd 
-from cointegration_functions import * 
-from kalman_functions import *
-
-stocks_1990_2025 = pd.read_csv("./stocks_1990_2025.csv", index_col = 0)
-
-# First run without transaction costs
-# Cointegration Hossein 
-"""
-backtest_cointegration_returns_nocost, backtest_cointegration_tradecount_nocost  = run_strategy_hossein(stocks_1990_2025, useTransactionCosts=False)
-backtest_cointegration_returns_nocost.to_csv("./results/backtest_cointegration_returns_nocost.csv")
-backtest_cointegration_tradecount_nocost.to_csv("./results/backtest_cointegration_tradecount_nocost.csv")
-
-# Kalman method 
-backtest_kalman_returns_nocost, backtest_kalman_tradecount_nocost  = run_strategy_kalman(stocks_1990_2025, useTransactionCosts=False)
-backtest_kalman_returns_nocost.to_csv("./results/backtest_kalman_returns_nocost.csv")
-backtest_kalman_tradecount_nocost.to_csv("./results/backtest_kalman_tradecount_nocost.csv")
-
-
-# Then run including transaction costs 
-backtest_cointegration_returns, backtest_cointegration_tradecount  = run_strategy_hossein(stocks_1990_2025, useTransactionCosts=True)
-backtest_cointegration_returns.to_csv("./results/backtest_cointegration_returns.csv")
-backtest_cointegration_tradecount.to_csv("./results/backtest_cointegration_tradecount.csv")
-""" 
-# Kalman method
-backtest_kalman_returns, backtest_kalman_tradecount = run_strategy_kalman(stocks_1990_2025, useTransactionCosts=True)
-backtest_kalman_returns.to_csv("./results/backtest_kalman_returns.csv")
-backtest_kalman_tradecount.to_csv("./results/backtest_kalman_tradecount.csv")
+import sys
+
+from pairs_backtest import main
+
+# The backtests are run with the command line of pairs_backtest.py, the settings of the runs are in configs/:
+#   python pairs_backtest.py run --config configs/cointegration.toml
+#   python pairs_backtest.py run --config configs/kalman.toml
+#   python pairs_backtest.py run --strategy kalman --costs 0,0.006 --start 1990 --workers 8
+# The csv is converted once into a memory-mapped price store (cache/prices), later runs only map the file.
+# Each strategy is simulated once and evaluated for all transaction cost levels, 0.0 is the run without costs.
+# Finished periods are checkpointed, after new days are appended to the csv only the new periods are simulated.
+# The per period stage times / counters are written next to the results (--profile-stages to profile a stage).
+if __name__ == "__main__":
+    sys.exit(main(["run", "--config", "configs/kalman.toml"] + sys.argv[1:]))
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+# trading rule of a pair
+COINTEGRATION, KALMAN = 0, 1
+
+_FLOAT_STATE = ("beta", "mean", "sd", "A", "B", "C", "D", "threshold_factor", "base1", "base2",
+                "x_est", "R_est", "direction", "spread_t", "last_spread")
+_INT_STATE = ("idx1", "idx2", "rule", "n_bars")
+
+
+class StreamingSignalEngine:
+    """
+    Online version of the trading rules of trade_portfolio and trade_portfolio_kalman.
+
+    The state of every pair of all active (overlapping) portfolios is kept in flat arrays: filter state
+    (x_est, R_est), position (direction, spread at entry) and the portfolio parameters. on_bar consumes the prices
+    of one day and updates all pairs with array operations, so the work per bar is O(pairs) and the memory does not
+    grow with the length of the feed. Replaying a trading period bar by bar gives the same returns as the batch
+    functions.
+
+    Parameters:
+    tickers: tickers of the price vector passed to on_bar
+    """
+
+    def __init__(self, tickers):
+        self.tickers = pd.Index(tickers)
+        self.ticker_columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.portfolio_ends = {}  # portfolio -> last day of its trading period
+        self.last_date = None
+        self._pairs = np.empty(0, dtype=object)
+        self._portfolios = np.empty(0, dtype=object)
+        self._entered = np.empty(0, dtype=bool)
+        self._state = {name: np.empty(0) for name in _FLOAT_STATE}
+        self._state.update({name: np.empty(0, dtype=int) for name in _INT_STATE})
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def _add(self, name: str, pairs: pd.Index, base_prices: pd.Series, end, rule: int, **params):
+        if name in self.portfolio_ends:
+            raise ValueError(f"portfolio {name} is already active")
+        stock1s = [pair.split("_")[0] for pair in pairs]
+        stock2s = [pair.split("_")[1] for pair in pairs]
+        n_pairs = len(pairs)
+
+        new_state = {name: np.zeros(n_pairs) for name in _FLOAT_STATE}
+        new_state.update({name: np.zeros(n_pairs, dtype=int) for name in _INT_STATE})
+        new_state.update({key: np.asarray(value, dtype=np.float64) for key, value in params.items()})
+        new_state["idx1"] = np.array([self.ticker_columns[stock] for stock in stock1s], dtype=int)
+        new_state["idx2"] = np.array([self.ticker_columns[stock] for stock in stock2s], dtype=int)
+        new_state["base1"] = base_prices[stock1s].to_numpy(dtype=np.float64)
+        new_state["base2"] = base_prices[stock2s].to_numpy(dtype=np.float64)
+        new_state["rule"][:] = rule
+        new_state["last_spread"][:] = np.nan
+
+        for key in self._state:
+            self._state[key] = np.concatenate([self._state[key], new_state[key]])
+        self._pairs = np.concatenate([self._pairs, np.asarray(pairs, dtype=object)])
+        self._portfolios = np.concatenate([self._portfolios, np.full(n_pairs, name, dtype=object)])
+        self._entered = np.concatenate([self._entered, np.zeros(n_pairs, dtype=bool)])
+        self.portfolio_ends[name] = pd.Timestamp(end)
+
+    def add_cointegration_portfolio(self, name: str, portfolio: pd.DataFrame, base_prices: pd.Series, end,
+                                    entry_threshold: float = 2.0):
+        """
+        Starts trading a portfolio of select_cointegrated_pairs with the rule of trade_portfolio.
+
+        Parameters:
+        name: portfolio name, e.g. Portfolio_<trading_start>
+        portfolio: beta, mean and sd of the pairs from the formation period
+        base_prices: raw prices on the first day of the formation period (the prices are normalized to them)
+        end: last day of the trading period, open trades are closed after it
+        entry_threshold: entry threshold of the normalized spread in standard deviations
+        """
+        # the entry threshold is kept in the threshold_factor state of the pair
+        self._add(name, portfolio.index, base_prices, end, COINTEGRATION, beta=portfolio["beta"],
+                  mean=portfolio["mean"], sd=portfolio["sd"],
+                  threshold_factor=np.full(len(portfolio), entry_threshold))
+
+    def add_kalman_portfolio(self, name: str, portfolio_models: pd.DataFrame, base_prices: pd.Series, end,
+                             threshold_factor: float = 1.0):
+        """
+        Starts trading a portfolio of estimate_model with the rule of trade_portfolio_kalman.
+
+        Parameters:
+        name: portfolio name, e.g. Portfolio_<trading_start>
+        portfolio_models: A, B, C, D and beta of the pairs from the formation period
+        base_prices: raw prices on the first day of the formation period (the prices are normalized to them)
+        end: last day of the trading period, open trades are closed after it
+        threshold_factor: number of filtered standard deviations of the bands
+        """
+        models = portfolio_models[["A", "B", "C", "D", "beta"]].astype(np.float64)
+        self._add(name, models.index, base_prices, end, KALMAN, A=models["A"], B=models["B"], C=models["C"],
+                  D=models["D"], beta=models["beta"], threshold_factor=np.full(len(models), threshold_factor))
+
+    def _events(self, rows: np.ndarray, event: str, date, returns: np.ndarray = None) -> list:
+        state = self._state
+        return [{"date": date, "portfolio": self._portfolios[i], "pair": self._pairs[i], "event": event,
+                 "direction": int(state["direction"][i]), "spread": float(state["last_spread"][i]),
+                 "return": None if returns is None else float(returns[i])}
+                for i in rows]
+
+    def close_portfolio(self, name: str) -> list:
+        """
+        Closes the open trades of a portfolio at its last spread (as on the last day of the batch rule) and
+        removes its pairs.
+
+        Returns:
+        list of "close" events
+        """
+        state = self._state
+        rows = self._portfolios == name
+        delta_spread = state["direction"] * (state["last_spread"] - state["spread_t"])
+        events = self._events(np.flatnonzero(rows & self._entered), "close", self.last_date, delta_spread)
+
+        keep = ~rows
+        for key in state:
+            state[key] = state[key][keep]
+        self._pairs, self._portfolios, self._entered = self._pairs[keep], self._portfolios[keep], self._entered[keep]
+        del self.portfolio_ends[name]
+        return events
+
+    def on_bar(self, date, prices) -> list:
+        """
+        Processes the prices of one day.
+
+        Parameters:
+        date: day of the bar, portfolios whose trading period ended before it are closed first
+        prices: raw prices of all tickers, a numpy array in the order of tickers (fast path) or a Series
+
+        Returns:
+        list of event dicts (date, portfolio, pair, event = entry / exit / close, direction, spread, return),
+        return is the delta spread without transaction costs for exit and close events
+        """
+        date = pd.Timestamp(date)
+        events = []
+        for name, end in list(self.portfolio_ends.items()):
+            if end < date:
+                events.extend(self.close_portfolio(name))
+
+        if isinstance(prices, pd.Series):
+            prices = prices.reindex(self.tickers)
+        prices = np.asarray(prices, dtype=np.float64)
+        state = self._state
+
+        # spread = P2 - beta * P1 of the prices normalized to the first formation day
+        y = prices[state["idx2"]] / state["base2"] - state["beta"] * (prices[state["idx1"]] / state["base1"])
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # Kalman filter step, the first bar initializes the filter (x0 = y0, R0 = D^2) and is not traded
+            kalman = state["rule"] == KALMAN
+            first = state["n_bars"] == 0
+            A, B, C, D = state["A"], state["B"], state["C"], state["D"]
+            R = (B**2) * state["R_est"] + C**2
+            K = R / (R + D**2)
+            x = A + B * state["x_est"]
+            state["R_est"] = np.where(kalman, np.where(first, D**2, R - K*R), state["R_est"])
+            state["x_est"] = np.where(kalman, np.where(first, y, x + K * (y - x)), state["x_est"])
+
+            # entry and exit signals: normalized spread beyond +-entry_threshold / back at 0 (cointegration),
+            # observed spread outside the bands / beyond the opposite band (Kalman)
+            threshold = np.sqrt(state["R_est"]) * state["threshold_factor"]
+            upper_band, lower_band = state["x_est"] + threshold, state["x_est"] - threshold
+            spread_normalized = (y - state["mean"]) / state["sd"]
+            above = np.where(kalman, y > upper_band, spread_normalized > state["threshold_factor"])
+            below = np.where(kalman, y < lower_band, spread_normalized < -state["threshold_factor"])
+            exit_short = np.where(kalman, y < lower_band, spread_normalized <= 0)
+            exit_long = np.where(kalman, y > upper_band, spread_normalized >= 0)
+            active = ~(kalman & first)
+
+            enter_short = above & ~self._entered & active
+            enter_long = below & ~self._entered & ~enter_short & active
+            enter = enter_short | enter_long
+            state["spread_t"] = np.where(enter, y, state["spread_t"])
+            state["direction"] = np.where(enter_short, -1.0, np.where(enter_long, 1.0, state["direction"]))
+            self._entered = self._entered | enter
+
+            exit_trade = self._entered & active & (((state["direction"] == -1) & exit_short)
+                                                   | ((state["direction"] == 1) & exit_long))
+            returns = np.where(kalman, state["direction"] * (y - state["spread_t"]), np.abs(y - state["spread_t"]))
+            self._entered = self._entered & ~exit_trade
+
+        state["last_spread"] = y
+        state["n_bars"] += 1
+        self.last_date = date
+
+        events.extend(self._events(np.flatnonzero(enter), "entry", date))
+        events.extend(self._events(np.flatnonzero(exit_trade), "exit", date, returns))
+        return events
+
+    def positions(self) -> pd.DataFrame:
+        """
+        Current state of all active pairs.
+        """
+        state = pd.DataFrame({key: value for key, value in self._state.items()
+                              if key in ("x_est", "R_est", "direction", "spread_t", "last_spread")})
+        state.insert(0, "entered", self._entered)
+        state.insert(0, "pair", self._pairs)
+        state.insert(0, "portfolio", self._portfolios)
+        return state
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules are flat files in the repository root, the synthetic prices of the benchmarks are reused by the tests
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from cointegration_functions import (normalize, calculate_and_sort_ssd, select_cointegrated_pairs, batch_ols,
+                                     batch_adf)
+from synthetic import synthetic_prices
+
+sm = pytest.importorskip("statsmodels.api")
+from statsmodels.tsa.stattools import adfuller  # noqa: E402
+
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+
+@pytest.fixture(scope="module")
+def reference_pairs():
+    """
+    x, y prices of every 12th SSD ranked pair of a 24 month formation window, cointegrated (same factor) and not
+    cointegrated pairs, lags from 0 to 18 are selected by AIC.
+    """
+    stocks = normalize(synthetic_prices(n_tickers=60, n_days=504, seed=7))
+    pairs = calculate_and_sort_ssd(stocks).index[::12]
+    x = np.column_stack([stocks[pair.split("_")[0]].to_numpy() for pair in pairs])
+    y = np.column_stack([stocks[pair.split("_")[1]].to_numpy() for pair in pairs])
+    return stocks, x, y
+
+
+def test_batch_ols_matches_statsmodels(reference_pairs):
+    _, x, y = reference_pairs
+    beta, residuals, mean, sd, ols_pvalue = batch_ols(x, y)
+    for p in range(x.shape[1]):
+        model = sm.OLS(y[:, p], x[:, p]).fit()
+        np.testing.assert_allclose(beta[p], model.params[0], rtol=1e-10)
+        np.testing.assert_allclose(residuals[:, p], model.resid, rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(mean[p], np.mean(model.resid), rtol=1e-7, atol=1e-12)
+        np.testing.assert_allclose(sd[p], np.std(model.resid), rtol=1e-10)
+        np.testing.assert_allclose(ols_pvalue[p], model.pvalues[0], rtol=1e-6, atol=1e-300)
+
+
+def test_batch_adf_matches_adfuller(reference_pairs):
+    _, x, y = reference_pairs
+    residuals = batch_ols(x, y)[1]
+    adf_stat, adf_pvalue, usedlag = batch_adf(residuals)
+    for p in range(residuals.shape[1]):
+        stat, pvalue, lag = adfuller(residuals[:, p], autolag="AIC")[:3]
+        assert usedlag[p] == lag
+        np.testing.assert_allclose(adf_stat[p], stat, rtol=1e-8)
+        np.testing.assert_allclose(adf_pvalue[p], pvalue, rtol=1e-6, atol=1e-12)
+        # the selection decision of select_cointegrated_pairs never flips
+        assert (adf_pvalue[p] < 0.05) == (pvalue < 0.05)
+
+
+def test_batch_adf_fixed_lag(reference_pairs):
+    _, x, y = reference_pairs
+    residuals = batch_ols(x, y)[1][:, :20]
+    adf_stat, adf_pvalue, usedlag = batch_adf(residuals, maxlag=3, autolag=None)
+    assert np.all(usedlag == 3)
+    for p in range(residuals.shape[1]):
+        stat, pvalue = adfuller(residuals[:, p], maxlag=3, autolag=None)[:2]
+        np.testing.assert_allclose(adf_stat[p], stat, rtol=1e-8)
+        np.testing.assert_allclose(adf_pvalue[p], pvalue, rtol=1e-6, atol=1e-12)
+
+
+def test_numpy_screening_selects_the_same_portfolio(reference_pairs):
+    stocks, _, _ = reference_pairs
+    pairs = calculate_and_sort_ssd(stocks)
+    expected = select_cointegrated_pairs(stocks, pairs, method="statsmodels")
+    portfolio = select_cointegrated_pairs(stocks, pairs, method="numpy")
+    assert list(portfolio.index) == list(expected.index)
+    np.testing.assert_allclose(portfolio.to_numpy(dtype=np.float64), expected.to_numpy(dtype=np.float64),
+                               rtol=1e-8)
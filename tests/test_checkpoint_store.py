@@ -0,0 +1,110 @@
+import os
+
+import pandas as pd
+import pytest
+
+from checkpoint_store import CheckpointStore
+from cointegration_functions import run_strategy_hossein
+from kalman_functions import run_strategy_kalman
+from pair_prefilter import PairPrefilter
+from screening_cascade import ScreeningCascade
+from synthetic import synthetic_prices
+
+# adfuller of the statsmodels screening warns about its future return type
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+# short periods keep the backtests small: 6 month formation / 2 month trading periods on 14 months of prices
+DEFAULTS = dict(formation_months=6, trading_months=2, screening_method="numpy")
+
+
+@pytest.fixture(scope="module")
+def stocks():
+    return synthetic_prices(n_tickers=30, n_days=300, seed=3)
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # the backtests write their log files into the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def _stored_hashes(store: CheckpointStore) -> dict:
+    return {key: store.stored_hash(key) for key in store.keys()}
+
+
+def _backtest(run_strategy, stocks, checkpoints=None, **settings):
+    return run_strategy(stocks.copy(), checkpoints=checkpoints, **{**DEFAULTS, **settings})
+
+
+@pytest.mark.parametrize("run_strategy, settings", [
+    (run_strategy_hossein, {"entry_threshold": 1.0}),
+    (run_strategy_hossein, {"n_pairs": 5}),
+    (run_strategy_hossein, {"cascade": ScreeningCascade()}),
+    (run_strategy_hossein, {"prefilter": PairPrefilter(n_components=8, n_neighbors=10)}),
+    (run_strategy_hossein, {"screening_method": "statsmodels"}),
+    (run_strategy_kalman, {"threshold_factor": 2.0}),
+    (run_strategy_kalman, {"n_pairs": 5}),
+    (run_strategy_kalman, {"warm_start": True}),
+], ids=["entry_threshold", "n_pairs", "cascade", "prefilter", "screening_method", "threshold_factor",
+        "kalman_n_pairs", "warm_start"])
+def test_changed_settings_are_recomputed(stocks, tmp_path, run_strategy, settings):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    _backtest(run_strategy, stocks, store)
+    first_hashes = _stored_hashes(store)
+    assert len(first_hashes) > 1
+
+    returns, trade_counts = _backtest(run_strategy, stocks, store, **settings)
+    # every period was run again with the new settings and stored under a new hash
+    second_hashes = _stored_hashes(store)
+    assert second_hashes.keys() == first_hashes.keys()
+    assert all(second_hashes[key] != first_hashes[key] for key in first_hashes)
+
+    expected_returns, expected_trade_counts = _backtest(run_strategy, stocks, **settings)
+    pd.testing.assert_frame_equal(returns, expected_returns)
+    pd.testing.assert_frame_equal(trade_counts, expected_trade_counts)
+
+
+def test_unchanged_settings_are_loaded(stocks, tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    expected_returns, expected_trade_counts = _backtest(run_strategy_hossein, stocks, store, entry_threshold=1.5)
+    hashes = _stored_hashes(store)
+    modified = {key: (tmp_path / "checkpoints" / f"{key}.sha1").stat().st_mtime_ns for key in hashes}
+
+    # the runtime options (here the screening workers) are not part of the settings
+    returns, trade_counts = _backtest(run_strategy_hossein, stocks, store, entry_threshold=1.5, screening_workers=2)
+    assert _stored_hashes(store) == hashes
+    assert {key: (tmp_path / "checkpoints" / f"{key}.sha1").stat().st_mtime_ns for key in hashes} == modified
+    pd.testing.assert_frame_equal(returns, expected_returns)
+    pd.testing.assert_frame_equal(trade_counts, expected_trade_counts)
+
+
+def test_settings_fingerprint():
+    assert CheckpointStore.settings(n_pairs=20, entry_threshold=2.0) == "entry_threshold=2.0,n_pairs=20"
+    assert (CheckpointStore.settings(cascade=ScreeningCascade(max_half_life=40.0))
+            != CheckpointStore.settings(cascade=ScreeningCascade()))
+
+
+def test_only_new_and_changed_periods_are_run(stocks, tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    _backtest(run_strategy_hossein, stocks.iloc[:260], store)
+    hashes = _stored_hashes(store)
+    modified = {key: (tmp_path / "checkpoints" / f"{key}.sha1").stat().st_mtime_ns for key in hashes}
+
+    # new days appended: the stored periods are loaded, only the new periods are run
+    returns, _ = _backtest(run_strategy_hossein, stocks, store)
+    assert set(returns.columns) - set(hashes)
+    assert {key: (tmp_path / "checkpoints" / f"{key}.sha1").stat().st_mtime_ns for key in hashes} == modified
+    pd.testing.assert_frame_equal(returns, _backtest(run_strategy_hossein, stocks)[0])
+
+    # a changed price only reruns the periods whose window contains it, a period without a hash is always rerun
+    first_key, last_key = store.keys()[0], store.keys()[-1]
+    changed = stocks.copy()
+    changed.loc[changed.index >= pd.Timestamp(last_key[len("Portfolio_"):]), "T0000"] *= 1.5
+    os.remove(tmp_path / "checkpoints" / f"{first_key}.sha1")
+    hashes = _stored_hashes(store)
+    returns, _ = _backtest(run_strategy_hossein, changed, store)
+    rerun = [key for key, stored_hash in _stored_hashes(store).items() if stored_hash != hashes[key]]
+    assert first_key in rerun
+    assert last_key in rerun
+    assert len(rerun) < len(hashes)
+    pd.testing.assert_frame_equal(returns, _backtest(run_strategy_hossein, changed)[0])
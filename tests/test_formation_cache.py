@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from cointegration_functions import run_strategy_hossein
+from formation_cache import FormationCache
+from synthetic import synthetic_prices
+
+# adfuller of the statsmodels screening warns about its future return type
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # the backtests write their log files into the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def _portfolios(cache: FormationCache) -> set:
+    return {name for name in os.listdir(cache.directory) if "_portfolio." in name}
+
+
+def test_screening_methods_do_not_share_formations(tmp_path):
+    stocks = synthetic_prices(n_tickers=30, n_days=300, seed=3)
+    cache = FormationCache(str(tmp_path / "formation"))
+    run_strategy_hossein(stocks.copy(), formation_cache=cache, formation_months=6, trading_months=2)
+    statsmodels_entries = _portfolios(cache)
+    assert statsmodels_entries
+
+    # a numpy run stores its own portfolios instead of loading the statsmodels ones, a second run loads them
+    run_strategy_hossein(stocks.copy(), formation_cache=cache, screening_method="numpy", formation_months=6,
+                         trading_months=2)
+    numpy_entries = _portfolios(cache) - statsmodels_entries
+    assert len(numpy_entries) == len(statsmodels_entries)
+    run_strategy_hossein(stocks.copy(), formation_cache=cache, screening_method="numpy", formation_months=6,
+                         trading_months=2)
+    assert _portfolios(cache) == statsmodels_entries | numpy_entries
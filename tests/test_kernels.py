@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import kernels
+from cointegration_functions import (normalize, calculate_and_sort_ssd, select_cointegrated_pairs,
+                                     calculate_portfolio_spread, trade_portfolio)
+from kalman_functions import estimate_model, trade_portfolio_kalman
+from synthetic import synthetic_prices
+
+# the loop backends are compared with the numpy backend bit for bit
+BACKENDS = ["python", pytest.param("numba", marks=pytest.mark.skipif(not kernels.numba_available(),
+                                                                      reason="numba is not installed"))]
+KERNELS = ["em_scalar", "em_scalar_warm_start", "em_scalar_warm_start_rtol", "kalman_variance_sequence",
+           "kalman_filter", "trade_spreads", "trade_spreads_per_column", "trade_kalman_bands",
+           "trade_kalman_bands_per_column", "pair_ssd", "replay_signals"]
+
+
+@pytest.fixture
+def backend(request):
+    previous = kernels.get_backend()
+    yield request.param
+    kernels.set_backend(previous)
+
+
+@pytest.fixture(scope="module")
+def portfolio():
+    """
+    20 cointegrated pairs of a 24 month formation window and the next 6 months of prices with missing days, a
+    suspended stock and a stock that stops trading.
+    """
+    stocks = synthetic_prices(n_tickers=60, n_days=630, seed=11)
+    formation, trading = stocks.iloc[:504], stocks.iloc[504:].copy()
+    formation_normalized = normalize(formation)
+    pairs = select_cointegrated_pairs(formation_normalized, calculate_and_sort_ssd(formation_normalized),
+                                      method="numpy")
+    rng = np.random.default_rng(0)
+    trading = trading.mask(rng.random(trading.shape) < 0.02)
+    stock1 = pairs.index[0].split("_")[0]
+    stock2 = pairs.index[-1].split("_")[1]
+    trading.iloc[30:40, trading.columns.get_loc(stock1)] = np.nan
+    trading.iloc[100:, trading.columns.get_loc(stock2)] = np.nan
+    return formation_normalized, pairs, trading
+
+
+def _in_backend(name: str, function, *args, **kwargs):
+    kernels.set_backend(name)
+    return function(*args, **kwargs)
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_kernels_match_numpy(backend):
+    checked = kernels.check_backends([backend])[backend]
+    assert sorted(checked) == sorted(KERNELS)
+    assert [kernel for kernel, equal in checked.items() if not equal] == []
+
+
+@pytest.mark.parametrize("use_costs", [False, True], ids=["nocost", "cost"])
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_trade_portfolio_matches_numpy(backend, portfolio, use_costs):
+    _, pairs, trading = portfolio
+    spread, spread_normalized = calculate_portfolio_spread(normalize(trading), pairs)
+    assert spread.isna().to_numpy().any()
+
+    expected = _in_backend("numpy", trade_portfolio, spread, spread_normalized, useTransactionCosts=use_costs)
+    result = _in_backend(backend, trade_portfolio, spread, spread_normalized, useTransactionCosts=use_costs)
+    for expected_df, result_df in zip(expected, result):
+        pd.testing.assert_frame_equal(result_df, expected_df, check_exact=True)
+    assert (expected[1].to_numpy() != 0).any()
+
+
+@pytest.mark.parametrize("use_costs", [False, True], ids=["nocost", "cost"])
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_trade_portfolio_kalman_matches_numpy(backend, portfolio, use_costs):
+    formation, pairs, trading = portfolio
+    # the EM runs in the backend too, so the whole estimation -> filter -> trading chain is compared
+    expected_models = _in_backend("numpy", estimate_model, formation, pairs)
+    models = _in_backend(backend, estimate_model, formation, pairs)
+    pd.testing.assert_frame_equal(models, expected_models, check_exact=True)
+
+    expected = _in_backend("numpy", trade_portfolio_kalman, expected_models, normalize(trading),
+                           useTransactionCosts=use_costs)
+    result = _in_backend(backend, trade_portfolio_kalman, models, normalize(trading), useTransactionCosts=use_costs)
+    for expected_df, result_df in zip(expected, result):
+        pd.testing.assert_frame_equal(result_df, expected_df, check_exact=True)
+    assert (expected[4].to_numpy() != 0).any()
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        kernels.set_backend("fortran")
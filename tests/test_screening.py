@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+
+import cointegration_functions
+from cointegration_functions import (normalize, calculate_and_sort_ssd, select_cointegrated_pairs, screening_pool,
+                                     shutdown_screening_pool)
+from synthetic import synthetic_prices
+
+# adfuller of the statsmodels screening warns about its future return type
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+
+@pytest.fixture(scope="module")
+def windows():
+    stocks = synthetic_prices(n_tickers=60, n_days=546, n_factors=50, seed=5)
+    windows = [normalize(stocks.iloc[start:start + 504]) for start in (0, 21, 42)]
+    return [(window, calculate_and_sort_ssd(window)) for window in windows]
+
+
+@pytest.mark.parametrize("method", ["statsmodels", "numpy"])
+def test_parallel_screening_matches_serial(windows, method):
+    try:
+        for window, pairs in windows:
+            expected = select_cointegrated_pairs(window, pairs, method=method)
+            portfolio = select_cointegrated_pairs(window, pairs, n_workers=2, method=method)
+            pd.testing.assert_frame_equal(portfolio, expected)
+            assert portfolio.attrs == expected.attrs
+    finally:
+        shutdown_screening_pool()
+
+
+def test_screening_pool_is_reused(windows):
+    try:
+        pool = screening_pool(2)
+        for window, pairs in windows:
+            select_cointegrated_pairs(window, pairs, n_workers=2)
+        assert screening_pool(2) is pool
+        # another number of workers replaces the pool
+        assert screening_pool(3) is not pool
+    finally:
+        shutdown_screening_pool()
+    assert cointegration_functions._screening_executor is None